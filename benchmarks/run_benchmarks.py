@@ -0,0 +1,207 @@
+"""
+Benchmarks of the retrieval methods and of the phase integrators on
+synthetic speckle data (mobi_plugin._sample_data), so that the effect of a
+change on the speed of each method can be measured. The data only depend on
+the size, the number of membrane positions and the seed, so that runs made
+on the same machine before and after a change are comparable::
+
+    python benchmarks/run_benchmarks.py --sizes 128 256 --points 8 --output before.json
+    python benchmarks/run_benchmarks.py --sizes 128 256 --points 8 --compare before.json
+
+Each case is run `--repeat` times; the minimum and median wall times are
+reported, with the memory increase during the run and the stages (correct,
+solve, median filter, ...) of the fastest run. Every run is timed as the
+first projection of a scan: what the previous runs kept for the next
+projections is forgotten first (cold_start). `--precision float64 float32`
+runs every case in both working precisions.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import time
+
+import numpy as np
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._dispatch import METHODS, run_processing
+from mobi_plugin.pipeline._experiment import PRECISIONS, ExperimentParameters
+from mobi_plugin.pipeline._shared import shutdown_pool
+from mobi_plugin.pipeline._timing import TIMINGS_KEY, StageTimings, timed_stage
+from mobi_plugin.popcorn.fourier_integration import fourier_solver
+from mobi_plugin.popcorn.frankoChellappa import frankotchellappa
+from mobi_plugin.popcorn.ls_integration import least_squares
+from mobi_plugin.popcorn.reference_cache import REFERENCE_CACHE, REFERENCE_CACHE_VARIABLE, REFERENCE_PREPARATIONS
+
+# Geometry of the synthetic acquisition, shared by all the methods
+GEOMETRY = {"pixel": 6.5e-6, "energy": 25000., "dist_object_detector": 1., "dist_source_object": 140.}
+
+# Parameters of each method (median filters disabled, so that only the method is timed)
+METHOD_PARAMETERS = {
+    'lcs': {"alpha": 0., "weak_absorption": False},
+    'lcs_df': {"max_shift": 2, "LCS_median_filter": 0},
+    'lcs_dirdf': {"max_shift": 2, "LCS_median_filter": 0},
+    'misti': {"beta": 1e-9, "delta": 1e-7, "MIST_median_filter": 0, "sigma_regularization": 0.},
+    'mistii1': {"beta": 1e-9, "delta": 1e-7, "MIST_median_filter": 0, "sigma_regularization": 0.},
+    'mistii2': {"beta": 1e-9, "delta": 1e-7, "MIST_median_filter": 0, "sigma_regularization": 0.},
+    'pavlov2020': {"beta": 1e-9, "delta": 1e-7, "sigma_regularization": 0., "source_size": 1e-6},
+    'xsvt': {"max_shift": 2, "XSVT_median_filter": 0, "XSVT_Nw": 2},
+    'reversflowlcs': {"max_shift": 2},
+    'specklematching': {"max_shift": 2, "UMPA_Nw": 2},
+}
+
+INTEGRATORS = {
+    'kottler': lambda gx, gy: fourier_solver(gx, gy, 1., 1., solver='kottler'),
+    'fourier_frankot_chellappa': lambda gx, gy: fourier_solver(gx, gy, 1., 1., solver='frankot_chellappa'),
+    'frankotchellappa': lambda gx, gy: frankotchellappa(gx, gy),
+    'least_squares_southwell': lambda gx, gy: least_squares(gx, gy, 1., 1., model='southwell'),
+}
+
+
+def build_experiment(method, nb_of_point, precision=PRECISIONS[0]):
+    experiment = ExperimentParameters(method, precision=precision, **GEOMETRY, **METHOD_PARAMETERS[method])
+    if hasattr(experiment, "nb_of_point"):
+        experiment.nb_of_point = nb_of_point
+    return experiment
+
+def cold_start():
+    """
+    Forget what a run keeps for the next projections of a scan, so that the
+    next run does all its work: the reference preparations of LCS DF and
+    LCS DirDF, in memory or saved in the folder of REFERENCE_CACHE_VARIABLE,
+    the pseudo-inverses of the MIST reference systems, and the process pool,
+    whose workers are started again. The float64 and float32 runs of a case
+    are then compared on the same work.
+    """
+    os.environ.pop(REFERENCE_CACHE_VARIABLE, None)
+    REFERENCE_PREPARATIONS.clear()
+    REFERENCE_CACHE.clear()
+    shutdown_pool()
+
+def time_runs(function, repeat, setup=None):
+    """
+    Run function `repeat` times (its prints hidden), after setup(), not timed, if given.
+
+    Returns:
+        wall_times (list): wall time of each run, in seconds.
+        result: what the fastest run returned.
+    """
+    wall_times = []
+    fastest = None
+    for _ in range(repeat):
+        if setup is not None:
+            setup()
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            result = function()
+            wall_time = time.perf_counter() - start
+        if not wall_times or wall_time < min(wall_times):
+            fastest = result
+        wall_times.append(wall_time)
+    return wall_times, fastest
+
+def benchmark_method(method, sample, reference, repeat, precision=PRECISIONS[0]):
+    nb_of_point = sample.shape[0]
+
+    def run():
+        # The whole run is measured apart, the stages being recorded by run_processing
+        timings = StageTimings()
+        with timings.activate(), timed_stage("run"):
+            results = run_processing(build_experiment(method, nb_of_point, precision), sample, reference)
+        return timings.as_dict()["run"]["memory_increase"], results[TIMINGS_KEY]
+
+    wall_times, (memory, stages) = time_runs(run, repeat, cold_start)
+    return wall_times, memory, {name: round(record["wall_time"], 4) for name, record in stages.items()}
+
+def benchmark_integrator(integrator, gx, gy, repeat):
+    def run():
+        timings = StageTimings()
+        with timings.activate(), timed_stage("run"):
+            INTEGRATORS[integrator](gx, gy)
+        return timings.as_dict()
+
+    wall_times, stages = time_runs(run, repeat)
+    return wall_times, stages["run"]["memory_increase"], {}
+
+def run_benchmarks(sizes, points, methods, integrators, repeat=3, seed=0, precisions=PRECISIONS[:1]):
+    """
+    Returns:
+        list: one dict per case, with its name, size, number of points,
+        precision, minimum and median wall times, memory increase (bytes)
+        and the stages of the fastest run.
+    """
+    cases = []
+
+    def report(name, size, nb_of_point, precision, wall_times, memory, stages):
+        case = {"name": name, "size": size, "nb_of_point": nb_of_point, "precision": precision,
+                "min": round(min(wall_times), 4), "median": round(statistics.median(wall_times), 4),
+                "memory": memory, "stages": stages}
+        cases.append(case)
+        print(f"{name:<28}{size:>6}{nb_of_point if nb_of_point else '':>6}{precision:>9}"
+              f"{case['min']:>10.3f}{case['median']:>10.3f}{memory / 1e6:>10.1f}", flush=True)
+
+    print(f"{'case':<28}{'size':>6}{'pts':>6}{'prec':>9}{'min (s)':>10}{'med (s)':>10}{'mem (MB)':>10}")
+    for size in sizes:
+        for nb_of_point in points:
+            sample, reference, truth = make_speckle_stacks(shape=(size, size), nb_of_point=nb_of_point, seed=seed)
+            for method in methods:
+                for precision in precisions:
+                    try:
+                        report(method, size, nb_of_point, precision, *benchmark_method(method, sample, reference, repeat, precision))
+                    except Exception as e:
+                        print(f"{method:<28}{size:>6}{nb_of_point:>6}{precision:>9}  failed: {e}")
+        # The integrators only depend on the size: integrate the true displacements
+        truth = make_speckle_stacks(shape=(size, size), nb_of_point=1, seed=seed)[2]
+        for integrator in integrators:
+            for precision in precisions:
+                gx, gy = truth["dx"].astype(precision), truth["dy"].astype(precision)
+                report(integrator, size, None, precision, *benchmark_integrator(integrator, gx, gy, repeat))
+    return cases
+
+def compare(cases, previous):
+    """
+    Print the speedup of each case over the same case of a previous run.
+    """
+    def key(case):
+        return case["name"], case["size"], case["nb_of_point"], case.get("precision", PRECISIONS[0])
+
+    previous_min = {key(case): case["min"] for case in previous["cases"]}
+    print(f"\n{'case':<28}{'size':>6}{'pts':>6}{'prec':>9}{'before':>10}{'after':>10}{'speedup':>10}")
+    for case in cases:
+        before = previous_min.get(key(case))
+        if before is None:
+            continue
+        print(f"{case['name']:<28}{case['size']:>6}{case['nb_of_point'] if case['nb_of_point'] else '':>6}{case['precision']:>9}"
+              f"{before:>10.3f}{case['min']:>10.3f}{before / case['min']:>9.2f}x")
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Time the retrieval methods and the integrators on synthetic speckle data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[128, 256], help="side of the square images (default: 128 256)")
+    parser.add_argument("--points", type=int, nargs="+", default=[8], help="numbers of membrane positions (default: 8)")
+    parser.add_argument("--methods", nargs="*", default=list(METHOD_PARAMETERS), choices=list(METHODS), help="methods to time (default: all)")
+    parser.add_argument("--integrators", nargs="*", default=list(INTEGRATORS), choices=list(INTEGRATORS), help="integrators to time (default: all)")
+    parser.add_argument("--precision", nargs="+", default=list(PRECISIONS[:1]), choices=PRECISIONS, help="working precisions (default: float64)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs of each case (default: 3)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic data (default: 0)")
+    parser.add_argument("--output", metavar="FILE", help="write the results to this JSON file")
+    parser.add_argument("--compare", metavar="FILE", help="JSON file of a previous run to compare with")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    cases = run_benchmarks(args.sizes, args.points, args.methods, args.integrators, args.repeat, args.seed, args.precision)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"python": platform.python_version(), "numpy": np.__version__, "machine": platform.machine(),
+                       "seed": args.seed, "repeat": args.repeat, "cases": cases}, f, indent=2)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(cases, json.load(f))
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
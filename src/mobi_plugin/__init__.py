@@ -6,20 +6,30 @@ except ImportError:
 # Importation des fonctions nécessaires des différents modules
 from ._writer import write_tiff
 
-from ._widgets import (
-    LcsWidget,
-    LcsdfWidget,
-    LcsdirdfWidget,
-    MistiWidget,
-    Mistii1Widget,
-    Mistii2Widget,
-    Pavlov2020Widget,
-    XsvtWidget,
-    ReversflowlcsWidget,
-    SpecklematchingWidget
+# The widgets are imported on first use, so that the headless processing
+# (mobi-process) does not load Qt
+_WIDGETS = (
+    "LcsWidget",
+    "LcsdfWidget",
+    "LcsdirdfWidget",
+    "MistiWidget",
+    "Mistii1Widget",
+    "Mistii2Widget",
+    "Pavlov2020Widget",
+    "XsvtWidget",
+    "ReversflowlcsWidget",
+    "SpecklematchingWidget",
+    "TimingsWidget"
 )
 
 
+def __getattr__(name):
+    if name in _WIDGETS:
+        from . import _widgets
+        return getattr(_widgets, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 # Liste des objets exposés par le package
 __all__ = (
     "__version__",
@@ -33,20 +43,11 @@ __all__ = (
     "Pavlov2020Widget",
     "XsvtWidget",
     "ReversflowlcsWidget",
-    "SpecklematchingWidget"
+    "SpecklematchingWidget",
+    "TimingsWidget"
 )
 
 
 def napari_experimental_provide_dock_widget():
-    return [
-        LcsWidget,
-        LcsdfWidget,
-        LcsdirdfWidget,
-        MistiWidget,
-        Mistii1Widget,
-        Mistii2Widget,
-        Pavlov2020Widget,
-        XsvtWidget,
-        ReversflowlcsWidget,
-        SpecklematchingWidget
-    ]
+    from . import _widgets
+    return [getattr(_widgets, name) for name in _WIDGETS]
@@ -0,0 +1,172 @@
+"""
+Headless entry point (``mobi-process``) running a retrieval method on
+images read from disk, without napari or any display.
+
+The method and its parameters come from a YAML or JSON file::
+
+    method: xsvt
+    parameters:
+      max_shift: 4
+      pixel: 6.5e-6
+      energy: 25000
+      dist_object_detector: 1.0
+      dist_source_object: 140.0
+      XSVT_median_filter: 0
+      XSVT_Nw: 2
+    phase:              # optional, same as the "Phase Retrieval" section
+      method: Kottler
+      pad: antisym
+    hdf5:               # optional, slice used for each 3D dataset
+      /entry/data/data: {slice: 0, dimension: 0, use_median: false}
+"""
+import argparse
+import json
+import os
+
+import numpy as np
+import yaml
+
+from ._writer import write_tiff
+from .pipeline._batch import process_batch
+from .pipeline._cache import ResultCache
+from .pipeline._dispatch import run_processing
+from .pipeline._experiment import ExperimentParameters
+from .pipeline._progress import ProcessingMonitor
+from .popcorn.reference_cache import REFERENCE_CACHE_VARIABLE
+from .pipeline._timing import TIMINGS_KEY, StageTimings, merge_timings, timed_stage, write_timings
+from .readers._edf_reader import read_edf
+from .readers._hdf5_reader import default_slices_info, read_hdf5
+
+# Attributes of ExperimentParameters which are not method parameters
+NON_PARAMETERS = ("method", "sample_images", "reference_images", "darkfield", "flatfield", "phase_parameters", "nb_of_point", "workers")
+
+
+def load_config(path):
+    """
+    Load the method and its parameters from a YAML or JSON file.
+    """
+    with open(path) as f:
+        if path.endswith(".json"):
+            return json.load(f)
+        return yaml.safe_load(f)
+
+def load_images(paths, slices_info=None):
+    """
+    Read images with the plugin readers and return them as a single array.
+    A single .npy file is memory-mapped, which allows 4D scans (batch mode).
+    """
+    if paths is None:
+        return None
+
+    if len(paths) == 1 and paths[0].endswith(".npy"):
+        return np.load(paths[0], mmap_mode="r")
+
+    if all(path.endswith(".edf") for path in paths):
+        layers = read_edf(paths)
+    else:
+        if slices_info is None:
+            slices_info = default_slices_info(paths[0])
+        layers = read_hdf5(paths, slices_info=slices_info)
+
+    if len(layers) == 0:
+        raise ValueError(f"No image found in {paths}")
+    if len(layers) > 1:
+        names = [meta["name"] for data, meta, layer_type in layers]
+        raise ValueError(f"Several datasets found in {paths} ({names}), select one in the 'hdf5' section of the configuration")
+    return layers[0][0]
+
+def build_experiment(config):
+    """
+    Create the experiment parameters from the configuration dictionary.
+    """
+    experiment = ExperimentParameters(config["method"], **config.get("parameters", {}))
+    experiment.phase_parameters = config.get("phase")
+
+    missing = [name for name, value in vars(experiment).items() if value is None and name not in NON_PARAMETERS]
+    if missing:
+        raise ValueError(f"Missing parameters for method {experiment.method}: {', '.join(missing)}")
+    return experiment
+
+def write_results(results, method, output, file_format="tif"):
+    """
+    Write the resulting images in the output folder, named like the layers
+    the widgets would create.
+    """
+    os.makedirs(output, exist_ok=True)
+    results = {name: image for name, image in results.items() if name != TIMINGS_KEY}
+    if file_format == "npz":
+        path = os.path.join(output, f"{method}.npz")
+        np.savez(path, **{name: np.real(image) for name, image in results.items()})
+        return [path]
+
+    paths = []
+    for name, image in results.items():
+        layer_name = f"{method}_phase" if name == "phase" else f"{name}_{method}"
+        paths += write_tiff(os.path.join(output, f"{layer_name}.tif"), np.real(image), {})
+    return paths
+
+class StagePrinter:
+    """
+    Progress callback printing each new processing stage once.
+    """
+    def __init__(self):
+        self.stage = None
+
+    def __call__(self, stage, fraction):
+        if stage != self.stage:
+            print(f"[mobi-process] {stage}")
+            self.stage = stage
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(prog="mobi-process", description="Run a MoBI phase retrieval method without napari.")
+    parser.add_argument("--config", required=True, help="YAML or JSON file with the method and its parameters")
+    parser.add_argument("--sample", nargs="+", required=True, help="sample image files (HDF5/NXS, EDF or a single .npy)")
+    parser.add_argument("--reference", nargs="+", required=True, help="reference image files")
+    parser.add_argument("--dark", nargs="+", help="darkfield image files")
+    parser.add_argument("--flat", nargs="+", help="flatfield image files")
+    parser.add_argument("--output", required=True, help="folder where the results are written")
+    parser.add_argument("--format", choices=("tif", "npz"), default="tif", help="output file format (default: tif)")
+    parser.add_argument("--cache", metavar="DIR", help="reuse results stored in this folder, and store new ones there")
+    parser.add_argument("--reference-cache", metavar="DIR", help="keep the derivatives of the reference images (LCS DF, LCS DirDF) in this folder, for the next runs")
+    parser.add_argument("--tile-size", type=int, default=None, help="solve on tiles of this size in pixels (default: only if the frame does not fit in memory, 0: never)")
+    parser.add_argument("--timings", metavar="FILE", help="write the time and memory of each stage to this JSON file")
+    parser.add_argument("--workers", type=int, default=None, help="processes used for a 4D sample scan, threads of the lcs method for a single projection (default: all cores)")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    config = load_config(args.config)
+    experiment = build_experiment(config)
+    slices_info = config.get("hdf5")
+
+    timings = StageTimings()
+    with timings.activate(), timed_stage("read"):
+        sample = load_images(args.sample, slices_info)
+        reference = load_images(args.reference, slices_info)
+        darkfield = load_images(args.dark, slices_info)
+        flatfield = load_images(args.flat, slices_info)
+    if hasattr(experiment, "nb_of_point"):
+        experiment.nb_of_point = sample.shape[-3]
+
+    cache = ResultCache(args.cache) if args.cache else None
+    if args.reference_cache:
+        # Read by the batch workers too
+        os.environ[REFERENCE_CACHE_VARIABLE] = args.reference_cache
+    with ProcessingMonitor(callback=StagePrinter()).activate():
+        if sample.ndim == 4:
+            results = process_batch(experiment, sample, reference, darkfield, flatfield, workers=args.workers, cache=cache)
+            results[TIMINGS_KEY] = merge_timings(timings.as_dict(), results[TIMINGS_KEY])
+        else:
+            if args.workers and hasattr(experiment, "workers"):
+                experiment.workers = args.workers
+            results = run_processing(experiment, sample, reference, darkfield, flatfield, cache=cache, tile_size=args.tile_size, timings=timings)
+
+    paths = write_results(results, experiment.method, args.output, args.format)
+    if args.timings:
+        write_timings(args.timings, results[TIMINGS_KEY], method=experiment.method)
+    print(f"[mobi-process] {len(paths)} file(s) written in {args.output}")
+    return 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,71 @@
+"""
+Deterministic synthetic speckle data, used as napari sample data and by the
+benchmarks (benchmarks/ at the root of the repository).
+"""
+import numpy as np
+from scipy.ndimage import gaussian_filter, map_coordinates
+
+
+def make_speckle_stacks(shape=(256, 256), nb_of_point=8, speckle_size=2.0, max_displacement=1.5,
+                        min_transmission=0.8, dark_field=0.3, noise=0.005, seed=0, dtype=np.float32):
+    """
+    Simulate a speckle-based imaging acquisition of a sphere.
+
+    The reference images are a random membrane seen at nb_of_point
+    positions. In the sample images the speckles are displaced by the
+    refraction of the sphere (up to max_displacement pixels), attenuated
+    (down to min_transmission) and lose visibility (up to dark_field).
+    The same seed always gives the same images.
+
+    Args:
+        shape (tuple): (ny, nx) size of the images.
+        nb_of_point (int): number of membrane positions.
+        speckle_size (float): standard deviation of the speckle grains, in pixels.
+        noise (float): standard deviation of the gaussian noise, relative to the mean intensity.
+
+    Returns:
+        sample (NUMPY ARRAY): sample images (nb_of_point x ny x nx).
+        reference (NUMPY ARRAY): reference images (nb_of_point x ny x nx).
+        truth (dict): the displacements 'dx' and 'dy', 'transmission' and 'dark_field' of the sphere.
+    """
+    rng = np.random.default_rng(seed)
+    ny, nx = shape
+    margin = int(4 * speckle_size) + 8
+
+    membrane = gaussian_filter(rng.normal(size=(ny + 2 * margin, nx + 2 * margin)), speckle_size)
+    membrane = 1 + 0.5 * membrane / membrane.std()
+    positions = rng.integers(-margin + 1, margin, size=(nb_of_point, 2))
+
+    # Sphere of radius a third of the field of view
+    y, x = np.mgrid[:ny, :nx].astype(float)
+    radius = min(ny, nx) / 3
+    thickness = np.sqrt(np.clip(radius**2 - (y - ny / 2)**2 - (x - nx / 2)**2, 0, None)) / radius
+    gradient_y, gradient_x = np.gradient(thickness)
+    scale = max_displacement / max(np.abs(gradient_y).max(), np.abs(gradient_x).max())
+    dy = gaussian_filter(gradient_y * scale, 1)
+    dx = gaussian_filter(gradient_x * scale, 1)
+    transmission = 1 - (1 - min_transmission) * thickness
+    visibility = 1 - dark_field * thickness
+
+    reference = np.empty((nb_of_point, ny, nx), dtype=dtype)
+    sample = np.empty((nb_of_point, ny, nx), dtype=dtype)
+    for k, (py, px) in enumerate(positions):
+        window = membrane[margin + py:margin + py + ny, margin + px:margin + px + nx]
+        reference[k] = window + noise * rng.normal(size=shape)
+        coordinates = np.array([y + margin + py - dy, x + margin + px - dx])
+        displaced = map_coordinates(membrane, coordinates, order=3, mode="nearest")
+        mean = gaussian_filter(displaced, 3 * speckle_size)
+        sample[k] = transmission * (mean + visibility * (displaced - mean)) + noise * rng.normal(size=shape)
+
+    truth = {"dx": dx, "dy": dy, "transmission": transmission, "dark_field": 1 - visibility}
+    return sample, reference, truth
+
+def make_sample_data():
+    """
+    Sample data of the plugin: synthetic sample and reference speckle images.
+    """
+    sample, reference, truth = make_speckle_stacks()
+    return [
+        (reference, {"name": "synthetic_reference"}, "image"),
+        (sample, {"name": "synthetic_sample"}, "image"),
+    ]
@@ -0,0 +1,42 @@
+import multiprocessing as mp
+import threading
+import time
+
+import numpy as np
+import pytest
+
+pytest.importorskip("mbipy")
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._batch import process_batch
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.pipeline._progress import ProcessingCancelled, ProcessingMonitor
+
+GEOMETRY = {"pixel": 6.5e-6, "energy": 25000., "dist_object_detector": 1., "dist_source_object": 140.}
+
+
+def test_cancel_does_not_wait_for_the_projections_in_flight():
+    # Projections of about ten seconds each (all the shifts up to 24 pixels)
+    sample, reference, _ = make_speckle_stacks(shape=(256, 256), nb_of_point=8)
+    experiment = ExperimentParameters("xsvt", **GEOMETRY, max_shift=24, XSVT_Nw=2, XSVT_median_filter=0)
+    monitor = ProcessingMonitor()
+    cancelled_at = []
+
+    def cancel():
+        cancelled_at.append(time.perf_counter())
+        monitor.cancel()
+
+    timer = threading.Timer(2., cancel)
+    timer.start()
+    try:
+        with monitor.activate(), pytest.raises(ProcessingCancelled):
+            process_batch(experiment, np.stack([sample] * 3), reference, workers=1)
+    finally:
+        timer.cancel()
+
+    assert time.perf_counter() - cancelled_at[0] < 2.
+    # The workers are stopped, not left running the projections
+    deadline = time.perf_counter() + 5.
+    while mp.active_children() and time.perf_counter() < deadline:
+        time.sleep(0.05)
+    assert not mp.active_children()
@@ -0,0 +1,69 @@
+import numpy as np
+
+from mobi_plugin.popcorn.batched_lstsq import solve_normal_equations, solve_pixel_systems
+
+
+def _random_systems(seed, nb_of_point=7, nb_of_variables=3, shape=(5, 6)):
+    rng = np.random.default_rng(seed)
+    RHS = rng.normal(size=(nb_of_point, nb_of_variables) + shape)
+    LHS = rng.normal(size=(nb_of_point,) + shape)
+    # Rank deficient pixels: a null column, two equal columns
+    RHS[:, 1, 0, 0] = 0
+    RHS[:, 2, 3, 4] = RHS[:, 0, 3, 4]
+    return RHS, LHS
+
+
+def _lstsq_per_pixel(RHS, LHS):
+    solution = np.empty(RHS.shape[1:])
+    for i, j in np.ndindex(RHS.shape[2:]):
+        solution[:, i, j] = np.linalg.lstsq(RHS[:, :, i, j], LHS[:, i, j], rcond=None)[0]
+    return solution
+
+
+def _scaled_condition(RHS):
+    condition = np.empty(RHS.shape[2:])
+    for i, j in np.ndindex(RHS.shape[2:]):
+        a = RHS[:, :, i, j]
+        norms = np.linalg.norm(a, axis=0)
+        condition[i, j] = np.linalg.cond(a / np.where(norms > 0, norms, 1))
+    return condition
+
+
+def test_solve_pixel_systems_matches_lstsq():
+    RHS, LHS = _random_systems(0)
+    fallback = [1., 2., 3.]
+
+    # Blocks smaller than the image, the last one truncated
+    solution, condition = solve_pixel_systems(RHS, LHS, fallback, block_pixels=7)
+
+    expected = _lstsq_per_pixel(RHS, LHS)
+    solvable = np.ones(RHS.shape[2:], dtype=bool)
+    solvable[0, 0] = solvable[3, 4] = False
+    np.testing.assert_allclose(solution[:, solvable], expected[:, solvable], atol=1e-12)
+    for i, j in [(0, 0), (3, 4)]:
+        np.testing.assert_array_equal(solution[:, i, j], fallback)
+    assert np.isinf(condition[0, 0])
+    assert condition[3, 4] >= 1 / np.finfo(float).eps
+    assert np.isfinite(condition[solvable]).all()
+
+
+def test_solve_normal_equations_matches_lstsq():
+    RHS, LHS = _random_systems(1)
+    fallback = [1., 2., 3.]
+    AtA = np.einsum('nk...,nl...->kl...', RHS, RHS)
+    Atb = np.einsum('nk...,n...->k...', RHS, LHS)
+
+    solution, condition = solve_normal_equations(AtA, Atb, fallback, block_pixels=7)
+
+    expected = _lstsq_per_pixel(RHS, LHS)
+    solvable = np.ones(RHS.shape[2:], dtype=bool)
+    solvable[0, 0] = solvable[3, 4] = False
+    np.testing.assert_allclose(solution[:, solvable], expected[:, solvable], atol=1e-10)
+    for i, j in [(0, 0), (3, 4)]:
+        np.testing.assert_array_equal(solution[:, i, j], fallback)
+    assert np.isinf(condition[0, 0])
+    # The condition number of the systems with unit norm columns, which the stacked solve only bounds from below
+    exact = _scaled_condition(RHS)
+    stacked_condition = solve_pixel_systems(RHS, LHS, fallback)[1]
+    np.testing.assert_allclose(condition[solvable], exact[solvable], rtol=1e-6)
+    assert (stacked_condition[solvable] <= exact[solvable] * (1 + 1e-9)).all()
@@ -0,0 +1,45 @@
+import os
+from types import SimpleNamespace
+
+import numpy as np
+
+from mobi_plugin.pipeline._cache import ResultCache
+
+
+def test_result_cache_round_trip(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    experiment = SimpleNamespace(method="xsvt", max_shift=4, sample_images="sample")
+    sample = np.random.default_rng(0).random((3, 8, 8))
+    reference = np.random.default_rng(1).random((3, 8, 8))
+    key = cache.key(experiment, sample, reference)
+
+    assert cache.get(key) is None
+    cache.put(key, {"dx": sample[0], "dy": reference[0], "method": "xsvt"})
+    result = cache.get(key)
+
+    # Only the arrays are stored
+    assert sorted(result) == ["dx", "dy"]
+    np.testing.assert_array_equal(result["dx"], sample[0])
+    np.testing.assert_array_equal(result["dy"], reference[0])
+    # The key follows the parameters and the content of the images, not the image attributes
+    assert cache.key(SimpleNamespace(method="xsvt", max_shift=4, sample_images="other"), sample, reference) == key
+    assert cache.key(SimpleNamespace(method="xsvt", max_shift=5, sample_images="sample"), sample, reference) != key
+    assert cache.key(experiment, sample + 1, reference) != key
+
+
+def test_result_cache_evicts_the_least_recently_used_entries(tmp_path):
+    result = {"dx": np.zeros((64, 64))}
+    cache = ResultCache(str(tmp_path))
+    cache.put("first", result)
+    entry_size = os.path.getsize(tmp_path / "first.npz")
+    cache.max_bytes = int(2.5 * entry_size)
+
+    cache.put("second", result)
+    # Older than "second", then used: "second" becomes the least recently used entry
+    os.utime(tmp_path / "first.npz", (0, 0))
+    os.utime(tmp_path / "second.npz", (1, 1))
+    assert cache.get("first") is not None
+    cache.put("third", result)
+
+    assert sorted(os.listdir(tmp_path)) == ["first.npz", "third.npz"]
+    assert cache.get("second") is None
@@ -0,0 +1,20 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+import mobi_plugin
+
+pytest.importorskip("mbipy")
+
+
+def test_cli_imports_without_qt():
+    # A fresh interpreter, as the other tests may already have loaded Qt,
+    # importing this mobi_plugin whether or not it is installed
+    source = os.path.dirname(os.path.dirname(os.path.abspath(mobi_plugin.__file__)))
+    env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [source, os.environ.get("PYTHONPATH")]))}
+    code = ("import sys, mobi_plugin._cli; "
+            "print(sorted({name.split('.')[0] for name in sys.modules} & {'PyQt5', 'qtpy', 'napari'}))")
+    result = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True, env=env)
+    assert result.stdout.strip() == "[]"
@@ -0,0 +1,53 @@
+import numpy as np
+
+from mobi_plugin.pipeline._corrections import apply_corrections, correct_images, prepare_correction
+
+
+def _frames(seed, shape=(3, 6, 5)):
+    return np.random.default_rng(seed).random(shape)
+
+
+def test_per_frame_darks_and_flats_correct_their_own_image():
+    images = 10 * _frames(0)
+    darkfield = _frames(1)
+    flatfield = darkfield + 1 + _frames(2)
+
+    dark, inverse_flat = prepare_correction(darkfield, flatfield, nb_of_point=3, dtype=np.float64)
+    corrected = correct_images(images, dark, inverse_flat, dtype=np.float64, chunk_frames=2)
+
+    np.testing.assert_allclose(corrected, (images - darkfield) / (flatfield - darkfield))
+    # The input is never modified
+    np.testing.assert_array_equal(images, 10 * _frames(0))
+
+
+def test_multi_frame_darks_and_flats_are_averaged():
+    images = 10 * _frames(0)
+    darkfield = _frames(1, (5, 6, 5))
+    flatfield = 2 + _frames(2, (4, 6, 5))
+
+    sample, reference = apply_corrections(images, images[::-1], darkfield, flatfield, dtype=np.float64)
+
+    dark, flat = darkfield.mean(axis=0), flatfield.mean(axis=0)
+    np.testing.assert_allclose(sample, (images - dark) / (flat - dark))
+    np.testing.assert_allclose(reference, (images[::-1] - dark) / (flat - dark))
+    # As many frames as images: averaged only when asked
+    dark, inverse_flat = prepare_correction(darkfield[:3], flatfield[:3], nb_of_point=3, average=True)
+    assert dark.shape == inverse_flat.shape == (6, 5)
+    assert dark.dtype == np.float32
+
+
+def test_pixels_whose_flat_does_not_exceed_the_dark_are_zero():
+    images = 10 * _frames(0)
+    darkfield = np.full((6, 5), 0.5)
+    flatfield = np.full((6, 5), 2.)
+    flatfield[1, 2] = 0.5
+    flatfield[4, 0] = 0.1
+
+    dark, inverse_flat = prepare_correction(darkfield, flatfield, nb_of_point=3)
+    corrected = correct_images(images, dark, inverse_flat)
+
+    assert corrected.dtype == np.float32
+    assert inverse_flat[1, 2] == inverse_flat[4, 0] == 0
+    np.testing.assert_array_equal(corrected[:, 1, 2], 0)
+    np.testing.assert_array_equal(corrected[:, 4, 0], 0)
+    np.testing.assert_allclose(corrected[:, 0, 0], (images[:, 0, 0] - 0.5) / 1.5, rtol=1e-6)
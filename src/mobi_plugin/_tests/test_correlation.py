@@ -0,0 +1,69 @@
+import numpy as np
+from scipy.ndimage import gaussian_filter
+
+from mobi_plugin.popcorn.XSVT import start_tracking
+from mobi_plugin.popcorn.correlation import PearsonSearch, pearson_maps
+
+
+def compute_covariance(roi_ref, roi_sample, pm, w):
+    # Pearson map of one pixel, window by window, as XSVT computed it before pearson_maps
+    pearson_map = np.zeros((roi_ref.shape[1] - 2 * pm, roi_ref.shape[2] - 2 * pm))
+    for l in range(pearson_map.shape[0]):
+        for m in range(pearson_map.shape[1]):
+            x = roi_sample - roi_sample.mean()
+            y = roi_ref[:, l:l + w, m:m + w] - roi_ref[:, l:l + w, m:m + w].mean()
+            if np.std(x) > 0 and np.std(y) > 0:
+                pearson_map[l, m] = np.sum(x * y) / np.sqrt(np.sum(x**2) * np.sum(y**2))
+    return pearson_map
+
+
+def test_pearson_maps_match_the_maps_of_each_pixel():
+    rng = np.random.default_rng(0)
+    max_shift, window, pm = 2, 3, 1
+    sample = rng.random((4, 12 + 2 * pm, 10 + 2 * pm))
+    reference = rng.random((4, 12 + 2 * (max_shift + pm), 10 + 2 * (max_shift + pm)))
+    # A flat sample window: its correlations are 0
+    sample[:, :3, :3] = 1.
+
+    maps = pearson_maps(sample, reference, max_shift, window)
+
+    assert maps.shape == (5, 5, 12, 10)
+    for i, j in [(0, 0), (5, 4), (11, 9)]:
+        expected = compute_covariance(reference[:, i:i + 2 * (max_shift + pm) + 1, j:j + 2 * (max_shift + pm) + 1],
+                                      sample[:, i:i + window, j:j + window], pm, window)
+        np.testing.assert_allclose(maps[:, :, i, j], expected, atol=1e-12)
+
+
+def test_pearson_search_matches_the_maps_around_its_centres():
+    rng = np.random.default_rng(1)
+    max_shift, window, pm = 3, 3, 1
+    sample = rng.random((4, 12 + 2 * pm, 10 + 2 * pm))
+    reference = rng.random((4, 12 + 2 * (max_shift + pm), 10 + 2 * (max_shift + pm)))
+    maps = pearson_maps(sample, reference, max_shift, window)
+
+    rows, cols = np.array([0, 5, 11]), np.array([0, 4, 9])
+    centres = np.array([[0, 0], [2, -1], [-3, 3]])
+    around = PearsonSearch(sample, reference, max_shift, window).maps_around(rows, cols, centres, 1)
+
+    assert around.shape == (3, 3, 3)
+    np.testing.assert_allclose(around[0], maps[2:5, 2:5, 0, 0], atol=1e-12)
+    np.testing.assert_allclose(around[1], maps[4:7, 1:4, 5, 4], atol=1e-12)
+    # Shifts beyond max_shift are never the peak
+    assert np.isneginf(around[2][0]).all() and np.isneginf(around[2][:, 2]).all()
+    np.testing.assert_allclose(around[2][1:, :2], maps[:2, 5:, 11, 9], atol=1e-12)
+
+
+def test_pyramid_search_tracks_the_shifts_of_the_full_search():
+    rng = np.random.default_rng(2)
+    reference = gaussian_filter(rng.normal(size=(4, 80, 80)), (0, 1.5, 1.5))
+    # The speckles move by 7 rows and -5 columns, more than the shifts searched at the coarsest level
+    sample = np.roll(reference, (7, -5), axis=(1, 2))
+
+    full = start_tracking(sample, reference, 10, 5, workers=1, search="full")
+    pyramid = start_tracking(sample, reference, 10, 5, workers=1, search="pyramid")
+
+    inside = (slice(12, -12),) * 2
+    np.testing.assert_allclose(full[0][inside], -5, atol=0.5)
+    np.testing.assert_allclose(full[1][inside], 7, atol=0.5)
+    np.testing.assert_allclose(pyramid[0][inside], full[0][inside], atol=1e-6)
+    np.testing.assert_allclose(pyramid[1][inside], full[1][inside], atol=1e-6)
@@ -0,0 +1,66 @@
+import numpy as np
+import pytest
+from scipy import ndimage, signal
+
+from mobi_plugin.popcorn.derivatives import derivative, gradient, laplacian, second_derivatives, wrapped_differences
+
+
+def _stack(dtype):
+    return np.random.default_rng(0).random((3, 9, 11)).astype(dtype)
+
+
+def _tolerance(dtype):
+    return {"rtol": 1e-5, "atol": 1e-5} if dtype == np.float32 else {"rtol": 1e-12, "atol": 1e-12}
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_derivatives_match_np_gradient(dtype):
+    stack = _stack(dtype)
+    expected_y, expected_x = zip(*(np.gradient(image, 0.5) for image in stack))
+
+    d_y, d_x = gradient(stack, 0.5)
+    assert d_y.dtype == d_x.dtype == dtype
+    np.testing.assert_allclose(d_y, expected_y, **_tolerance(dtype))
+    np.testing.assert_allclose(d_x, expected_x, **_tolerance(dtype))
+    # A single image, and the derivative written into out
+    out = np.empty_like(stack)
+    assert derivative(stack, -1, 0.5, out=out) is out
+    np.testing.assert_allclose(out, expected_x, **_tolerance(dtype))
+    np.testing.assert_allclose(derivative(stack[1], -2, 0.5), expected_y[1], **_tolerance(dtype))
+
+    d_yy, d_xx, d_yx = second_derivatives(stack)
+    for image, yy, xx, yx in zip(stack, d_yy, d_xx, d_yx):
+        g_y, g_x = np.gradient(image)
+        np.testing.assert_allclose(yy, np.gradient(g_y, axis=0), **_tolerance(dtype))
+        np.testing.assert_allclose(xx, np.gradient(g_x, axis=1), **_tolerance(dtype))
+        np.testing.assert_allclose(yx, np.gradient(g_x, axis=0), **_tolerance(dtype))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_laplacian_matches_ndimage_laplace(dtype):
+    stack = _stack(dtype)
+    expected = [ndimage.laplace(image) for image in stack]
+
+    assert laplacian(stack).dtype == dtype
+    np.testing.assert_allclose(laplacian(stack), expected, **_tolerance(dtype))
+    out = np.empty_like(stack)
+    assert laplacian(stack, out=out) is out
+    np.testing.assert_allclose(out, expected, **_tolerance(dtype))
+
+
+@pytest.mark.parametrize("dtype", [np.float32, np.float64])
+def test_wrapped_differences_match_convolve2d(dtype):
+    stack = _stack(dtype)
+    # The previous LCS_DirDF.myGradient
+    expected_x = [signal.convolve2d(image, np.array([[1, 0, -1]]), boundary='wrap', mode='same') for image in stack]
+    expected_y = [signal.convolve2d(image, np.array([[1], [0], [-1]]), boundary='wrap', mode='same') for image in stack]
+
+    d_x, d_y = wrapped_differences(stack)
+    assert d_x.dtype == d_y.dtype == dtype
+    np.testing.assert_allclose(d_x, expected_x, **_tolerance(dtype))
+    np.testing.assert_allclose(d_y, expected_y, **_tolerance(dtype))
+    out = (np.empty_like(stack), np.empty_like(stack))
+    result = wrapped_differences(stack, out=out)
+    assert result[0] is out[0] and result[1] is out[1]
+    np.testing.assert_allclose(out[0], expected_x, **_tolerance(dtype))
+    np.testing.assert_allclose(out[1], expected_y, **_tolerance(dtype))
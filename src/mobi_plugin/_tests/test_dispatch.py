@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+pytest.importorskip("mbipy")
+
+from mbipy.numpy.phase_retrieval import lcs
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline import _dispatch
+from mobi_plugin.pipeline._cache import parameters_digest
+from mobi_plugin.pipeline._dispatch import process_lcs, run_processing
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.popcorn.LCS_DF import process_projection_LCS_DF
+
+GEOMETRY = {"pixel": 6.5e-6, "energy": 25000., "dist_object_detector": 1., "dist_source_object": 140.}
+
+
+def test_float64_run_corrects_and_solves_in_float64():
+    sample, reference, _ = make_speckle_stacks(shape=(32, 40), nb_of_point=4, dtype=np.float64)
+    rng = np.random.default_rng(1)
+    darkfield = rng.random((32, 40))
+    flatfield = darkfield + 100 + rng.random((32, 40))
+    raw_sample, raw_reference = (images * (flatfield - darkfield) + darkfield for images in (sample, reference))
+
+    experiment = ExperimentParameters("lcs_df", **GEOMETRY, nb_of_point=4, max_shift=2, LCS_median_filter=0, precision="float64")
+    result = run_processing(experiment, raw_sample, raw_reference, darkfield, flatfield)
+
+    assert experiment.sample_images.dtype == experiment.reference_images.dtype == np.float64
+    # Corrected without the float32 rounding (about 1e-7)
+    np.testing.assert_allclose(experiment.sample_images, sample, rtol=1e-12)
+    np.testing.assert_allclose(experiment.reference_images, reference, rtol=1e-12)
+    expected = process_projection_LCS_DF(experiment.copy())
+    for name in ("dx", "dy", "absorption", "DeltaDeff"):
+        np.testing.assert_array_equal(result[name], expected[name])
+
+
+@pytest.mark.parametrize("workers", [1, 3])
+def test_lcs_by_blocks_of_rows_matches_the_full_frame(monkeypatch, workers):
+    sample, reference, _ = make_speckle_stacks(shape=(40, 24), nb_of_point=4, dtype=np.float64)
+    experiment = ExperimentParameters("lcs", alpha=0., weak_absorption=False, workers=workers)
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+    full = lcs(reference, sample, alpha=0., weak_absorption=False)
+
+    # Blocks of 3 rows: every block needs the rows of its halo
+    monkeypatch.setattr(_dispatch, "LCS_BLOCK_PIXELS", 3 * 24)
+    result = process_lcs(experiment)
+
+    for index, name in enumerate(("abs", "dx", "dy")):
+        np.testing.assert_allclose(result[name], full[..., index], rtol=1e-10, atol=1e-12)
+
+
+def test_lcs_workers_do_not_change_the_result_cache_key():
+    experiments = [ExperimentParameters("lcs", alpha=0., weak_absorption=False, workers=workers) for workers in (None, 4)]
+    assert parameters_digest(experiments[0]) == parameters_digest(experiments[1])
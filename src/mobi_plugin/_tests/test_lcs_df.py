@@ -0,0 +1,62 @@
+import numpy as np
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.pipeline._stages import SolveCache
+from mobi_plugin.popcorn import LCS_DF, reference_cache
+from mobi_plugin.popcorn.LCS_DF import solve_LCS_DF
+from mobi_plugin.popcorn.reference_cache import REFERENCE_CACHE_VARIABLE, REFERENCE_PREPARATIONS, ReferencePreparationCache
+
+
+def _experiment(streaming):
+    sample, reference, _ = make_speckle_stacks(shape=(40, 48), nb_of_point=5, dtype=np.float64)
+    experiment = ExperimentParameters("lcs_df", nb_of_point=5, max_shift=2, LCS_streaming=streaming)
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+    return experiment
+
+
+def test_streaming_solve_matches_the_stacked_solve():
+    stacked = solve_LCS_DF(_experiment(False))
+    streaming = solve_LCS_DF(_experiment(True))
+
+    # The normal equations square the condition number: only the well-conditioned pixels agree,
+    # the streaming solve gives the fallback to the others sooner
+    well_conditioned = streaming[4] < 1e4
+    assert well_conditioned.mean() > 0.99
+    np.testing.assert_allclose(streaming[:4, well_conditioned], stacked[:4, well_conditioned], rtol=1e-6, atol=1e-9)
+    assert (stacked[4][well_conditioned] <= streaming[4][well_conditioned] * (1 + 1e-6)).all()
+    fallback = streaming[4] >= 1 / np.sqrt(np.finfo(float).eps)
+    np.testing.assert_array_equal(streaming[:4, fallback].T, np.broadcast_to([1, 0, 0, 0], (fallback.sum(), 4)))
+
+
+def test_solve_cache_key_depends_on_the_streaming():
+    cache = SolveCache()
+    assert cache.key(_experiment(False)) != cache.key(_experiment(True))
+
+
+def test_streaming_solve_reads_the_derivatives_from_the_reference_cache(tmp_path, monkeypatch):
+    expected = solve_LCS_DF(_experiment(True))
+    monkeypatch.setenv(REFERENCE_CACHE_VARIABLE, str(tmp_path))
+    REFERENCE_PREPARATIONS.clear()
+    try:
+        first = solve_LCS_DF(_experiment(True))
+        # The next projections only compute the terms of the sample
+        REFERENCE_PREPARATIONS.clear()
+        monkeypatch.setattr(LCS_DF, "gradient", None)
+        monkeypatch.setattr(LCS_DF, "laplacian", None)
+        second = solve_LCS_DF(_experiment(True))
+    finally:
+        REFERENCE_PREPARATIONS.clear()
+
+    saved = {path.name for path in tmp_path.glob("*/*.npy")}
+    assert {"derivative_y.npy", "derivative_x.npy", "laplacian.npy", "lcs_df_normal.npy"} <= saved
+    np.testing.assert_allclose(first, expected, rtol=1e-12, atol=1e-12)
+    np.testing.assert_array_equal(second, first)
+
+
+def test_preparation_key_depends_on_the_format(monkeypatch):
+    reference = np.zeros((2, 4, 4))
+    key = ReferencePreparationCache().prepare(reference).key
+    monkeypatch.setattr(reference_cache, "PREPARATION_FORMAT", "test")
+    assert ReferencePreparationCache().prepare(reference).key != key
@@ -0,0 +1,29 @@
+import numpy as np
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.popcorn.LCS_DirDF import myGradient, solveLCS_DDF
+
+
+def test_solve_matches_lstsq_of_each_pixel():
+    sample, reference, _ = make_speckle_stacks(shape=(24, 28), nb_of_point=7, dtype=np.float64)
+    experiment = ExperimentParameters("lcs_dirdf", nb_of_point=7, max_shift=2)
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+
+    solution = solveLCS_DDF(experiment)
+
+    # The system of the pixels, as it was stacked before the numba kernels
+    RHS = np.empty((7, 6) + reference.shape[1:])
+    for i in range(7):
+        gX, gY = myGradient(reference[i])
+        gXX, gYX = myGradient(gX)
+        gXY, gYY = myGradient(gY)
+        RHS[i] = [sample[i], gX, gY, -gXX, -gYY, -gXY]
+    expected = np.empty((6,) + reference.shape[1:])
+    for i, j in np.ndindex(reference.shape[1:]):
+        expected[:, i, j] = np.linalg.lstsq(RHS[:, :, i, j], reference[:, i, j], rcond=None)[0]
+
+    assert solution.shape == (7,) + reference.shape[1:]
+    assert (solution[6] < 1e4).all()
+    np.testing.assert_allclose(solution[:6], expected, rtol=0, atol=1e-9)
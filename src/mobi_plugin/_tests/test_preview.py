@@ -0,0 +1,19 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+
+pytest.importorskip("mbipy")
+
+from mobi_plugin.widgets._preview import viewport_bounds
+
+
+def test_viewport_bounds_are_the_layer_pixels_in_the_canvas():
+    # 100 x 200 screen pixels at zoom 2: 50 x 100 world units around the centre
+    viewer = SimpleNamespace(camera=SimpleNamespace(center=(0., 50., 60.), zoom=2.), _canvas_size=(100, 200))
+    layer = SimpleNamespace(scale=(1., 2., 2.), translate=(0., 10., 20.))
+
+    y0, y1, x0, x1 = viewport_bounds(viewer, layer)
+
+    # World (25, 10) to (75, 110), in pixels of the layer
+    np.testing.assert_allclose([y0, y1, x0, x1], [7.5, 32.5, -5., 45.])
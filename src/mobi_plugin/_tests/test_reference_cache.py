@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+
+from mobi_plugin.popcorn.batched_lstsq import solve_pixel_systems
+from mobi_plugin.popcorn.reference_cache import ReferenceSystemCache, solve_reference_systems
+
+
+def _systems(seed=0):
+    rng = np.random.default_rng(seed)
+    reference = rng.random((6, 5, 4))
+    RHS = rng.normal(size=(6, 3, 5, 4))
+    return reference, RHS
+
+
+def test_reference_systems_are_factorized_once():
+    reference, RHS = _systems()
+    cache = ReferenceSystemCache(max_bytes=10 * RHS.nbytes)
+    builds = []
+
+    def build_RHS():
+        builds.append(1)
+        return RHS
+
+    first_LHS, second_LHS = np.random.default_rng(1).normal(size=(2, 6, 5, 4))
+    first = solve_reference_systems("test", reference, (1.,), build_RHS, first_LHS, [1, 0, 0], cache=cache)
+    again = solve_reference_systems("test", reference, (1.,), build_RHS, first_LHS, [1, 0, 0], cache=cache)
+    second = solve_reference_systems("test", reference, (1.,), build_RHS, second_LHS, [1, 0, 0], cache=cache)
+
+    assert len(builds) == 1
+    np.testing.assert_array_equal(again[0], first[0])
+    np.testing.assert_array_equal(again[1], first[1])
+    np.testing.assert_allclose(first[0], solve_pixel_systems(RHS, first_LHS, [1, 0, 0])[0], atol=1e-12)
+    np.testing.assert_allclose(second[0], solve_pixel_systems(RHS, second_LHS, [1, 0, 0])[0], atol=1e-12)
+    # Other parameters: other systems
+    solve_reference_systems("test", reference, (2.,), build_RHS, first_LHS, [1, 0, 0], cache=cache)
+    assert len(builds) == 2
+
+
+def test_reference_systems_too_large_for_the_cache_are_solved_directly():
+    reference, RHS = _systems()
+    cache = ReferenceSystemCache(max_bytes=RHS.nbytes - 1)
+    LHS = np.random.default_rng(1).normal(size=(6, 5, 4))
+
+    with pytest.warns(RuntimeWarning, match="do not fit"):
+        solution, condition = solve_reference_systems("test", reference, (), lambda: RHS, LHS, [1, 0, 0], cache=cache)
+
+    assert cache.get(cache.key("test", reference, ())) is None
+    expected, expected_condition = solve_pixel_systems(RHS, LHS, [1, 0, 0])
+    np.testing.assert_array_equal(solution, expected)
+    np.testing.assert_array_equal(condition, expected_condition)
+
+
+def test_budget_from_the_environment(monkeypatch):
+    monkeypatch.setenv("MOBI_REFERENCE_SYSTEMS_BYTES", "1e6")
+    assert ReferenceSystemCache().budget == 10**6
@@ -1,7 +1,19 @@
-# from mobi_plugin import make_sample_data
+import numpy as np
 
-# add your tests here...
+from mobi_plugin._sample_data import make_sample_data, make_speckle_stacks
 
 
-def test_something():
-    pass
+def test_make_speckle_stacks_is_deterministic():
+    sample, reference, truth = make_speckle_stacks(shape=(32, 40), nb_of_point=3)
+    assert sample.shape == reference.shape == (3, 32, 40)
+    assert truth["dx"].shape == (32, 40)
+    assert np.abs(truth["dx"]).max() <= 1.5
+
+    sample_again, reference_again, _ = make_speckle_stacks(shape=(32, 40), nb_of_point=3)
+    np.testing.assert_array_equal(sample, sample_again)
+    np.testing.assert_array_equal(reference, reference_again)
+
+
+def test_make_sample_data():
+    layers = make_sample_data()
+    assert [meta["name"] for data, meta, layer_type in layers] == ["synthetic_reference", "synthetic_sample"]
@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.pipeline._shared import run_row_blocks, run_row_blocks_threaded, shutdown_pool
+from mobi_plugin.popcorn import ReverseFlow_LCS
+from mobi_plugin.popcorn.XSVT import start_tracking
+
+
+def _vertical_differences(inputs, outputs, row_start, row_stop):
+    # Needs the row after each of its rows, like the derivatives of the solvers
+    image = inputs["image"]
+    stop = min(row_stop + 1, image.shape[0])
+    outputs["difference"][row_start:row_stop] = np.diff(image[row_start:stop], axis=0, append=image[-1:])[:row_stop - row_start]
+
+
+def test_run_row_blocks_on_processes_matches_one_process():
+    image = np.random.default_rng(0).random((40, 7))
+    outputs = {"difference": (image.shape, image.dtype)}
+
+    expected = run_row_blocks(_vertical_differences, {"image": image}, outputs, 40, 3, workers=1)
+    try:
+        result = run_row_blocks(_vertical_differences, {"image": image}, outputs, 40, 3, workers=2)
+    finally:
+        shutdown_pool()
+
+    np.testing.assert_array_equal(result["difference"], expected["difference"])
+    np.testing.assert_array_equal(expected["difference"][:-1], np.diff(image, axis=0))
+
+
+def test_run_row_blocks_threaded_covers_every_row():
+    image = np.random.default_rng(0).random((40, 7))
+    result = np.zeros_like(image)
+
+    def double(row_start, row_stop):
+        result[row_start:row_stop] = 2 * image[row_start:row_stop]
+
+    run_row_blocks_threaded(double, 40, 3, workers=3)
+
+    np.testing.assert_array_equal(result, 2 * image)
+
+
+def test_reverse_flow_lcs_on_processes_matches_one_process():
+    # More than 3 blocks of BLOCK_PIXELS, so that the 3 processes each get some
+    sample, reference, _ = make_speckle_stacks(shape=(520, 256), nb_of_point=4)
+    experiment = ExperimentParameters("reversflowlcs", nb_of_point=4, max_shift=2)
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+
+    expected = ReverseFlow_LCS.LCS(experiment, workers=1)
+    try:
+        result = ReverseFlow_LCS.LCS(experiment, workers=3)
+    finally:
+        shutdown_pool()
+
+    for image, expected_image in zip(result, expected):
+        np.testing.assert_array_equal(image, expected_image)
+
+
+@pytest.mark.parametrize("search", ["guided", "pyramid"])
+def test_narrowed_search_on_processes_matches_one_process(search):
+    sample, reference, _ = make_speckle_stacks(shape=(160, 144), nb_of_point=8, max_displacement=6.)
+
+    expected = start_tracking(sample, reference, 12, 5, workers=1, search=search)
+    try:
+        result = start_tracking(sample, reference, 12, 5, workers=2, search=search)
+    finally:
+        shutdown_pool()
+
+    for image, expected_image in zip(result, expected):
+        np.testing.assert_array_equal(image, expected_image)
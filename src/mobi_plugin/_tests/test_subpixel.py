@@ -0,0 +1,20 @@
+import numpy as np
+
+from mobi_plugin.popcorn.speckle_matching import quad_fit
+from mobi_plugin.popcorn.subpixel import paraboloid_peaks
+
+
+def test_paraboloid_peaks_match_the_fit_of_each_neighbourhood():
+    rng = np.random.default_rng(0)
+    i, j = np.indices((3, 3)) - 1
+    # Paraboloids with a maximum at a known position, then noisy neighbourhoods
+    peaks = rng.uniform(-0.5, 0.5, size=(2, 2))
+    neighbourhoods = np.stack([1 - (i - y)**2 - 0.5 * (j - x)**2 - 0.2 * (i - y) * (j - x) for y, x in peaks])
+    neighbourhoods = np.concatenate([neighbourhoods, rng.random((3, 3, 3))])
+
+    offsets, is_maximum = paraboloid_peaks(neighbourhoods)
+
+    np.testing.assert_allclose(offsets[:2], peaks, atol=1e-12)
+    assert is_maximum[:2].all()
+    for neighbourhood, offset in zip(neighbourhoods, offsets):
+        np.testing.assert_allclose(offset, quad_fit(neighbourhood)[1] - 1, atol=1e-9)
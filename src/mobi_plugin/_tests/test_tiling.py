@@ -0,0 +1,56 @@
+import math
+
+import numpy as np
+import pytest
+
+from mobi_plugin._sample_data import make_speckle_stacks
+from mobi_plugin.pipeline._experiment import ExperimentParameters
+from mobi_plugin.pipeline._shared import shutdown_pool
+from mobi_plugin.pipeline._stages import STAGED_METHODS
+from mobi_plugin.pipeline._tiling import STREAMING_LCS_DF_VALUES, TILED_METHODS, auto_tile_size, solve_tiled
+
+GEOMETRY = {"pixel": 6.5e-6, "energy": 25000., "dist_object_detector": 1., "dist_source_object": 140.}
+PARAMETERS = {
+    'lcs_df': {"nb_of_point": 4, "max_shift": 2},
+    'lcs_dirdf': {"nb_of_point": 6, "max_shift": 2},
+    'mistii1': {"nb_of_point": 4, "beta": 1e-9, "delta": 1e-7, "sigma_regularization": 0.},
+    'mistii2': {"nb_of_point": 4, "beta": 1e-9, "delta": 1e-7, "sigma_regularization": 0.},
+    'xsvt': {"max_shift": 2, "XSVT_Nw": 2},
+}
+
+
+@pytest.mark.parametrize("method", sorted(TILED_METHODS))
+def test_tiled_solve_matches_the_full_frame(method):
+    experiment = ExperimentParameters(method, **GEOMETRY, **PARAMETERS[method])
+    sample, reference, _ = make_speckle_stacks(shape=(48, 56), nb_of_point=getattr(experiment, "nb_of_point", 4))
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+    solve = STAGED_METHODS[method][0]
+
+    try:
+        full = np.asarray(solve(experiment))
+        # Tiles smaller than the frame along both axes, the last ones truncated
+        tiled = solve_tiled(solve, experiment, tile_size=20)
+    finally:
+        shutdown_pool()
+
+    assert tiled.shape == full.shape
+    # Up to rounding errors (XSVT), relative to each output, NaN where the full frame is NaN
+    scale = np.nanmax(np.abs(full), axis=(1, 2), keepdims=True)
+    np.testing.assert_allclose(tiled / scale, full / scale, rtol=0, atol=1e-6)
+
+
+def test_streaming_lcs_df_tiles_are_sized_from_its_normal_equations():
+    experiment = ExperimentParameters('lcs_df', **GEOMETRY, **PARAMETERS['lcs_df'])
+    shape = (40, 2048, 2048)
+    # Twice the memory of the streaming normal equations of a 1000 x 1000 tile with its halo
+    memory_limit = 2 * 8 * STREAMING_LCS_DF_VALUES * 1002**2
+
+    stacked = auto_tile_size(experiment, shape, memory_limit)
+    experiment.LCS_streaming = True
+    streaming = auto_tile_size(experiment, shape, memory_limit)
+
+    assert stacked < streaming
+    assert streaming == int(math.sqrt(2) * 1002) - 2
+    # The number of points does not change the streaming tiles
+    assert auto_tile_size(experiment, (400, 2048, 2048), memory_limit) == streaming
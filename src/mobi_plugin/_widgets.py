@@ -3,11 +3,20 @@ from qtpy.QtWidgets import (
     QWidget,
     QVBoxLayout,
     QLabel,
+    QPushButton,
     QSpacerItem,
     QSizePolicy,
 )
 from .widgets._utils import LayerUtils, Experiment
 from .widgets._section import *
+from .widgets._timings import (
+    create_timings_table,
+    fill_timings_table,
+    last_timings,
+    save_timings,
+    subscribe_timings,
+    unsubscribe_timings,
+)
 
 if TYPE_CHECKING:
     import napari
@@ -370,4 +379,39 @@ class SpecklematchingWidget(QWidget):
         LayerUtils.update_layer_selections(self)
         self.layout().addSpacerItem(
             QSpacerItem(20, 40, QSizePolicy.Minimum, QSizePolicy.Expanding)
-        )
\ No newline at end of file
+        )
+
+class TimingsWidget(QWidget):
+    """
+    Table of the time and memory of each stage of the last processing run.
+    """
+
+    def __init__(self, viewer: "napari.viewer.Viewer"):
+        super().__init__()
+        self.viewer = viewer
+
+        self.setup_ui()
+        subscribe_timings(self.update_timings)
+        self.destroyed.connect(lambda: unsubscribe_timings(self.update_timings))
+
+    def setup_ui(self):
+        """
+        Set up the user interface components.
+        """
+        self.setLayout(QVBoxLayout())
+        self.method_label = QLabel("Stage timings")
+        self.layout().addWidget(self.method_label)
+
+        self.table = create_timings_table()
+        self.layout().addWidget(self.table)
+
+        btn_save = QPushButton("Save as JSON")
+        btn_save.clicked.connect(lambda: save_timings(self))
+        self.layout().addWidget(btn_save)
+
+        self.update_timings(last_timings["stages"], last_timings["method"])
+
+    def update_timings(self, stages, method):
+        if method is not None:
+            self.method_label.setText(f"Stage timings: {method}")
+        fill_timings_table(self.table, stages)
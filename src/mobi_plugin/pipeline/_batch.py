@@ -0,0 +1,98 @@
+import multiprocessing as mp
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from ._dispatch import run_processing
+from ._progress import progress
+from ._timing import TIMINGS_KEY, merge_timings
+
+# State shared by all the projections handled by one worker process.
+# It is sent once, when the worker starts, instead of once per projection.
+_worker_state = {}
+
+# Longest time between two checks of a cancel request, in seconds
+CANCEL_POLL_SECONDS = 0.2
+
+
+def _init_worker(parameters, reference, darkfield, flatfield, cache):
+    _worker_state['parameters'] = parameters
+    _worker_state['reference'] = reference
+    _worker_state['darkfield'] = darkfield
+    _worker_state['flatfield'] = flatfield
+    _worker_state['cache'] = cache
+
+
+def _process_projection(index, sample):
+    experiment = _worker_state['parameters'].copy()
+    result = run_processing(experiment, sample, _worker_state['reference'], _worker_state['darkfield'], _worker_state['flatfield'], _worker_state['cache'])
+    return index, result
+
+
+def process_batch(experiment, samples, reference, darkfield=None, flatfield=None, workers=None, cache=None):
+    """
+    Process every projection of a tomographic scan with the method of the experiment.
+
+    All projections share the same reference (and dark/flat) images, which are
+    sent once to each worker of a process pool; the projections are then
+    fanned out over the pool.
+
+    Args:
+        experiment (ExperimentParameters): parameters of the method.
+        samples (NUMPY ARRAY): sample images (angle x membrane position x y x x).
+        reference (NUMPY ARRAY): reference images (membrane position x y x x).
+        darkfield, flatfield (NUMPY ARRAY): optional correction images.
+        workers (int): number of processes, all the cores by default.
+        cache (ResultCache): optional cache of the per-projection results.
+
+    Returns:
+        dict: each resulting image stacked along a first angle axis, and
+        the timings of the stages summed over the projections.
+    """
+    nb_of_angles = len(samples)
+    workers = workers or os.cpu_count()
+    parameters = experiment.copy()
+    parameters.sample_images = None
+    parameters.reference_images = None
+    if hasattr(parameters, 'nb_of_point'):
+        parameters.nb_of_point = np.shape(samples)[1]
+
+    print(f"Batch processing of {nb_of_angles} projections on {workers} processes")
+    results = {}
+    timings = {}
+    # spawn rather than fork: the caller may be a thread of the napari process.
+    # Not a with block, whose exit would wait for the projections in flight on cancel
+    executor = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"), initializer=_init_worker, initargs=(parameters, reference, darkfield, flatfield, cache))
+    # Only a few projections are in flight at a time, so that a scan read
+    # lazily (h5py, dask) is never fully loaded in memory
+    pending = set()
+    next_index = 0
+    done = 0
+    try:
+        while done < nb_of_angles:
+            while next_index < nb_of_angles and len(pending) < 2 * workers:
+                pending.add(executor.submit(_process_projection, next_index, np.asarray(samples[next_index])))
+                next_index += 1
+            # Woken up regularly to see a cancel request during long projections
+            finished, pending = wait(pending, timeout=CANCEL_POLL_SECONDS, return_when=FIRST_COMPLETED)
+            for future in finished:
+                index, result = future.result()
+                timings = merge_timings(timings, result.pop(TIMINGS_KEY, {}))
+                for name, image in result.items():
+                    if name not in results:
+                        results[name] = np.empty((nb_of_angles,) + np.shape(image), dtype=np.asarray(image).dtype)
+                    results[name][index] = image
+                done += 1
+            progress("Batch processing", done / nb_of_angles)
+    except BaseException:
+        # Cancelled or failed: the projections in flight are stopped, not waited for
+        processes = list((executor._processes or {}).values())
+        executor.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()
+        raise
+    executor.shutdown()
+
+    results[TIMINGS_KEY] = timings
+    return results
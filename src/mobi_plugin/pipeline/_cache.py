@@ -0,0 +1,126 @@
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+# Attributes of the experiment holding the images (or their layer names):
+# the images enter the key through their content, not through these attributes.
+IMAGE_ATTRIBUTES = ("settings", "sample_images", "reference_images", "darkfield", "flatfield")
+# Attributes of the experiment which do not change the results
+EXECUTION_ATTRIBUTES = ("workers",)
+
+
+def default_cache_directory():
+    """
+    Folder of the result cache, in the user cache directory.
+    """
+    root = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(root, "mobi_plugin", "results")
+
+def array_digest(array, hasher=None):
+    """
+    Hash the shape, type and content of an array, one frame at a time so that
+    no contiguous copy of the whole array is needed.
+    """
+    hasher = hasher or hashlib.blake2b(digest_size=16)
+    array = np.asarray(array)
+    hasher.update(repr((array.shape, array.dtype.str)).encode())
+    for frame in (array if array.ndim > 2 else [array]):
+        hasher.update(np.ascontiguousarray(frame).data)
+    return hasher.hexdigest()
+
+def parameters_digest(experiment, hasher=None):
+    """
+    Hash the parameters of the experiment, images excluded.
+    """
+    hasher = hasher or hashlib.blake2b(digest_size=16)
+    parameters = {name: value for name, value in vars(experiment).items() if name not in IMAGE_ATTRIBUTES + EXECUTION_ATTRIBUTES}
+    hasher.update(json.dumps(parameters, sort_keys=True, default=repr).encode())
+    return hasher.hexdigest()
+
+
+class ResultCache:
+    """
+    On-disk cache of the result dictionaries returned by the methods, keyed by
+    the content of the corrected images and the parameters of the experiment.
+    Each entry is an npz file; the least recently used entries are removed
+    once the cache is larger than max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=2 * 1024**3):
+        self.directory = directory or default_cache_directory()
+        self.max_bytes = max_bytes
+
+    def key(self, experiment, sample, reference):
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(experiment.method.encode())
+        parameters_digest(experiment, hasher)
+        array_digest(sample, hasher)
+        array_digest(reference, hasher)
+        return hasher.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, f"{key}.npz")
+
+    def get(self, key):
+        """
+        Return the cached result dictionary, or None if it is not in the cache.
+        """
+        path = self._path(key)
+        try:
+            with np.load(path, allow_pickle=False) as data:
+                result = {name: data[name] for name in data.files}
+            # The modification time is the last use, for the LRU eviction
+            os.utime(path)
+        except (FileNotFoundError, OSError, ValueError):
+            return None
+        print(f"Result found in cache: {path}")
+        return result
+
+    def put(self, key, result):
+        """
+        Store the arrays of a result dictionary and evict old entries if needed.
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        arrays = {name: value for name, value in result.items() if isinstance(value, np.ndarray)}
+        # Written under a temporary name first: concurrent readers never see a partial file
+        fd, tmp_path = tempfile.mkstemp(suffix=".tmp", dir=self.directory)
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **arrays)
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        self.evict()
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the cache fits in max_bytes.
+        """
+        entries = []
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npz"):
+                try:
+                    stat = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+    def clear(self):
+        if os.path.isdir(self.directory):
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npz"):
+                    os.remove(entry.path)
@@ -0,0 +1,84 @@
+import numpy as np
+
+from ._progress import progress
+
+# Type of the corrected images given to the methods
+WORKING_DTYPE = np.float32
+
+
+def average_frames(frames, dtype=WORKING_DTYPE):
+    """
+    Mean of a stack of frames, accumulated one frame at a time so that a
+    stack read lazily (h5py, dask) is never loaded at once.
+    """
+    frames_shape = np.shape(frames)
+    if len(frames_shape) == 2:
+        return np.asarray(frames, dtype=dtype)
+    total = np.zeros(frames_shape[-2:], dtype=np.float64)
+    for frame in frames:
+        total += frame
+    return (total / frames_shape[0]).astype(dtype)
+
+def prepare_correction(darkfield, flatfield, nb_of_point, dtype=WORKING_DTYPE, average=None):
+    """
+    Darkfield and reciprocal of (flatfield - darkfield), in the working type.
+
+    Stacks of darks/flats are averaged when average is True, or by default
+    when their number of frames does not match the nb_of_point images to
+    correct (otherwise each image is corrected by its own frame).
+
+    Returns:
+        dark (NUMPY ARRAY): darkfield, or None.
+        inverse_flat (NUMPY ARRAY): 1/(flatfield - darkfield), 0 where the
+        flatfield does not exceed the darkfield, or None.
+    """
+    def load(frames):
+        if frames is None:
+            return None
+        frames_shape = np.shape(frames)
+        if len(frames_shape) == 3 and (average or (average is None and frames_shape[0] != nb_of_point)):
+            return average_frames(frames, dtype)
+        return np.asarray(frames, dtype=dtype)
+
+    dark = load(darkfield)
+    flat = load(flatfield)
+    if flat is None:
+        return dark, None
+
+    if dark is not None:
+        flat = flat - dark
+    inverse_flat = np.zeros_like(flat)
+    np.divide(1, flat, out=inverse_flat, where=flat > 0)
+    return dark, inverse_flat
+
+def correct_images(images, dark=None, inverse_flat=None, dtype=WORKING_DTYPE, chunk_frames=4):
+    """
+    Return (images - dark) * inverse_flat in the working type. The images are
+    converted with a single copy (the input is never modified), then corrected
+    in place, a few frames at a time.
+    """
+    corrected = np.array(images, dtype=dtype)
+    if dark is None and inverse_flat is None:
+        return corrected
+    nb_of_frames = corrected.shape[0] if corrected.ndim == 3 else 1
+    frames = corrected if corrected.ndim == 3 else corrected[np.newaxis]
+    for start in range(0, nb_of_frames, chunk_frames):
+        stop = min(start + chunk_frames, nb_of_frames)
+        block = frames[start:stop]
+        if dark is not None:
+            np.subtract(block, dark[start:stop] if dark.ndim == 3 else dark, out=block)
+        if inverse_flat is not None:
+            np.multiply(block, inverse_flat[start:stop] if inverse_flat.ndim == 3 else inverse_flat, out=block)
+    return corrected
+
+def apply_corrections(sample, reference, darkfield=None, flatfield=None, dtype=WORKING_DTYPE, average=None):
+    """
+    Apply darkfield and flatfield corrections to the sample and reference
+    images: (image - darkfield) / (flatfield - darkfield), computed in dtype.
+    """
+    print("Applying corrections")
+    dark, inverse_flat = prepare_correction(darkfield, flatfield, np.shape(sample)[0], dtype, average)
+    sample = correct_images(sample, dark, inverse_flat, dtype)
+    progress("Applying corrections", 0.5)
+    reference = correct_images(reference, dark, inverse_flat, dtype)
+    return sample, reference
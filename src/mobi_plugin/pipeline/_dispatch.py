@@ -0,0 +1,157 @@
+import threading
+
+import numpy as np
+
+from mbipy.numpy.phase_retrieval import lcs
+from mbipy.src.normal_integration.fourier import kottler, frankot
+
+from ..popcorn.LCS_DirDF import processProjectionLCS_DDF
+from ..popcorn.LCS_DF import process_projection_LCS_DF
+from ..popcorn.MISTI import MISTI
+from ..popcorn.MISTII_1 import processProjectionMISTII_1
+from ..popcorn.MISTII_2 import processProjectionMISTII_2
+from ..popcorn.Pavlov2020 import tie_Pavlovetal2020
+from ..popcorn.XSVT import processProjectionXSVT
+from ..popcorn.ReverseFlow_LCS import processProjection_rLCS
+from ..popcorn.speckle_matching import processProjectionUMPA
+
+from ._corrections import apply_corrections
+from ._progress import progress
+from ._shared import run_row_blocks_threaded
+from ._stages import STAGED_METHODS, run_staged
+from ._timing import TIMINGS_KEY, StageTimings, timed_stage
+
+
+# Pixels given to the mbipy LCS at once, and the rows added around a block
+# for the derivatives of the reference images, so that a block is solved
+# exactly as on the full frame
+LCS_BLOCK_PIXELS = 65536
+LCS_HALO = 2
+
+
+def process_lcs(experiment, workers=None):
+    """
+    Run the mbipy LCS on the sample and reference images of the experiment,
+    by blocks of rows on `workers` threads (experiment.workers, all the cores
+    by default): its numpy linear algebra releases the GIL, and the memory it
+    allocates is the one of the blocks being solved. The blocks are written
+    into one (3, Ny, Nx) array, whose images are the results.
+    """
+    workers = workers or getattr(experiment, "workers", None)
+    reference, sample = experiment.reference_images, experiment.sample_images
+    Ny, Nx = reference.shape[-2:]
+    output = []
+    lock = threading.Lock()
+
+    def solve_rows(row_start, row_stop):
+        top, bottom = max(0, row_start - LCS_HALO), min(Ny, row_stop + LCS_HALO)
+        block = lcs(reference[..., top:bottom, :], sample[..., top:bottom, :], alpha=experiment.alpha, weak_absorption=experiment.weak_absorption)
+        with lock:
+            # In the type of the results of mbipy
+            if not output:
+                output.append(np.empty((3, Ny, Nx), dtype=block.dtype))
+        output[0][:, row_start:row_stop] = np.moveaxis(block[row_start - top:row_stop - top], -1, 0)
+
+    run_row_blocks_threaded(solve_rows, Ny, max(1, LCS_BLOCK_PIXELS // Nx), workers, "Solving LCS system")
+    result = output[0]
+    return {'abs': result[0], 'dx': result[1], 'dy': result[2]}
+
+
+METHODS = {
+    'lcs': process_lcs,
+    'lcs_df': process_projection_LCS_DF,
+    'lcs_dirdf': processProjectionLCS_DDF,
+    'misti': MISTI,
+    'mistii1': processProjectionMISTII_1,
+    'mistii2': processProjectionMISTII_2,
+    'pavlov2020': tie_Pavlovetal2020,
+    'xsvt': processProjectionXSVT,
+    'reversflowlcs': processProjection_rLCS,
+    'specklematching': processProjectionUMPA,
+}
+
+
+def apply_phase(result, phase_parameters):
+    """
+    Apply phase calculation based on the provided phase parameters.
+    """
+    if phase_parameters['method'] == 'Kottler':
+        return kottler(result['dy'], result['dx'], pad=phase_parameters['pad'])
+    elif phase_parameters['method'] == 'Frankot_Chellappa':
+        return frankot(result['dy'], result['dx'], pad=phase_parameters['pad'])
+    else:
+        raise ValueError(f"Unknown phase retrieval method: {phase_parameters['method']}")
+
+
+def run_method(experiment, solve_cache=None, tile_size=None):
+    """
+    Run the retrieval method selected in the experiment on its sample and
+    reference images and return the dictionary of resulting images.
+    Methods with separate solve and post-processing stages reuse the solve
+    output kept in solve_cache when only post-processing parameters changed,
+    and solve tile by tile (see run_staged) when the frame is too large.
+    """
+    print(f"Processing with method: {experiment.method}")
+    try:
+        method = METHODS[experiment.method]
+    except KeyError:
+        raise ValueError(f"Unknown method: {experiment.method}") from None
+    if experiment.method in STAGED_METHODS:
+        return run_staged(experiment, solve_cache, tile_size)
+    with timed_stage("solve"):
+        return method(experiment)
+
+
+def run_processing(experiment, sample, reference, darkfield=None, flatfield=None, cache=None, solve_cache=None, tile_size=None, timings=None):
+    """
+    Full processing chain without any Qt dependency: corrections, retrieval
+    and, if phase parameters are set, phase integration (stored under 'phase').
+    The experiment is modified in place to hold the corrected images.
+    If a ResultCache is given, a result computed earlier from the same
+    corrected images and parameters is returned without processing.
+    A SolveCache keeps the solve stage of the last runs in memory.
+    The time and memory of each stage are recorded in timings (a new
+    StageTimings by default) and returned under result['timings'].
+    """
+    if timings is None:
+        timings = StageTimings()
+    with timings.activate():
+        result = _run_stages(experiment, sample, reference, darkfield, flatfield, cache, solve_cache, tile_size)
+    result[TIMINGS_KEY] = timings.as_dict()
+    return result
+
+def _run_stages(experiment, sample, reference, darkfield, flatfield, cache, solve_cache, tile_size):
+    progress("Applying corrections")
+    with timed_stage("correct"):
+        # In the precision of the solvers, float32 images would truncate a float64 run
+        sample, reference = apply_corrections(sample, reference, darkfield, flatfield, dtype=experiment.get_dtype())
+    experiment.sample_images = sample
+    experiment.reference_images = reference
+
+    if cache is not None:
+        progress("Looking for the result in the cache")
+        with timed_stage("cache lookup"):
+            key = cache.key(experiment, sample, reference)
+            result = cache.get(key)
+        if result is not None:
+            return result
+
+    progress(f"Processing with method: {experiment.method}", 0.0)
+    result = run_method(experiment, solve_cache, tile_size)
+
+    if experiment.phase_parameters:
+        progress("Phase integration")
+        try:
+            with timed_stage("integrate"):
+                result['phase'] = apply_phase(result, experiment.phase_parameters)
+        except Exception as e:
+            # The retrieved images are still worth returning without the phase
+            print(f"Error during phase calculation: {e}")
+            import traceback
+            traceback.print_exc()
+
+    if cache is not None:
+        with timed_stage("cache store"):
+            cache.put(key, result)
+
+    return result
@@ -0,0 +1,161 @@
+import numpy as np
+from numpy import pi
+
+# Floating types the systems can be solved in, the first is the default
+PRECISIONS = ("float64", "float32")
+
+# Searches of the XSVT correlation peaks, the first is the default:
+# - full: all the shifts up to max_shift, for every pixel;
+# - guided: all the shifts for a grid of seed pixels only, then a few shifts
+#   around the displacement interpolated from the seeds;
+# - pyramid: all the shifts of images downsampled until max_shift is small,
+#   then a few shifts at each finer level around the upsampled displacement
+XSVT_SEARCHES = ("full", "guided", "pyramid")
+
+# Methods solving a linear system per pixel, which can output the condition number of the systems
+CONDITION_METHODS = ("lcs_df", "lcs_dirdf", "misti", "mistii1", "mistii2", "reversflowlcs")
+
+
+class ExperimentParameters:
+    """
+    Parameters of a retrieval method, without any Qt dependency, so that
+    they can be sent to worker processes or built from a configuration file.
+    """
+    def __init__(self, method, **parameters):
+        self.method = method
+
+        self.sample_images = None
+        self.reference_images = None
+        self.darkfield = None
+        self.flatfield = None
+
+        self._initialize_method_parameters()
+
+        for name, value in parameters.items():
+            setattr(self, name, value)
+
+    def _initialize_method_parameters(self):
+
+        if self.method == "lcs":
+            self.alpha = None
+            self.weak_absorption = False 
+            # Threads solving the blocks of rows, all the cores by default
+            self.workers = None
+
+        elif self.method == "lcs_df":
+            self.nb_of_point = None
+            self.max_shift = None
+            self.pixel = None
+            self.energy = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.LCS_median_filter = None
+            self.LCS_streaming = False
+
+        elif self.method == "lcs_dirdf":
+            self.nb_of_point = None
+            self.max_shift = None
+            self.pixel = None
+            self.energy = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.LCS_median_filter = None
+
+        elif self.method == "misti":
+            self.pixel = None
+            self.dist_object_detector = None
+            self.beta = None
+            self.delta = None
+            self.energy = None
+            self.MIST_median_filter = None
+            self.sigma_regularization = None
+
+        elif self.method == "mistii1":
+            self.nb_of_point = None
+            self.pixel = None
+            self.dist_object_detector = None
+            self.beta = None
+            self.delta = None
+            self.energy = None
+            self.MIST_median_filter = None
+            self.sigma_regularization = None
+
+        elif self.method == "mistii2":
+            self.nb_of_point = None
+            self.pixel = None
+            self.dist_object_detector = None
+            self.beta = None
+            self.delta = None
+            self.energy = None
+            self.MIST_median_filter = None
+            self.sigma_regularization = None
+
+        elif self.method == "pavlov2020":
+            self.pixel = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.beta = None
+            self.delta = None
+            self.energy = None
+            self.sigma_regularization = None
+            self.source_size = None
+
+        elif self.method == "xsvt":
+            self.max_shift = None
+            self.pixel = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.energy = None
+            self.XSVT_median_filter = None
+            self.XSVT_Nw = None
+            self.XSVT_search = XSVT_SEARCHES[0]
+
+        elif self.method == "reversflowlcs":
+            self.nb_of_point = None
+            self.max_shift = None
+            self.pixel = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.energy = None
+
+        elif self.method == "specklematching":
+            self.max_shift = None
+            self.pixel = None
+            self.dist_object_detector = None
+            self.dist_source_object = None
+            self.UMPA_Nw = None
+            self.energy = None
+            
+        self.phase_parameters = None
+        # Type of the systems solved and of the results, float32 halves their memory
+        self.precision = PRECISIONS[0]
+        if self.method in CONDITION_METHODS:
+            # Adds the log10 of the condition number of each pixel's system to the results
+            self.condition_map = False
+
+    def getk(self):
+        """
+        Energy in eV
+        """
+        h=6.626e-34
+        c=2.998e8
+        e=1.6e-19
+        k=2*pi*self.energy*e/(h*c)
+        return k
+
+    def get_dtype(self):
+        """
+        Floating type of the systems and of the results (see precision)
+        """
+        precision = getattr(self, "precision", None) or PRECISIONS[0]
+        if precision not in PRECISIONS:
+            raise ValueError(f"Unknown precision {precision!r}, expected one of {PRECISIONS}")
+        return np.dtype(precision)
+
+    def copy(self):
+        """
+        Return a plain ExperimentParameters holding the same values.
+        """
+        parameters = ExperimentParameters(self.method)
+        parameters.__dict__.update({name: value for name, value in vars(self).items() if name != "settings"})
+        return parameters
@@ -0,0 +1,56 @@
+import numpy as np
+
+
+def crop_images(images, bounds):
+    """
+    Crop the last two axes of a stack of images to bounds = (y0, y1, x0, x1).
+    """
+    if images is None:
+        return None
+    y0, y1, x0, x1 = bounds
+    return np.asarray(images[..., y0:y1, x0:x1])
+
+def bin_images(images, factor):
+    """
+    Average blocks of factor x factor pixels on the last two axes of a stack
+    of images; the last rows and columns are dropped if they do not fill a block.
+    """
+    if images is None:
+        return None
+    images = np.asarray(images)
+    ny, nx = images.shape[-2] // factor, images.shape[-1] // factor
+    images = images[..., :ny * factor, :nx * factor]
+    return images.reshape(images.shape[:-2] + (ny, factor, nx, factor)).mean(axis=(-3, -1))
+
+def binned_experiment(experiment, factor):
+    """
+    Copy of the experiment with the parameters given in pixels converted to
+    the binned pixels, so that the preview covers the same physical shifts.
+    Window sizes are kept: they have to stay large enough to hold speckles.
+    """
+    experiment = experiment.copy()
+    if getattr(experiment, "pixel", None) is not None:
+        experiment.pixel = experiment.pixel * factor
+    max_shift = getattr(experiment, "max_shift", None)
+    if max_shift is not None:
+        if isinstance(max_shift, int):
+            experiment.max_shift = max(1, max_shift // factor)
+        else:
+            experiment.max_shift = max_shift / factor
+    return experiment
+
+def clip_bounds(bounds, shape, min_size=8):
+    """
+    Clip bounds = (y0, y1, x0, x1) to an image of the given (ny, nx) shape,
+    enlarging them to min_size pixels if needed.
+    """
+    y0, y1, x0, x1 = (int(round(value)) for value in bounds)
+    clipped = []
+    for start, stop, size in ((y0, y1, shape[0]), (x0, x1, shape[1])):
+        start, stop = max(0, min(start, size)), max(0, min(stop, size))
+        if stop - start < min_size:
+            centre = (start + stop) // 2
+            start = max(0, min(centre - min_size // 2, size - min_size))
+            stop = min(size, start + min_size)
+        clipped += [start, stop]
+    return tuple(clipped)
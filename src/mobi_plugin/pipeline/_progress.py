@@ -0,0 +1,68 @@
+import threading
+from contextlib import contextmanager
+
+
+class ProcessingCancelled(Exception):
+    """
+    Raised inside a processing run once the user has asked to stop it.
+    """
+
+
+_local = threading.local()
+
+
+class ProcessingMonitor:
+    """
+    Progress reports and cancel request of one processing run.
+
+    The numerical code never talks to Qt: it calls ``progress()``, which
+    forwards the report to the monitor active in the current thread and
+    raises ProcessingCancelled if the run has been cancelled.
+    """
+
+    def __init__(self, callback=None):
+        self.callback = callback
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def report(self, stage, fraction=None):
+        if self.cancelled:
+            raise ProcessingCancelled(f"Processing cancelled during: {stage}")
+        if self.callback is not None:
+            self.callback(stage, fraction)
+
+    @contextmanager
+    def activate(self):
+        """
+        Make this monitor the one seen by ``progress()`` in the current thread.
+        """
+        previous = getattr(_local, "monitor", None)
+        _local.monitor = self
+        try:
+            yield self
+        finally:
+            _local.monitor = previous
+
+
+def current_monitor():
+    """
+    Monitor active in the current thread, to be activated again in the
+    threads a run is split into.
+    """
+    return getattr(_local, "monitor", None)
+
+
+def progress(stage, fraction=None):
+    """
+    Report the current stage (and the fraction done, between 0 and 1) to the
+    active monitor, if any. This is also the cancellation point of the loops.
+    """
+    monitor = current_monitor()
+    if monitor is not None:
+        monitor.report(stage, fraction)
@@ -0,0 +1,203 @@
+import atexit
+import math
+import multiprocessing as mp
+import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from ._progress import progress
+
+# Row-tiled execution of a per-pixel solve on a pool of processes.
+#
+# The input images and the output images are placed once in shared memory;
+# a task only carries the names of the blocks and its rows, and the workers
+# write their rows straight into the outputs. The pool is kept between runs,
+# so that its processes are only started (spawned) once.
+#
+# Solves spending their time in code releasing the GIL (numpy linear algebra)
+# run their blocks on threads instead (run_row_blocks_threaded).
+
+
+class SharedArray:
+    """
+    NumPy array in a shared memory block, created by the main process and
+    attached by name (see descriptor) in the workers, without copy.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        size = max(1, math.prod(self.shape) * self.dtype.itemsize)
+        self.owner = name is None
+        self.memory = shared_memory.SharedMemory(name=name, create=self.owner, size=size if self.owner else 0)
+        self.array = np.ndarray(self.shape, dtype=self.dtype, buffer=self.memory.buf)
+
+    @classmethod
+    def from_array(cls, array):
+        array = np.asarray(array)
+        shared = cls(array.shape, array.dtype)
+        shared.array[...] = array
+        return shared
+
+    @classmethod
+    def attach(cls, descriptor):
+        name, shape, dtype = descriptor
+        return cls(shape, dtype, name=name)
+
+    @property
+    def descriptor(self):
+        return self.memory.name, self.shape, self.dtype.str
+
+    def close(self):
+        # The array must not be used once its buffer is released
+        self.array = None
+        try:
+            self.memory.close()
+        except BufferError:
+            # Views are still alive (e.g. in the traceback of an error): the
+            # mapping is released with them, the block is unlinked all the same
+            pass
+        if self.owner:
+            self.memory.unlink()
+
+
+def _run_block(function, descriptors, input_names, row_start, row_stop):
+    # Attached for the task only, so that a worker never keeps the images of a finished run
+    shared = {name: SharedArray.attach(descriptor) for name, descriptor in descriptors.items()}
+    try:
+        function({name: shared[name].array for name in input_names},
+                 {name: array.array for name, array in shared.items() if name not in input_names},
+                 row_start, row_stop)
+    finally:
+        for array in shared.values():
+            array.close()
+    return row_stop - row_start
+
+
+_pool = {"executor": None, "workers": None}
+
+
+def get_pool(workers):
+    """
+    Process pool of `workers` processes, kept for the next runs. It is
+    created again if the number of workers changed or if it broke.
+    """
+    executor = _pool["executor"]
+    if executor is None or _pool["workers"] != workers or getattr(executor, "_broken", False):
+        shutdown_pool()
+        # spawn rather than fork: the caller may be a thread of the napari process
+        _pool["executor"] = ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"))
+        _pool["workers"] = workers
+    return _pool["executor"]
+
+def shutdown_pool():
+    executor = _pool["executor"]
+    _pool["executor"] = None
+    _pool["workers"] = None
+    if executor is not None:
+        executor.shutdown(wait=True, cancel_futures=True)
+
+atexit.register(shutdown_pool)
+
+def run_row_blocks(function, inputs, outputs, nb_of_rows, rows_per_block, workers=None, message=None):
+    """
+    Run function on blocks of rows of the images, on `workers` processes
+    (all the cores by default). It runs in this process if there is only one
+    worker or one block, and in the worker processes of a pool (e.g. the batch
+    processing), which already use all the cores.
+
+    function(inputs, outputs, row_start, row_stop) reads what it needs of the
+    input arrays (a block may need rows around its own, e.g. for derivatives)
+    and writes the rows row_start to row_stop of the outputs. It must be
+    importable by the workers (a module level function).
+
+    Args:
+        inputs (dict): name: input array.
+        outputs (dict): name: (shape, dtype) of the output arrays.
+        nb_of_rows (int): number of rows split in blocks.
+        rows_per_block (int): largest number of rows of a task, fewer so that each worker gets a few tasks.
+        message (str): progress message, if any.
+
+    Returns:
+        dict: name: output array.
+    """
+    workers, blocks = _split_rows(nb_of_rows, rows_per_block, workers)
+
+    if workers <= 1:
+        results = {name: np.empty(shape, dtype=dtype) for name, (shape, dtype) in outputs.items()}
+        for row_start, row_stop in blocks:
+            if message is not None:
+                progress(message, row_start / nb_of_rows)
+            function(inputs, results, row_start, row_stop)
+        return results
+
+    shared = {}
+    try:
+        for name, array in inputs.items():
+            shared[name] = SharedArray.from_array(array)
+        for name, (shape, dtype) in outputs.items():
+            shared[name] = SharedArray(shape, dtype)
+        descriptors = {name: array.descriptor for name, array in shared.items()}
+        executor = get_pool(workers)
+        pending = {executor.submit(_run_block, function, descriptors, tuple(inputs), row_start, row_stop) for row_start, row_stop in blocks}
+        done = 0
+        try:
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    done += future.result()
+                if message is not None:
+                    progress(message, done / nb_of_rows)
+        finally:
+            # On error or cancellation, the blocks not started are dropped and
+            # the running ones finish before the shared memory is released
+            for future in pending:
+                future.cancel()
+            wait(pending)
+        return {name: shared[name].array.copy() for name in outputs}
+    finally:
+        for array in shared.values():
+            array.close()
+
+def run_row_blocks_threaded(function, nb_of_rows, rows_per_block, workers=None, message=None):
+    """
+    Run function(row_start, row_stop) on blocks of rows on `workers` threads
+    (all the cores by default), the blocks being split as in run_row_blocks.
+    function writes its rows into the outputs itself.
+    """
+    workers, blocks = _split_rows(nb_of_rows, rows_per_block, workers)
+    if workers <= 1:
+        for row_start, row_stop in blocks:
+            if message is not None:
+                progress(message, row_start / nb_of_rows)
+            function(row_start, row_stop)
+        return
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        pending = {executor.submit(function, row_start, row_stop) for row_start, row_stop in blocks}
+        done = 0
+        try:
+            while pending:
+                finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    future.result()
+                    done += 1
+                if message is not None:
+                    progress(message, done / len(blocks))
+        finally:
+            # The blocks not started are dropped, the executor waits for the running ones
+            for future in pending:
+                future.cancel()
+
+def _split_rows(nb_of_rows, rows_per_block, workers):
+    # One worker in the worker processes of a pool (e.g. the batch processing), which already use all the cores
+    if mp.parent_process() is not None:
+        workers = 1
+    workers = min(workers or os.cpu_count() or 1, math.ceil(nb_of_rows / rows_per_block))
+    if workers > 1:
+        # A few blocks per worker, for the load balance
+        rows_per_block = max(1, min(rows_per_block, math.ceil(nb_of_rows / (4 * workers))))
+    blocks = [(start, min(start + rows_per_block, nb_of_rows)) for start in range(0, nb_of_rows, rows_per_block)]
+    return workers, blocks
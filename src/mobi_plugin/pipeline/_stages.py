@@ -0,0 +1,91 @@
+import hashlib
+from collections import OrderedDict
+
+from ..popcorn.LCS_DirDF import processProjectionLCS_DDF, solveLCS_DDF
+from ..popcorn.LCS_DF import process_projection_LCS_DF, solve_LCS_DF
+from ..popcorn.MISTII_1 import processProjectionMISTII_1, solveMISTII_1
+from ..popcorn.MISTII_2 import processProjectionMISTII_2, solveMISTII_2
+from ..popcorn.XSVT import processProjectionXSVT, solveXSVT
+
+from ._cache import array_digest
+from ._progress import progress
+from ._tiling import auto_tile_size, solve_tiled
+from ._timing import timed_stage
+
+# Methods run in two stages: an expensive per-pixel solve, which only depends
+# on the images and on the listed parameters, then a cheap post-processing
+# (median filters, displacement clipping, integration, colour composites)
+# using all the other parameters.
+# method: (solve, parameters of the solve, post-processing)
+STAGED_METHODS = {
+    'lcs_df': (solve_LCS_DF, ('nb_of_point', 'precision', 'LCS_streaming'), process_projection_LCS_DF),
+    'lcs_dirdf': (solveLCS_DDF, ('nb_of_point', 'precision'), processProjectionLCS_DDF),
+    'mistii1': (solveMISTII_1, ('nb_of_point', 'pixel', 'precision'), processProjectionMISTII_1),
+    'mistii2': (solveMISTII_2, ('nb_of_point', 'pixel', 'precision'), processProjectionMISTII_2),
+    'xsvt': (solveXSVT, ('max_shift', 'XSVT_Nw', 'XSVT_search'), processProjectionXSVT),
+}
+
+
+class SolveCache:
+    """
+    In-memory cache of the raw outputs of the solve stage of the last runs,
+    so that changing only post-processing parameters does not solve again.
+    """
+
+    def __init__(self, max_entries=4):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def key(self, experiment):
+        solve, parameters, postprocess = STAGED_METHODS[experiment.method]
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(repr([experiment.method] + [getattr(experiment, name) for name in parameters]).encode())
+        array_digest(experiment.sample_images, hasher)
+        array_digest(experiment.reference_images, hasher)
+        return hasher.hexdigest()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, solution):
+        self._entries[key] = solution
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+def run_staged(experiment, solve_cache=None, tile_size=None):
+    """
+    Run a method of STAGED_METHODS, reusing the output of its solve stage
+    from the cache when the images and the parameters of the solve are unchanged.
+    The solve runs on tiles of tile_size pixels: by default only when the full
+    frame does not fit in memory, never if tile_size is 0.
+    """
+    solve, parameters, postprocess = STAGED_METHODS[experiment.method]
+    solution = None
+    if solve_cache is not None:
+        key = solve_cache.key(experiment)
+        solution = solve_cache.get(key)
+        if solution is not None:
+            print(f"Reusing the solve stage of {experiment.method}, only post-processing")
+
+    if solution is None:
+        if tile_size is None:
+            tile_size = auto_tile_size(experiment, experiment.reference_images.shape)
+        with timed_stage("solve"):
+            if tile_size:
+                solution = solve_tiled(solve, experiment, tile_size)
+            else:
+                solution = solve(experiment)
+        if solve_cache is not None:
+            solve_cache.put(key, solution)
+
+    progress("Post-processing")
+    with timed_stage("post-processing"):
+        return postprocess(experiment, solution)
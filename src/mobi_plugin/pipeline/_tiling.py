@@ -0,0 +1,113 @@
+import math
+from contextlib import nullcontext
+
+import dask
+import numpy as np
+import psutil
+
+from ._progress import current_monitor, progress
+
+# How the solve stage of each staged method (see _stages.py) is tiled:
+# method: (halo in pixels, padding of the image borders, working arrays)
+# - the halo covers the derivative stencils (np.gradient, laplace) or the
+#   speckle search (max_shift and window), so that the pixels of a tile are
+#   computed exactly as on the full frame;
+# - methods wrapping their derivatives around the image are padded the same
+#   way, the others see the image borders as the full frame does;
+# - working arrays: arrays of shape (nb_of_point, pixels), in the precision of
+#   the experiment, the solve allocates, to size the tiles from the available memory
+#   (for lcs_dirdf, its 20 float64 sums of the reference images per pixel).
+TILED_METHODS = {
+    'lcs_df': (lambda experiment: 1, None, 7),
+    'lcs_dirdf': (lambda experiment: 2, 'wrap', 3),
+    'mistii1': (lambda experiment: 2, None, 7),
+    'mistii2': (lambda experiment: 2, None, 7),
+    # map_coordinates (transmission, dark field) also needs the decay of its spline prefilter
+    'xsvt': (lambda experiment: int(experiment.max_shift) + int(experiment.XSVT_Nw) + 8, None, 4),
+}
+
+# Values per pixel of the streaming lcs_df solve (LCS_streaming): its normal
+# equations, 4 x 4 + 4 sums in float64 whatever the number of points
+STREAMING_LCS_DF_VALUES = 4 * 4 + 4
+
+MIN_TILE_SIZE = 64
+
+
+def auto_tile_size(experiment, shape, memory_limit=None):
+    """
+    Side of the square tiles keeping the memory of the solve below
+    memory_limit (a quarter of the available memory by default), or None
+    if the full frame fits.
+    """
+    if experiment.method not in TILED_METHODS:
+        return None
+    halo_of, padding, working_arrays = TILED_METHODS[experiment.method]
+    if memory_limit is None:
+        memory_limit = psutil.virtual_memory().available / 4
+    nb_of_point, ny, nx = shape
+    if experiment.method == 'lcs_df' and getattr(experiment, "LCS_streaming", False):
+        bytes_per_pixel = np.dtype(np.float64).itemsize * STREAMING_LCS_DF_VALUES
+    else:
+        bytes_per_pixel = experiment.get_dtype().itemsize * working_arrays * nb_of_point
+    if bytes_per_pixel * ny * nx <= memory_limit:
+        return None
+    side = int(math.sqrt(memory_limit / bytes_per_pixel)) - 2 * halo_of(experiment)
+    return max(MIN_TILE_SIZE, side)
+
+def tile_bounds(ny, nx, tile_size):
+    """
+    (y0, y1, x0, x1) of the tiles covering an image of ny x nx pixels.
+    """
+    return [(y0, min(y0 + tile_size, ny), x0, min(x0 + tile_size, nx))
+            for y0 in range(0, ny, tile_size) for x0 in range(0, nx, tile_size)]
+
+def solve_tiled(solve, experiment, tile_size, workers=1):
+    """
+    Run solve, the solve stage of the method of the experiment, tile by tile and
+    stitch the solutions, so that the memory used by the solve is bounded by
+    the tile size instead of the frame size. Tiles are dask tasks, run on
+    `workers` threads (each tile holds its own working arrays).
+
+    Returns:
+        NUMPY ARRAY: the solution of the full frame, (unknowns, y, x).
+    """
+    halo_of, padding, working_arrays = TILED_METHODS[experiment.method]
+    halo = halo_of(experiment)
+
+    sample = experiment.sample_images
+    reference = experiment.reference_images
+    ny, nx = reference.shape[-2:]
+    offset = 0
+    if padding is not None:
+        pad_width = ((0, 0), (halo, halo), (halo, halo))
+        sample = np.pad(sample, pad_width, mode=padding)
+        reference = np.pad(reference, pad_width, mode=padding)
+        offset = halo
+
+    tiles = tile_bounds(ny, nx, tile_size)
+    print(f"Tiled solve: {len(tiles)} tiles of {tile_size} pixels, halo of {halo} pixels")
+    # The progress and cancellation of the run also apply in the dask threads
+    monitor = current_monitor()
+
+    def solve_tile(index, y0, y1, x0, x1):
+        with monitor.activate() if monitor is not None else nullcontext():
+            progress(f"Tile {index + 1}/{len(tiles)}", index / len(tiles))
+            # Tile with its halo, in the coordinates of the (padded) images
+            ty0, ty1 = max(0, y0 + offset - halo), min(sample.shape[-2], y1 + offset + halo)
+            tx0, tx1 = max(0, x0 + offset - halo), min(sample.shape[-1], x1 + offset + halo)
+            tile_experiment = experiment.copy()
+            tile_experiment.sample_images = np.asarray(sample[:, ty0:ty1, tx0:tx1])
+            tile_experiment.reference_images = np.asarray(reference[:, ty0:ty1, tx0:tx1])
+            solution = np.asarray(solve(tile_experiment))
+            return solution[:, y0 + offset - ty0:y1 + offset - ty0, x0 + offset - tx0:x1 + offset - tx0]
+
+    tasks = [dask.delayed(solve_tile)(index, *bounds) for index, bounds in enumerate(tiles)]
+    if workers > 1:
+        solutions = dask.compute(*tasks, scheduler="threads", num_workers=workers)
+    else:
+        solutions = dask.compute(*tasks, scheduler="synchronous")
+
+    solution = np.empty((solutions[0].shape[0], ny, nx), dtype=solutions[0].dtype)
+    for (y0, y1, x0, x1), tile_solution in zip(tiles, solutions):
+        solution[:, y0:y1, x0:x1] = tile_solution
+    return solution
@@ -0,0 +1,149 @@
+import json
+import threading
+import time
+from contextlib import contextmanager, nullcontext
+
+import psutil
+
+# Key of the stage timings in the result dictionaries (the other values are images)
+TIMINGS_KEY = "timings"
+
+_local = threading.local()
+
+
+class _PeakWatch:
+    """
+    Peak memory seen while a stage runs (compared by identity, not value).
+    """
+    def __init__(self, memory):
+        self.peak = memory
+
+
+class MemorySampler(threading.Thread):
+    """
+    Background thread reading the resident memory of the process every
+    `interval` seconds and updating the peak seen by each running stage.
+    """
+
+    def __init__(self, interval=0.01):
+        super().__init__(daemon=True)
+        self.interval = interval
+        self.process = psutil.Process()
+        self.watches = []
+        self._stop_event = threading.Event()
+
+    def sample(self):
+        rss = self.process.memory_info().rss
+        for watch in list(self.watches):
+            watch.peak = max(watch.peak, rss)
+        return rss
+
+    def run(self):
+        while not self._stop_event.wait(self.interval):
+            self.sample()
+
+    def stop(self):
+        self._stop_event.set()
+        self.join()
+
+
+class StageTimings:
+    """
+    Wall time, CPU time and peak memory (resident set size) of the stages of
+    a processing run. Stages can be nested: a stage includes the stages run
+    inside it. The CPU time is the one of the whole process (all threads,
+    but not the worker processes of a pool).
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.records = []
+        self._sampler = None
+
+    @contextmanager
+    def activate(self):
+        """
+        Make these timings the ones recorded by ``timed_stage()`` in the
+        current thread, and sample the memory while they are active.
+        """
+        previous = getattr(_local, "timings", None)
+        _local.timings = self
+        owns_sampler = self._sampler is None
+        if owns_sampler:
+            self._sampler = MemorySampler(self.interval)
+            self._sampler.start()
+        try:
+            yield self
+        finally:
+            if owns_sampler:
+                self._sampler.stop()
+                self._sampler = None
+            _local.timings = previous
+
+    @contextmanager
+    def stage(self, name):
+        sampler = self._sampler or MemorySampler()
+        start_memory = sampler.sample()
+        watch = _PeakWatch(start_memory)
+        sampler.watches.append(watch)
+        # Recorded when the stage starts, so that nested stages come after it
+        record = {"stage": name}
+        self.records.append(record)
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            record["wall_time"] = time.perf_counter() - wall
+            record["cpu_time"] = time.process_time() - cpu
+            sampler.sample()
+            sampler.watches.remove(watch)
+            record["peak_memory"] = watch.peak
+            record["memory_increase"] = watch.peak - start_memory
+
+    def as_dict(self):
+        """
+        Timings by stage, in the order the stages started; a stage run
+        several times has its times summed and its peaks maximised.
+        """
+        timings = {}
+        for record in self.records:
+            merge_stage(timings, record["stage"], record)
+        return timings
+
+
+def merge_stage(timings, name, record):
+    if name not in timings:
+        timings[name] = {"wall_time": 0.0, "cpu_time": 0.0, "peak_memory": 0, "memory_increase": 0, "calls": 0}
+    total = timings[name]
+    total["wall_time"] += record["wall_time"]
+    total["cpu_time"] += record["cpu_time"]
+    total["peak_memory"] = max(total["peak_memory"], record["peak_memory"])
+    total["memory_increase"] = max(total["memory_increase"], record["memory_increase"])
+    total["calls"] += record.get("calls", 1)
+
+def merge_timings(*all_timings):
+    """
+    Combine dictionaries returned by StageTimings.as_dict (e.g. the projections of a batch).
+    """
+    merged = {}
+    for timings in all_timings:
+        for name, record in timings.items():
+            merge_stage(merged, name, record)
+    return merged
+
+def timed_stage(name):
+    """
+    Record the enclosed block as a stage of the timings active in the
+    current thread, if any.
+    """
+    timings = getattr(_local, "timings", None)
+    if timings is None:
+        return nullcontext()
+    return timings.stage(name)
+
+def write_timings(path, timings, **metadata):
+    """
+    Write the timings (and metadata such as the method) to a JSON file, to compare runs.
+    """
+    with open(path, "w") as f:
+        json.dump({**metadata, "stages": timings}, f, indent=2)
@@ -8,16 +8,147 @@ Created on Mon Mar 15 13:46:27 2021.
 import numpy as np
 from . import frankoChellappa as fc
 from scipy.ndimage.filters import  median_filter
-from scipy.ndimage import laplace
 from . import fourier_integration, ls_integration
+from .derivatives import derivative, gradient, laplacian
+from .batched_lstsq import log_condition, solve_normal_equations, solve_pixel_systems
+from .reference_cache import prepare_reference
+from ..pipeline._progress import progress
+from ..pipeline._timing import timed_stage
 
 
-def LCS_DF(experiment):
+def solve_LCS_DF(experiment):
+    """Solves the LCS system for each pixel, the expensive stage of LCS_DF.
+
+    Args:
+        experiment (PhaseRetrievalClass): class with all parameters as attributes.
+
+    Returns:
+        solution (NUMPY ARRAY): the 4 unknowns of the system for each pixel, then the
+        condition number of its system (5 x Ny x Nx).
+
+    """
+    experiment.nb_of_point=experiment.sample_images.shape[0]
+    if getattr(experiment, "LCS_streaming", False):
+        return solve_LCS_DF_streaming(experiment)
+
+    Nz, Ny, Nx=experiment.reference_images.shape
+    LHS=np.ones(((experiment.nb_of_point, Ny, Nx)), dtype=experiment.get_dtype())
+    RHS=np.ones((((experiment.nb_of_point,4, Ny, Nx))), dtype=experiment.get_dtype())
+
+    #Prepare system matrices, the derivatives of the reference images are computed once for all the projections
+    #Right handSide
+    reference=experiment.reference_images
+    preparation=prepare_reference(reference)
+    gY_IrIr=preparation.get("derivative_y", lambda: derivative(reference, -2))
+    gX_IrIr=preparation.get("derivative_x", lambda: derivative(reference, -1))
+    lapIr=preparation.get("laplacian", lambda: laplacian(reference))
+    RHS[:,0]=experiment.sample_images
+    RHS[:,1]=gY_IrIr
+    RHS[:,2]=gX_IrIr
+    RHS[:,3]=-lapIr
+    LHS[:]=experiment.reference_images
+
+    #Solving system for each pixel 
+    solution, condition=solve_pixel_systems(RHS, LHS, [1,0,0,0], "Solving LCS DF system")
+
+    return np.concatenate((solution, condition[np.newaxis]))
+
+
+def referenceNormalLCS_DF(reference_images):
+    """Sums of the normal equations of LCS_DF which only involve the reference images.
+
+    The columns 1 to 3 of the system (gradients and laplacian of the reference
+    images) and b (the reference images) do not depend on the sample.
+
+    Args:
+        reference_images (NUMPY ARRAY): reference images (nb_of_point x Ny x Nx).
+
+    Returns:
+        sums (NUMPY ARRAY): the 3x3 block of A^T A of these columns (9 values) then their
+        3 products A^T b, for each pixel (12 x Ny x Nx), in float64.
+
+    """
+    Nz, Ny, Nx=reference_images.shape
+    sums=np.zeros((12, Ny, Nx))
+    AtA=sums[:9].reshape(3, 3, Ny, Nx)
+    Atb=sums[9:]
+    for i in range(Nz):
+        progress("Preparing the reference images", i / Nz)
+        Ir=np.asarray(reference_images[i], dtype=float)
+        gY_IrIr,gX_IrIr=gradient(Ir)
+        a=[gY_IrIr, gX_IrIr, -laplacian(Ir)]
+        for k in range(3):
+            Atb[k]+=a[k]*Ir
+            for l in range(k, 3):
+                AtA[k,l]+=a[k]*a[l]
+    for k in range(3):
+        for l in range(k):
+            AtA[k,l]=AtA[l,k]
+    return sums
+
+
+def solve_LCS_DF_streaming(experiment):
+    """Solves the LCS system for each pixel from its normal equations, accumulated one image at a time.
+
+    Only the gradients and laplacian of the current reference image are
+    kept, so the memory does not grow with the number of membrane positions
+    (4x4 + 4 values per pixel instead of 5 per pixel and position). The sums
+    which do not involve the sample are computed once for all the projections
+    (referenceNormalLCS_DF). The derivatives of the reference images, needed
+    for the sums with the sample, are read frame by frame from the reference
+    cache when it is on disk (REFERENCE_CACHE_VARIABLE), otherwise each
+    projection computes them again, so that they are never all in memory.
+
+    Args:
+        experiment (PhaseRetrievalClass): class with all parameters as attributes.
+
+    Returns:
+        solution (NUMPY ARRAY): the 4 unknowns of the system for each pixel, then the
+        condition number of its system (5 x Ny x Nx).
+
+    """
+    Nz, Ny, Nx=experiment.reference_images.shape
+    reference=experiment.reference_images
+    preparation=prepare_reference(reference)
+    sums=preparation.get("lcs_df_normal", lambda: referenceNormalLCS_DF(reference))
+    if preparation.directory:
+        # Memory-mapped, computed one at a time (the same arrays as the stacked solve)
+        derivatives=[preparation.get("derivative_y", lambda: derivative(reference, -2)),
+                     preparation.get("derivative_x", lambda: derivative(reference, -1)),
+                     preparation.get("laplacian", lambda: laplacian(reference))]
+    # The sums are accumulated in float64 whatever the precision, the normal equations square the condition number
+    AtA=np.zeros((4, 4, Ny, Nx))
+    Atb=np.zeros((4, Ny, Nx))
+    AtA[1:,1:]=sums[:9].reshape(3, 3, Ny, Nx)
+    Atb[1:]=sums[9:]
+
+    for i in range(Nz):
+        progress("Accumulating LCS DF system", i / Nz)
+        Ir=np.asarray(reference[i], dtype=float)
+        if preparation.directory:
+            gY_IrIr,gX_IrIr,lapIr=(np.asarray(array[i], dtype=float) for array in derivatives)
+        else:
+            gY_IrIr,gX_IrIr=gradient(Ir)
+            lapIr=laplacian(Ir)
+        Is=np.asarray(experiment.sample_images[i], dtype=float)
+        a=[Is, gY_IrIr, gX_IrIr, -lapIr]
+        Atb[0]+=Is*Ir
+        for l in range(4):
+            AtA[0,l]+=Is*a[l]
+    for l in range(1, 4):
+        AtA[l,0]=AtA[0,l]
+
+    solution, condition=solve_normal_equations(AtA, Atb, [1,0,0,0], "Solving LCS DF system")
+    return np.concatenate((solution, condition[np.newaxis])).astype(experiment.get_dtype(), copy=False)
+
+
+def LCS_DF(experiment, solution=None):
     """Calculates the displacement images from sample and reference images using the LCS system
     
 
     Args:
         experiment (PhaseRetrievalClass): class with all parameters as attributes.
+        solution (NUMPY ARRAY): output of solve_LCS_DF, to skip the solve stage.
 
     Returns:
         Dx (NUMPY ARRAY): the displacements along x axis (h).
@@ -25,38 +156,14 @@ def LCS_DF(experiment):
         absoprtion (NUMPY ARRAY): the absorption.
 
     """
+    if solution is None:
+        solution=solve_LCS_DF(experiment)
 
-    Nz, Ny, Nx=experiment.reference_images.shape
-    LHS=np.ones(((experiment.nb_of_point, Ny, Nx)))
-    RHS=np.ones((((experiment.nb_of_point,4, Ny, Nx))))
-    solution=np.ones(((4, Ny, Nx)))
-
-    #Prepare system matrices
-    for i in range(experiment.nb_of_point):
-        #Right handSide
-        gY_IrIr,gX_IrIr=np.gradient(experiment.reference_images[i])
-        lapIr=laplace(experiment.reference_images[i])
-        RHS[i]=[experiment.sample_images[i],gY_IrIr, gX_IrIr, -lapIr]
-        LHS[i]=experiment.reference_images[i]
-
-    #Solving system for each pixel 
-    for i in range(Ny):
-        for j in range(Nx):
-            a=RHS[:,:,i,j]
-            b=LHS[:,i,j]
-            Q,R = np.linalg.qr(a) # qr decomposition of A
-            Qb = np.dot(Q.T,b) # computing Q^T*b (project b onto the range of A)
-            
-            if R[2,2]==0 or R[1,1]==0 or R[0,0]==0 or R[3,3]==0:
-                temp=[1,0,0,0]
-            else:
-                temp = np.linalg.solve(R,Qb) # solving R*x = Q^T*b
-            solution[:,i,j]=temp
-        
+    # Copies: the post-processing below works in place and the solution may be reused
     absoprtion=1/solution[0]
-    Dy=solution[1]
-    Dx=solution[2]
-    DeltaDeff=solution[3]
+    Dy=solution[1].copy()
+    Dx=solution[2].copy()
+    DeltaDeff=solution[3].copy()
     
     #Bit of post-processing
     #Limiting displacement to a threshold
@@ -66,28 +173,32 @@ def LCS_DF(experiment):
     Dy[Dy<-displacementLimit]=-displacementLimit
     Dy[Dy>displacementLimit]=displacementLimit
     #Trying different filters
-    if experiment.LCS_median_filter !=0:
-        Dx=median_filter(Dx,size=experiment.LCS_median_filter)
-        Dy=median_filter(Dy,size=experiment.LCS_median_filter)
+    with timed_stage("median filter"):
+        if experiment.LCS_median_filter !=0:
+            Dx=median_filter(Dx,size=experiment.LCS_median_filter)
+            Dy=median_filter(Dy,size=experiment.LCS_median_filter)
     DeltaDeff[DeltaDeff<0]=0
     DeltaDeff[DeltaDeff>1]=0
     DeltaDeff[DeltaDeff>np.std(DeltaDeff)*5]=0
     return Dx, Dy, absoprtion, DeltaDeff
 
 
-def process_projection_LCS_DF(experiment):
+def process_projection_LCS_DF(experiment, solution=None):
     """launches calculation of displacement maps and phase images from LCS, FC, LA and K.
     
     Args:
         experiment (PHASERETRIEVALCLASS): class of the experiment.
+        solution (NUMPY ARRAY): output of solve_LCS_DF, to only redo the post-processing.
 
     Returns:
         dict | NUMPY ARRAY : contains all the calculated images.
 
     """
     experiment.nb_of_point, Nx, Ny= experiment.sample_images.shape
+    if solution is None:
+        solution=solve_LCS_DF(experiment)
     
-    dx, dy , absorption ,DeltaDeff=LCS_DF(experiment)
+    dx, dy , absorption ,DeltaDeff=LCS_DF(experiment, solution)
 
     # Compute the phase gradient from displacements (linear relationship)
     # magnification=(experiment['distSO']+experiment['distOD'])/experiment['distSO'] #Not sure I need to use this yet
@@ -110,8 +221,9 @@ def process_projection_LCS_DF(experiment):
     # The sampling step for the gradient is the magnified pixel size
     magnificationFactor = (experiment.dist_object_detector + experiment.dist_source_object) / experiment.dist_source_object
     gradientSampling = experiment.pixel / magnificationFactor
-    phiFC = fc.frankotchellappa(dphix, dphiy, True)*gradientSampling
-    phiK = fourier_integration.fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
+    with timed_stage("integrate"):
+        phiFC = fc.frankotchellappa(dphix, dphiy, True)*gradientSampling
+        phiK = fourier_integration.fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
     #phiLS = ls_integration.least_squares(dphix, dphiy, gradientSampling, gradientSampling, model='southwell')
     
     if (padForIntegration and padSize > 0):
@@ -119,7 +231,10 @@ def process_projection_LCS_DF(experiment):
         phiK = phiK[padSize:padSize + Nx , padSize:padSize + Ny]
         #phiLS = phiLS[padSize:padSize + Nx, padSize:padSize + Ny]
 
-    return {'dx': dx, 'dy': dy, 'phiFC': phiFC, 'phiK': phiK, 'absorption':absorption, 'DeltaDeff':DeltaDeff} #'phiLS': phiLS,
+    result={'dx': dx, 'dy': dy, 'phiFC': phiFC, 'phiK': phiK, 'absorption':absorption, 'DeltaDeff':DeltaDeff} #'phiLS': phiLS,
+    if getattr(experiment, "condition_map", False):
+        result['log_condition']=log_condition(solution[4])
+    return result
 
 
 
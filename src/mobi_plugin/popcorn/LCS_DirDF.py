@@ -8,35 +8,33 @@ Created on Mon Mar 15 13:46:27 2021.
 import numpy as np
 from scipy.ndimage.filters import median_filter
 from matplotlib.colors import hsv_to_rgb
-from numba import jit
+from numba import jit, njit, prange
 from . import frankoChellappa as fc
 from .fourier_integration import fourier_solver
 
-from scipy import signal
+from .batched_lstsq import log_condition, max_condition
+from .derivatives import wrapped_differences
+from .reference_cache import prepare_reference
+from ..pipeline._progress import progress
+from ..pipeline._timing import timed_stage
 
 
 def myGradient(img):
-    coins=0.3
-    # kernely = np.array([[coins,1,coins],[0,0,0],[-coins,-1,-coins]])
-    # kernelx = np.array([[coins,0,-coins],[1,0,-1],[coins,0,-coins]])
-    kernely = np.array([[1],[0],[-1]])
-    kernelx = np.array([[1,0,-1]])
-    edges_x = signal.convolve2d(img,kernelx,boundary='wrap', mode='same')
-    edges_y = signal.convolve2d(img,kernely,boundary='wrap', mode='same')
+    # Centred differences wrapping around the image (convolution by [1,0,-1]),
+    # the derivatives fast_solve_LCS_DDF computes for each pixel
+    edges_x, edges_y = wrapped_differences(img)
     return edges_x, edges_y
     
 
-def LCS_DDF(experiment):
-    """Calculates the displacement images from sample and reference images using the LCS system
-    
+def solveLCS_DDF(experiment):
+    """Solves the LCS directional dark field system for each pixel, the expensive stage of LCS_DDF.
 
     Args:
         experiment (PhaseRetrievalClass): class with all parameters as attributes.
 
     Returns:
-        Dx (NUMPY ARRAY): the displacements along x axis.
-        Dy (NUMPY ARRAY): the displacements along y axis.
-        absoprtion (NUMPY ARRAY): the absorption.
+        solution (NUMPY ARRAY): the 6 unknowns of the system for each pixel, then the
+        condition number estimate of its system (7 x Nx x Ny).
 
     """
     nbOfVariables=6
@@ -44,48 +42,222 @@ def LCS_DDF(experiment):
         raise Exception("Not enough point to solve LCS dir DF (min 6) only %d given" %experiment.nb_of_point)
     
     
-    Nz, Nx, Ny=experiment.reference_images.shape
-    LHS=np.ones(((experiment.nb_of_point, Nx, Ny)))
-    RHS=np.ones((((experiment.nb_of_point,nbOfVariables, Nx, Ny))))
-    solution=np.ones(((nbOfVariables, Nx, Ny)))
+    sample=np.ascontiguousarray(experiment.sample_images)
+    reference=np.ascontiguousarray(experiment.reference_images)
+    Nz, Nx, Ny=reference.shape
+    solution=np.empty((nbOfVariables+1, Nx, Ny), dtype=experiment.get_dtype())
+    #The sums which only involve the reference images are computed once for all the projections
+    sums=np.asarray(prepare_reference(experiment.reference_images).get("lcs_ddf_normal", lambda: referenceNormalLCS_DDF(reference)))
 
-    #Prepare system matrices
-    for i in range(experiment.nb_of_point):
+    #Solving system for each pixel, by bands of rows to report the progress
+    rowsPerBand=max(1, 2**16//Ny)
+    for start in range(0, Nx, rowsPerBand):
+        progress("Solving LCS directional DF system", start / Nx)
+        fast_solve_LCS_DDF(sample, reference, sums, start, min(start+rowsPerBand, Nx), max_condition(float), solution)
 
-        #Right handSide
-        # gX_IrIr,gY_IrIr=np.gradient(experiment.reference_images[i])
-        # lapIr=laplace(experiment.reference_images[i])
-        
-        gX_IrIr,gY_IrIr=myGradient(experiment.reference_images[i] )
-        gXX_IrIr,gYX_IrIr=myGradient(gX_IrIr)
-        gXY_IrIr,gYY_IrIr=myGradient(gY_IrIr)
-        
-        
-        
-        RHS[i]=[experiment.sample_images[i],gX_IrIr, gY_IrIr, -gXX_IrIr, -gYY_IrIr, -gXY_IrIr]
-        LHS[i]=experiment.reference_images[i]
+    return solution
+
+
+def referenceNormalLCS_DDF(reference):
+    """Sums of the normal equations of LCS_DDF which only involve the reference images.
 
-    #Solving system for each pixel 
-    for i in range(Nx):
+    Args:
+        reference (NUMPY ARRAY): reference images (nb_of_point x Nx x Ny).
+
+    Returns:
+        sums (NUMPY ARRAY): see fast_reference_normal_LCS_DDF (20 x Nx x Ny), in float64.
 
+    """
+    reference=np.ascontiguousarray(reference)
+    Nz, Nx, Ny=reference.shape
+    sums=np.empty((20, Nx, Ny))
+    rowsPerBand=max(1, 2**16//Ny)
+    for start in range(0, Nx, rowsPerBand):
+        progress("Preparing the reference images", start / Nx)
+        fast_reference_normal_LCS_DDF(reference, start, min(start+rowsPerBand, Nx), sums)
+    return sums
+
+
+@njit(parallel=True, cache=True)
+def fast_reference_normal_LCS_DDF(reference, rowStart, rowStop, sums):
+    """Sums of the normal equations of the LCS directional DF system which do not depend on the sample.
+
+    The columns 1 to 5 of the system (derivatives of the reference images) and
+    b (the reference images) are the same for all the projections.
+
+    Args:
+        reference (NUMPY ARRAY): reference images (nb_of_point x Nx x Ny).
+        rowStart, rowStop (int): rows to compute.
+        sums (NUMPY ARRAY): output, for each pixel the upper triangle of the 5x5 block of
+        the Gram matrix of these columns, row by row (15 values), then their 5 products with b.
+
+    """
+    Nz, Nx, Ny=reference.shape
+    for i in prange(rowStart, rowStop):
+        gram=np.empty((6, 6))
+        vec=np.empty(6)
+        a=np.empty(6)
+        im1, ip1, im2, ip2=(i-1)%Nx, (i+1)%Nx, (i-2)%Nx, (i+2)%Nx
         for j in range(Ny):
-            a=RHS[:,:,i,j]
-            b=LHS[:,i,j]
-            Q,R = np.linalg.qr(a) # qr decomposition of A
-            Qb = np.dot(Q.T,b) # computing Q^T*b (project b onto the range of A)
-            
-            if R[2,2]==0 or R[1,1]==0 or R[0,0]==0 or R[3,3]==0 or R[4,4]==0 or R[5,5]==0:
-                temp=[1,0,0,0,0,0]
-            else:
-                temp = np.linalg.solve(R,Qb) # solving R*x = Q^T*b
-            solution[:,i,j]=temp
-        
+            jm1, jp1, jm2, jp2=(j-1)%Ny, (j+1)%Ny, (j-2)%Ny, (j+2)%Ny
+            gram[:]=0
+            vec[:]=0
+            for k in range(Nz):
+                Ir=reference[k]
+                a[1]=Ir[i, jp1]-Ir[i, jm1]
+                a[2]=Ir[ip1, j]-Ir[im1, j]
+                a[3]=-(Ir[i, jp2]-2*Ir[i, j]+Ir[i, jm2])
+                a[4]=-(Ir[ip2, j]-2*Ir[i, j]+Ir[im2, j])
+                a[5]=-(Ir[ip1, jp1]-Ir[im1, jp1]-Ir[ip1, jm1]+Ir[im1, jm1])
+                b=Ir[i, j]
+                for m in range(1, 6):
+                    vec[m]+=a[m]*b
+                    for n in range(m, 6):
+                        gram[m, n]+=a[m]*a[n]
+            index=0
+            for m in range(1, 6):
+                for n in range(m, 6):
+                    sums[index, i, j]=gram[m, n]
+                    index+=1
+            for m in range(1, 6):
+                sums[14+m, i, j]=vec[m]
+
+
+@njit(parallel=True, cache=True)
+def fast_solve_LCS_DDF(sample, reference, sums, rowStart, rowStop, maxCondition, solution):
+    """Builds and solves the normal equations of the LCS directional DF system of the rows rowStart to rowStop.
+
+    The derivatives are the ones of myGradient (centred differences wrapping
+    around the image), computed for each pixel from its neighbours, so that
+    the (nb_of_point, 6, Nx, Ny) system is never stored. Only the sums with
+    the sample column are accumulated, the others are given in sums.
+
+    Args:
+        sample (NUMPY ARRAY): sample images (nb_of_point x Nx x Ny).
+        reference (NUMPY ARRAY): reference images (nb_of_point x Nx x Ny).
+        sums (NUMPY ARRAY): output of fast_reference_normal_LCS_DDF (20 x Nx x Ny).
+        rowStart, rowStop (int): rows to solve.
+        maxCondition (float): largest condition number of the normal equations solved,
+        the pixels above get [1,0,0,0,0,0].
+        solution (NUMPY ARRAY): output, the 6 unknowns of each pixel then the condition number
+        estimate of its system, the square root of the one of its normal equations.
+        The normal equations are accumulated in float64 whatever its type, and solved
+        scaled to a unit diagonal (the columns of the system to a unit norm).
+
+    """
+    Nz, Nx, Ny=reference.shape
+    for i in prange(rowStart, rowStop):
+        gram=np.empty((6, 6))
+        vec=np.empty(6)
+        a=np.empty(6)
+        scale=np.empty(6)
+        im1, ip1, im2, ip2=(i-1)%Nx, (i+1)%Nx, (i-2)%Nx, (i+2)%Nx
+        for j in range(Ny):
+            jm1, jp1, jm2, jp2=(j-1)%Ny, (j+1)%Ny, (j-2)%Ny, (j+2)%Ny
+            gram[:]=0
+            vec[:]=0
+            for k in range(Nz):
+                Ir=reference[k]
+                a[0]=sample[k, i, j]
+                a[1]=Ir[i, jp1]-Ir[i, jm1]
+                a[2]=Ir[ip1, j]-Ir[im1, j]
+                a[3]=-(Ir[i, jp2]-2*Ir[i, j]+Ir[i, jm2])
+                a[4]=-(Ir[ip2, j]-2*Ir[i, j]+Ir[im2, j])
+                a[5]=-(Ir[ip1, jp1]-Ir[im1, jp1]-Ir[ip1, jm1]+Ir[im1, jm1])
+                b=Ir[i, j]
+                vec[0]+=a[0]*b
+                for n in range(6):
+                    gram[0, n]+=a[0]*a[n]
+            index=0
+            for m in range(1, 6):
+                for n in range(m, 6):
+                    gram[m, n]=sums[index, i, j]
+                    index+=1
+                vec[m]=sums[14+m, i, j]
+            for m in range(6):
+                for n in range(m):
+                    gram[m, n]=gram[n, m]
+            condition=np.inf
+            if np.all(np.diag(gram)>0): # else a null column makes the system singular
+                for m in range(6):
+                    scale[m]=1/np.sqrt(gram[m, m])
+                for m in range(6):
+                    vec[m]*=scale[m]
+                    for n in range(6):
+                        gram[m, n]*=scale[m]*scale[n]
+                condition=solve_small_system(gram, vec)
+                for m in range(6):
+                    vec[m]*=scale[m]
+            if not condition<maxCondition:
+                vec[:]=0
+                vec[0]=1
+            for m in range(6):
+                solution[m, i, j]=vec[m]
+            solution[6, i, j]=np.sqrt(condition)
+
+
+@njit(cache=True)
+def solve_small_system(A, b):
+    """Solves A x = b in place (x in b) by Gaussian elimination with partial pivoting.
+
+    Returns:
+        float: the ratio of the largest to the smallest pivot, an estimate of the
+        condition number of A; inf if A is singular (b is then meaningless).
+
+    """
+    n=b.shape[0]
+    largest=0.
+    smallest=np.inf
+    for c in range(n):
+        pivot=c
+        for r in range(c+1, n):
+            if abs(A[r, c])>abs(A[pivot, c]):
+                pivot=r
+        if A[pivot, c]==0 or not np.isfinite(A[pivot, c]):
+            return np.inf
+        largest=max(largest, abs(A[pivot, c]))
+        smallest=min(smallest, abs(A[pivot, c]))
+        if pivot!=c:
+            for m in range(n):
+                A[c, m], A[pivot, m]=A[pivot, m], A[c, m]
+            b[c], b[pivot]=b[pivot], b[c]
+        for r in range(c+1, n):
+            factor=A[r, c]/A[c, c]
+            for m in range(c, n):
+                A[r, m]-=factor*A[c, m]
+            b[r]-=factor*b[c]
+    for c in range(n-1, -1, -1):
+        total=b[c]
+        for m in range(c+1, n):
+            total-=A[c, m]*b[m]
+        b[c]=total/A[c, c]
+    return largest/smallest
+
+
+def LCS_DDF(experiment, solution=None):
+    """Calculates the displacement images from sample and reference images using the LCS system
+    
+
+    Args:
+        experiment (PhaseRetrievalClass): class with all parameters as attributes.
+        solution (NUMPY ARRAY): output of solveLCS_DDF, to skip the solve stage.
+
+    Returns:
+        Dx (NUMPY ARRAY): the displacements along x axis.
+        Dy (NUMPY ARRAY): the displacements along y axis.
+        absoprtion (NUMPY ARRAY): the absorption.
+
+    """
+    if solution is None:
+        solution=solveLCS_DDF(experiment)
+
+    # Copies: the post-processing works in place and the solution may be reused
     absoprtion=1/solution[0]
-    Dx=solution[1]
-    Dy=solution[2]
-    Deff_yy=solution[3]
-    Deff_xx=solution[4]
-    Deff_xy=solution[5]
+    Dx=solution[1].copy()
+    Dy=solution[2].copy()
+    Deff_yy=solution[3].copy()
+    Deff_xx=solution[4].copy()
+    Deff_xy=solution[5].copy()
     
     #Bit of post-processing
     #Limiting displacement to a threshold
@@ -172,19 +344,23 @@ def std_normalize(image, n_std=3, no_min=False):
     image=np.clip(image, 0, 1)
     return image
 
-def processProjectionLCS_DDF(experiment):
+def processProjectionLCS_DDF(experiment, solution=None):
     """
     This function calls PavlovDirDF to compute the tensors of the directional dark field and the thickness of the sample
     The function should also convert the tensor into a coloured image
+    The solution of the system (solveLCS_DDF) can be given to only redo the post-processing.
     """
     Nx, Ny= experiment.sample_images[0].shape
+    if solution is None:
+        solution=solveLCS_DDF(experiment)
     
     #Calculate directional darl field
-    dx, dy, absorption, Deff_xx, Deff_yy, Deff_xy = LCS_DDF(experiment)
+    dx, dy, absorption, Deff_xx, Deff_yy, Deff_xy = LCS_DDF(experiment, solution)
     
-    if experiment.LCS_median_filter !=0:
-        dx=median_filter(dx,size=experiment.LCS_median_filter)
-        dy=median_filter(dy,size=experiment.LCS_median_filter)
+    with timed_stage("median filter"):
+        if experiment.LCS_median_filter !=0:
+            dx=median_filter(dx,size=experiment.LCS_median_filter)
+            dy=median_filter(dy,size=experiment.LCS_median_filter)
 
     # Compute the phase gradient from displacements (linear relationship)
     # magnification=(experiment['distSO']+experiment['distOD'])/experiment['distSO'] #Not sure I need to use this yet
@@ -204,8 +380,9 @@ def processProjectionLCS_DDF(experiment):
     # The sampling step for the gradient is the magnified pixel size
     magnificationFactor = (experiment.dist_object_detector + experiment.dist_source_object) / experiment.dist_source_object
     gradientSampling = experiment.pixel / magnificationFactor
-    phiFC = fc.frankotchellappa(dphix, dphiy, 'antisym')*gradientSampling
-    phiK = fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
+    with timed_stage("integrate"):
+        phiFC = fc.frankotchellappa(dphix, dphiy, 'antisym')*gradientSampling
+        phiK = fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
     #phiLS = ls_integration.least_squares(dphix, dphiy, gradientSampling, gradientSampling, model='southwell')
     
     if (padForIntegration and padSize > 0):
@@ -261,14 +438,15 @@ def processProjectionLCS_DDF(experiment):
     
     #Median filter
     medFiltSize=experiment.LCS_median_filter
-    if medFiltSize!=0:
-        #thickness=median_filter(thickness, medFiltSize)
-        Deff_xx=median_filter(Deff_xx, medFiltSize)
-        Deff_yy=median_filter(Deff_yy, medFiltSize)
-        Deff_xy=median_filter(Deff_xy, medFiltSize)
-    if medFiltSize!=0:
-        area=median_filter(area, medFiltSize)
-        excentricity=median_filter(excentricity, medFiltSize)
+    with timed_stage("median filter"):
+        if medFiltSize!=0:
+            #thickness=median_filter(thickness, medFiltSize)
+            Deff_xx=median_filter(Deff_xx, medFiltSize)
+            Deff_yy=median_filter(Deff_yy, medFiltSize)
+            Deff_xy=median_filter(Deff_xy, medFiltSize)
+        if medFiltSize!=0:
+            area=median_filter(area, medFiltSize)
+            excentricity=median_filter(excentricity, medFiltSize)
     stdarea=np.std(area)
     area=abs(area)*1e3#/(3*stdarea)
     area[area>1]=1
@@ -281,35 +459,39 @@ def processProjectionLCS_DDF(experiment):
     
     IntensityDeff=np.sqrt((Deff_xx**2+Deff_yy**2+Deff_xy**2)/3)
     
-    theta, sat=correctTheta(theta, medFiltSize*2) #theta=carte des orientations sur l'image, medFiltSize=ecart type gaussienne
-    theta=theta/np.pi
+    with timed_stage("colour composite"):
+        theta, sat=correctTheta(theta, medFiltSize*2) #theta=carte des orientations sur l'image, medFiltSize=ecart type gaussienne
+        theta=theta/np.pi
     
-    #Trying to create a coloured image from tensor (method probably wrong for now)
-    colouredImage=np.zeros(((Nx, Ny,3)))
-    colouredImage[:,:,0]=Deff_xx
-    colouredImage[:,:,1]=Deff_yy
-    colouredImage[:,:,2]=abs(Deff_xy)
+        #Trying to create a coloured image from tensor (method probably wrong for now)
+        colouredImage=np.zeros(((Nx, Ny,3)))
+        colouredImage[:,:,0]=Deff_xx
+        colouredImage[:,:,1]=Deff_yy
+        colouredImage[:,:,2]=abs(Deff_xy)
     
-    colouredImageExc=np.zeros(((Nx, Ny,3)))
-    colouredImageExc[:,:,0]=theta
-    colouredImageExc[:,:,1]=sat
-    colouredImageExc[:,:,2]=std_normalize(excentricity,no_min=True)
+        colouredImageExc=np.zeros(((Nx, Ny,3)))
+        colouredImageExc[:,:,0]=theta
+        colouredImageExc[:,:,1]=sat
+        colouredImageExc[:,:,2]=std_normalize(excentricity,no_min=True)
     
-    colouredImagearea=np.zeros(((Nx, Ny,3)))
-    colouredImagearea[:,:,0]=theta
-    colouredImagearea[:,:,1]=sat#area 
-    colouredImagearea[:,:,2]=std_normalize(area,no_min=True)
+        colouredImagearea=np.zeros(((Nx, Ny,3)))
+        colouredImagearea[:,:,0]=theta
+        colouredImagearea[:,:,1]=sat#area 
+        colouredImagearea[:,:,2]=std_normalize(area,no_min=True)
     
-    colouredImageDir=np.zeros(((Nx, Ny,3)))
-    colouredImageDir[:,:,0]=theta
-    colouredImageDir[:,:,1]=sat 
-    colouredImageDir[:,:,2]=std_normalize(IntensityDeff,no_min=True) #1-np.exp(-IntensityDeff) 
+        colouredImageDir=np.zeros(((Nx, Ny,3)))
+        colouredImageDir[:,:,0]=theta
+        colouredImageDir[:,:,1]=sat 
+        colouredImageDir[:,:,2]=std_normalize(IntensityDeff,no_min=True) #1-np.exp(-IntensityDeff) 
     
-    colouredImageExc=hsv_to_rgb(colouredImageExc)
-    colouredImagearea=hsv_to_rgb(colouredImagearea)
-    colouredImageDir=hsv_to_rgb(colouredImageDir)
+        colouredImageExc=hsv_to_rgb(colouredImageExc)
+        colouredImagearea=hsv_to_rgb(colouredImagearea)
+        colouredImageDir=hsv_to_rgb(colouredImageDir)
 
-    return {'dx': dx, 'dy': dy, 'phiFC': phiFC.real, 'phiK': phiK.real, 'absorption':absorption, 'Deff_xx': Deff_xx, 'Deff_yy': Deff_yy, 'Deff_xy': Deff_xy,  'excentricity': excentricity,'area':area, 'oriented_DF_exc': colouredImageExc, 'oriented_DF_area': colouredImagearea, 'oriented_DF_norm':colouredImageDir, 'theta':theta, 'local_orientation_strength':sat}
+    result={'dx': dx, 'dy': dy, 'phiFC': phiFC.real, 'phiK': phiK.real, 'absorption':absorption, 'Deff_xx': Deff_xx, 'Deff_yy': Deff_yy, 'Deff_xy': Deff_xy,  'excentricity': excentricity,'area':area, 'oriented_DF_exc': colouredImageExc, 'oriented_DF_area': colouredImagearea, 'oriented_DF_norm':colouredImageDir, 'theta':theta, 'local_orientation_strength':sat}
+    if getattr(experiment, "condition_map", False):
+        result['log_condition']=log_condition(solution[6])
+    return result
 
 
 
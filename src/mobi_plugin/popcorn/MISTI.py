@@ -10,7 +10,7 @@ import sys
 
 sys.path.append(os.path.realpath('../..'))
 
-from scipy.ndimage.filters import gaussian_laplace,sobel,median_filter,laplace
+from scipy.ndimage.filters import gaussian_laplace,sobel,median_filter
 from numpy.fft import fftshift as fftshift
 from numpy.fft import ifftshift as ifftshift
 from numpy.fft import fft2 as fft2
@@ -20,6 +20,10 @@ import numpy as np
 import glob
 from scipy.ndimage import fourier_shift
 
+from .derivatives import laplacian
+from .batched_lstsq import log_condition
+from .reference_cache import solve_reference_systems
+
 
 
 def kevToLambda(energyInKev):
@@ -28,6 +32,24 @@ def kevToLambda(energyInKev):
 
     return waveLengthInNanometer * 1e-9
 
+def referenceSystemMISTI(reference_images, k, dtype=np.float64):
+    """Matrices of the MISTI systems, built from the reference images only.
+
+    Args:
+        reference_images (NUMPY ARRAY): reference images (nbImages x Nx x Ny).
+        k (float): wave number.
+        dtype (DTYPE): type of the matrices.
+
+    Returns:
+        RHS (NUMPY ARRAY): the matrix of each pixel (nbImages x 2 x Nx x Ny).
+    """
+    nbImages, Nx, Ny=reference_images.shape
+    RHS=np.ones((((nbImages,2, Nx, Ny))), dtype=dtype)
+    #Right handSide
+    RHS[:,0]=reference_images/k
+    RHS[:,1]=-laplacian(reference_images)
+    return RHS
+
 def MISTI(experiment):
     nbImages, Nx, Ny=experiment.reference_images.shape
     beta=experiment.beta
@@ -37,34 +59,17 @@ def MISTI(experiment):
     k=experiment.getk()
     Lambda=1.2398/experiment.energy*1e-9
     
-    LHS=np.ones(((nbImages, Nx, Ny)))
-    RHS=np.ones((((nbImages,2, Nx, Ny))))
-    solution=np.ones(((2, Nx, Ny)))
+    dtype=experiment.get_dtype()
+    LHS=np.ones(((nbImages, Nx, Ny)), dtype=dtype)
     
     #Prepare system matrices
     for i in range(nbImages):
         #Left hand Side
         IrIs=experiment.reference_images[i]-experiment.sample_images[i]
-        
-        #Right handSide
-        FirstRHS=experiment.reference_images[i]/k
-        lapIr=laplace(experiment.reference_images[i])
-        
-        RHS[i]=[FirstRHS,-lapIr]
         LHS[i]=IrIs/distSampDet
         
-#    Solving system for each pixel 
-    for i in range(Nx):
-        for j in range(Ny):
-            a=RHS[:,:,i,j]
-            b=LHS[:,i,j]
-            Q,R = np.linalg.qr(a) # qr decomposition of A
-            Qb = np.dot(Q.T,b) # computing Q^T*b (project b onto the range of A)
-            if R[1,1]==0 or R[0,0]==0:
-                temp=[1,1]
-            else:
-                temp = np.linalg.solve(R,Qb) # solving R*x = Q^T*b
-            solution[:,i,j]=temp
+#    Solving system for each pixel, the matrices only depend on the reference images
+    solution, condition=solve_reference_systems("MISTI", experiment.reference_images, (k, dtype.name), lambda: referenceSystemMISTI(experiment.reference_images, k, dtype), LHS, [1,1], "Solving MISTI system")
             
     lapPhi=solution[0]
     Deff=solution[1]
@@ -104,5 +109,8 @@ def MISTI(experiment):
     #Calculation of absorption image
     phi=k/distSampDet*ifft2(ifftshift(fftshift(fft2(lapPhi))/(-4*np.pi*uv_sqr)*beta)).real   
     
-    return {'Deff': Deff, 'phi': phi}
+    result={'Deff': Deff, 'phi': phi}
+    if getattr(experiment, "condition_map", False):
+        result['log_condition']=log_condition(condition)
+    return result
     
\ No newline at end of file
@@ -19,12 +19,69 @@ from matplotlib import pyplot as plt
 from numba import jit
 import colorsys
 
-def MISTII_1(experiment):
+from .derivatives import second_derivatives
+from .batched_lstsq import log_condition
+from .reference_cache import solve_reference_systems
+from ..pipeline._timing import timed_stage
+
+def referenceSystemMISTII_1(reference_images, pixSize, dtype=np.float64):
+    """
+    Matrices of the MISTII_1 systems, built from the reference images only.
+
+    Args:
+        reference_images (NUMPY ARRAY): reference images (nb_of_point x Nx x Ny).
+        pixSize (float): pixel size.
+        dtype (DTYPE): type of the matrices.
+
+    Returns:
+        RHS (NUMPY ARRAY): the matrix of each pixel (nb_of_point x 4 x Nx x Ny).
+    """
+    Nz, Nx, Ny=reference_images.shape
+    RHS=np.ones((((Nz,4, Nx, Ny))), dtype=dtype)
+    #Right handSide
+    gXX_IrIr,gYY_IrIr,gXY_IrIr=second_derivatives(reference_images,pixSize)
+    RHS[:,1]=gXX_IrIr/reference_images
+    RHS[:,2]=gYY_IrIr/reference_images
+    RHS[:,3]=gXY_IrIr/reference_images
+    return RHS
+
+
+def solveMISTII_1(experiment):
+    """
+    Solves the MIST II system for each pixel, the expensive stage of MISTII_1.
+
+    Args:
+        experiment (PhaseRetrievalClass): class with all parameters as attributes.
+
+    Returns:
+        solution (NUMPY ARRAY): the coefficients G1 to G4 of each pixel, then the
+        condition number estimate of its system (5 x Nx x Ny).
+    """
+    pixSize=experiment.pixel
+    reference_images=experiment.reference_images[:experiment.nb_of_point]
+
+    #Left hand Side
+    dtype=experiment.get_dtype()
+    LHS=np.empty(reference_images.shape, dtype=dtype)
+    for i in range(experiment.nb_of_point):
+        IsIr=experiment.sample_images[i]/reference_images[i]
+        LHS[i]=1-IsIr
+
+#    Solving system for each pixel, the matrices only depend on the reference images
+    solution, condition=solve_reference_systems("MISTII_1", reference_images, (pixSize, dtype.name), lambda: referenceSystemMISTII_1(reference_images, pixSize, dtype), LHS, [1,1,1,1], "Solving MISTII_1 system")
+
+    return np.concatenate((solution, condition[np.newaxis]))
+
+
+def MISTII_1(experiment, solution=None):
     """
     Calculates the tensors of the dark field and the thickness of a phase object from the acquisitions
+    The solution of the system (solveMISTII_1) can be given to skip the solve stage.
     """
-        
-    Nz, Nx, Ny=experiment.reference_images.shape
+    if solution is None:
+        solution=solveMISTII_1(experiment)
+
+    _, Nx, Ny=solution.shape
     beta=experiment.beta
     gamma_mat=experiment.delta/beta
     distSampDet=experiment.dist_object_detector
@@ -32,42 +89,6 @@ def MISTII_1(experiment):
     Lambda=1.2398/experiment.energy*1e-9
     k=experiment.getk()
     
-    LHS=np.ones(((experiment.nb_of_point, Nx, Ny)))
-    RHS=np.ones((((experiment.nb_of_point,4, Nx, Ny))))
-    FirstTermRHS=np.ones((Nx,Ny))
-    solution=np.ones(((4, Nx, Ny)))
-    
-    #Prepare system matrices
-    for i in range(experiment.nb_of_point):
-        #Left hand Side
-        IsIr=experiment.sample_images[i]/experiment.reference_images[i]
-        
-        #Right handSide
-        gX_IrIr,gY_IrIr=np.gradient(experiment.reference_images[i],pixSize )
-        gXX_IrIr,gYX_IrIr=np.gradient(gX_IrIr,pixSize)
-        gXY_IrIr,gYY_IrIr=np.gradient(gY_IrIr,pixSize)
-        
-        gXX_IrIr=gXX_IrIr/experiment.reference_images[i]
-        gXY_IrIr=gXY_IrIr/experiment.reference_images[i]
-        gYX_IrIr=gYX_IrIr/experiment.reference_images[i]
-        gYY_IrIr=gYY_IrIr/experiment.reference_images[i]
-        
-        RHS[i]=[FirstTermRHS,gXX_IrIr, gYY_IrIr,gXY_IrIr]
-        LHS[i]=1-IsIr
-        
-#    Solving system for each pixel 
-    for i in range(Nx):
-        for j in range(Ny):
-            a=RHS[:,:,i,j]
-            b=LHS[:,i,j]
-            Q,R = np.linalg.qr(a) # qr decomposition of A
-            if R[2,2]==0 or R[1,1]==0 or R[0,0]==0 or R[3,3]==0:
-                temp=[1,1,1,1]
-            else:
-                Qb = np.dot(Q.T,b) # computing Q^T*b (project b onto the range of A)
-                temp = np.linalg.solve(R,Qb) # solving R*x = Q^T*b
-                solution[:,i,j]=temp
-            
     G1=solution[0]
     G2=solution[1]
     G3=solution[2]
@@ -179,14 +200,17 @@ def std_normalize(image, n_std=3, no_min=False):
     image=np.clip(image, 0, 1)
     return image
 
-def processProjectionMISTII_1(experiment):
+def processProjectionMISTII_1(experiment, solution=None):
     """
     This function calls PavlovDirDF to compute the tensors of the directional dark field and the phase of the sample
     The function should also convert the tensor into a coloured image
+    The solution of the system (solveMISTII_1) can be given to only redo the post-processing.
     """
     Nx, Ny=experiment.sample_images[0].shape
+    if solution is None:
+        solution=solveMISTII_1(experiment)
     #Calculate directional darl field
-    phi, Deff_xx,Deff_yy,Deff_xy=MISTII_1(experiment)
+    phi, Deff_xx,Deff_yy,Deff_xy=MISTII_1(experiment, solution)
     
     a11=(Deff_xy*Deff_yy)
     a22=(Deff_xy*Deff_xx)
@@ -233,14 +257,15 @@ def processProjectionMISTII_1(experiment):
     
     #Median filter
     medFiltSize=experiment.MIST_median_filter
-    if medFiltSize!=0:
-        phi=median_filter(phi, medFiltSize)
-        Deff_xx=median_filter(Deff_xx, medFiltSize)
-        Deff_yy=median_filter(Deff_yy, medFiltSize)
-        Deff_xy=median_filter(Deff_xy, medFiltSize)
-    if medFiltSize!=0:
-        area=median_filter(area, medFiltSize)
-        excentricity=median_filter(excentricity, medFiltSize)
+    with timed_stage("median filter"):
+        if medFiltSize!=0:
+            phi=median_filter(phi, medFiltSize)
+            Deff_xx=median_filter(Deff_xx, medFiltSize)
+            Deff_yy=median_filter(Deff_yy, medFiltSize)
+            Deff_xy=median_filter(Deff_xy, medFiltSize)
+        if medFiltSize!=0:
+            area=median_filter(area, medFiltSize)
+            excentricity=median_filter(excentricity, medFiltSize)
     stdarea=np.std(area)
     area=abs(area)*1e3#/(3*stdarea)
     area[area>1]=1
@@ -253,33 +278,37 @@ def processProjectionMISTII_1(experiment):
     
     IntensityDeff=np.sqrt((Deff_xx**2+Deff_yy**2+Deff_xy**2)/3)
     
-    theta, sat=correctTheta(theta, medFiltSize*2)
-    theta=theta/np.pi
+    with timed_stage("colour composite"):
+        theta, sat=correctTheta(theta, medFiltSize*2)
+        theta=theta/np.pi
     
-    #Trying to create a coloured image from tensor (method probably wrong for now)
-    colouredImage=np.zeros(((Nx, Ny,3)))
-    colouredImage[:,:,0]=Deff_xx
-    colouredImage[:,:,1]=Deff_yy
-    colouredImage[:,:,2]=abs(Deff_xy)
+        #Trying to create a coloured image from tensor (method probably wrong for now)
+        colouredImage=np.zeros(((Nx, Ny,3)))
+        colouredImage[:,:,0]=Deff_xx
+        colouredImage[:,:,1]=Deff_yy
+        colouredImage[:,:,2]=abs(Deff_xy)
     
-    colouredImageExc=np.zeros(((Nx, Ny,3)))
-    colouredImageExc[:,:,0]=theta
-    colouredImageExc[:,:,1]=sat
-    colouredImageExc[:,:,2]=std_normalize(excentricity,no_min=True)
+        colouredImageExc=np.zeros(((Nx, Ny,3)))
+        colouredImageExc[:,:,0]=theta
+        colouredImageExc[:,:,1]=sat
+        colouredImageExc[:,:,2]=std_normalize(excentricity,no_min=True)
     
-    colouredImagearea=np.zeros(((Nx, Ny,3)))
-    colouredImagearea[:,:,0]=theta
-    colouredImagearea[:,:,1]=sat#area 
-    colouredImagearea[:,:,2]=std_normalize(area,no_min=True)
+        colouredImagearea=np.zeros(((Nx, Ny,3)))
+        colouredImagearea[:,:,0]=theta
+        colouredImagearea[:,:,1]=sat#area 
+        colouredImagearea[:,:,2]=std_normalize(area,no_min=True)
     
-    colouredImageDir=np.zeros(((Nx, Ny,3)))
-    colouredImageDir[:,:,0]=theta
-    colouredImageDir[:,:,1]=sat 
-    colouredImageDir[:,:,2]=std_normalize(IntensityDeff,no_min=True) #1-np.exp(-IntensityDeff) 
+        colouredImageDir=np.zeros(((Nx, Ny,3)))
+        colouredImageDir[:,:,0]=theta
+        colouredImageDir[:,:,1]=sat 
+        colouredImageDir[:,:,2]=std_normalize(IntensityDeff,no_min=True) #1-np.exp(-IntensityDeff) 
     
-    colouredImageExc=hsv_to_rgb(colouredImageExc)
-    colouredImagearea=hsv_to_rgb(colouredImagearea)
-    colouredImageDir=hsv_to_rgb(colouredImageDir)
+        colouredImageExc=hsv_to_rgb(colouredImageExc)
+        colouredImagearea=hsv_to_rgb(colouredImagearea)
+        colouredImageDir=hsv_to_rgb(colouredImageDir)
     
 
-    return {'phi': phi, 'Deff_xx': Deff_xx, 'Deff_yy': Deff_yy, 'Deff_xy': Deff_xy, 'excentricity': excentricity,'area':area, 'oriented_DF_exc': colouredImageExc, 'oriented_DF_area': colouredImagearea, 'oriented_DF_norm':colouredImageDir, 'theta':theta, 'local_orientation_strength':sat}
+    result={'phi': phi, 'Deff_xx': Deff_xx, 'Deff_yy': Deff_yy, 'Deff_xy': Deff_xy, 'excentricity': excentricity,'area':area, 'oriented_DF_exc': colouredImageExc, 'oriented_DF_area': colouredImagearea, 'oriented_DF_norm':colouredImageDir, 'theta':theta, 'local_orientation_strength':sat}
+    if getattr(experiment, "condition_map", False):
+        result['log_condition']=log_condition(solution[4])
+    return result
@@ -8,47 +8,71 @@ Created on Mon Mar 15 13:46:27 2021.
 import numpy as np
 from . import frankoChellappa as fc
 from . import fourier_integration, ls_integration
+from .batched_lstsq import BLOCK_PIXELS, log_condition, solve_pixel_systems
+from .derivatives import gradient
+from ..pipeline._shared import run_row_blocks
 
-def LCS(experiment):
+
+def solveRowsLCS(inputs, outputs, rowStart, rowStop):
+    """Solves the reverse flow LCS system of the pixels of the rows rowStart to rowStop.
+
+    The gradients are taken on the rows with one more row on each side, so
+    that they are the ones of the full images.
+
+    Args:
+        inputs (dict): 'sample' and 'reference' images (nb_of_point x Ny x Nx).
+        outputs (dict): 'solution' (3 x Ny x Nx) and 'condition' (Ny x Nx), whose rows are written.
+        rowStart, rowStop (int): rows to solve.
+
+    """
+    sample=inputs['sample']
+    reference=inputs['reference']
+    Nz, Ny, Nx=reference.shape
+    top=max(0, rowStart-1)
+    bottom=min(Ny, rowStop+1)
+    rows=slice(rowStart-top, rowStop-top)
+
+    LHS=np.ones(((Nz, rowStop-rowStart, Nx)), dtype=outputs['solution'].dtype)
+    RHS=np.ones((((Nz,3, rowStop-rowStart, Nx))), dtype=outputs['solution'].dtype)
+
+    #Prepare system matrices
+    #Right handSide
+    gY_IrIr,gX_IrIr=gradient(sample[:, top:bottom])
+    RHS[:,0]=reference[:, rowStart:rowStop]
+    RHS[:,1]=gY_IrIr[:, rows]
+    RHS[:,2]=gX_IrIr[:, rows]
+    LHS[:]=sample[:, rowStart:rowStop]
+
+    #Solving system for each pixel
+    outputs['solution'][:, rowStart:rowStop], outputs['condition'][rowStart:rowStop]=solve_pixel_systems(RHS, LHS, [1,0,0])
+
+
+def LCS(experiment, workers=None):
     """Calculates the displacement images from sample and reference images using the LCS system
     
 
     Args:
         experiment (PhaseRetrievalClass): class with all parameters as attributes.
+        workers (int): number of processes solving blocks of rows, all the cores by default.
 
     Returns:
         Dx (NUMPY ARRAY): the displacements along x axis (h).
         Dy (NUMPY ARRAY): the displacements along y axis (v).
         absoprtion (NUMPY ARRAY): the absorption.
+        condition (NUMPY ARRAY): the condition number estimate of the system of each pixel.
 
     """
 
     Nz, Ny, Nx=experiment.reference_images.shape
-    LHS=np.ones(((experiment.nb_of_point, Ny, Nx)))
-    RHS=np.ones((((experiment.nb_of_point,3, Ny, Nx))))
-    solution=np.ones(((3, Ny, Nx)))
-
-    #Prepare system matrices
-    for i in range(experiment.nb_of_point):
-        #Right handSide
-        gY_IrIr,gX_IrIr=np.gradient(experiment.sample_images[i])
-        RHS[i]=[experiment.reference_images[i],gY_IrIr, gX_IrIr]
-        LHS[i]=experiment.sample_images[i]
-
-
-    #Solving system for each pixel 
-    for i in range(Ny):
-        for j in range(Nx):
-            a=RHS[:,:,i,j]
-            b=LHS[:,i,j]
-            Q,R = np.linalg.qr(a) # qr decomposition of A
-            Qb = np.dot(Q.T,b) # computing Q^T*b (project b onto the range of A)
-            
-            if R[2,2]==0 or R[1,1]==0 or R[0,0]==0:
-                temp=[1,0,0]
-            else:
-                temp = np.linalg.solve(R,Qb) # solving R*x = Q^T*b
-            solution[:,i,j]=temp
+    dtype=experiment.get_dtype()
+    inputs={'sample': experiment.sample_images[:experiment.nb_of_point], 'reference': experiment.reference_images[:experiment.nb_of_point]}
+    outputs={'solution': ((3, Ny, Nx), dtype), 'condition': ((Ny, Nx), dtype)}
+
+    #Solving system for each pixel, by blocks of rows shared between the processes
+    rowsPerBlock=max(1, BLOCK_PIXELS//Nx)
+    results=run_row_blocks(solveRowsLCS, inputs, outputs, Ny, rowsPerBlock, workers, "Solving reverse flow LCS system")
+    solution=results['solution']
+    condition=results['condition']
         
     absoprtion=solution[0]
     Dy=-1*solution[1]
@@ -63,7 +87,7 @@ def LCS(experiment):
     Dy[Dy<-displacementLimit]=-displacementLimit
     Dy[Dy>displacementLimit]=displacementLimit
     
-    return Dx, Dy, absoprtion
+    return Dx, Dy, absoprtion, condition
 
 
 def processProjection_rLCS(experiment):
@@ -80,7 +104,7 @@ def processProjection_rLCS(experiment):
     """
     experiment.nb_of_point, Nx, Ny= experiment.sample_images.shape
     
-    dx, dy , absorption =LCS(experiment)
+    dx, dy , absorption, condition =LCS(experiment)
 
     # Compute the phase gradient from displacements (linear relationship)
     # magnification=(experiment['distSO']+experiment['distOD'])/experiment['distSO'] #Not sure I need to use this yet
@@ -112,7 +136,10 @@ def processProjection_rLCS(experiment):
         phiK = phiK[padSize:padSize + Nx , padSize:padSize + Ny]
         #phiLS = phiLS[padSize:padSize + Nx, padSize:padSize + Ny]
 
-    return {'dx': dx, 'dy': dy, 'phiFC': phiFC.real, 'phiK': phiK, 'absorption':absorption} #,'phiLS': phiLS
+    result={'dx': dx, 'dy': dy, 'phiFC': phiFC.real, 'phiK': phiK, 'absorption':absorption} #,'phiLS': phiLS
+    if getattr(experiment, "condition_map", False):
+        result['log_condition']=log_condition(condition)
+    return result
             
     
 
@@ -1,20 +1,61 @@
+import math
 import numpy as np
-import multiprocessing as mp
-from itertools import product, chain
+from scipy.interpolate import RegularGridInterpolator
 from scipy.ndimage import map_coordinates
 from functools import partial
-from scipy.ndimage import median_filter
+from scipy.ndimage import gaussian_filter, median_filter
 from . import frankoChellappa as fc
 from . import fourier_integration, ls_integration
-from numba import jit
+from .correlation import PearsonSearch, pearson_maps
+from .subpixel import paraboloid_peaks, peak_neighbourhoods
+
+from ..pipeline._experiment import XSVT_SEARCHES
+from ..pipeline._progress import progress
+from ..pipeline._shared import run_row_blocks
+from ..pipeline._timing import timed_stage
+
+# Pixels tracked per task of the worker processes
+BLOCK_PIXELS = 4096
+# Correlation coefficients closer than this to the maximum of a map are equal
+PEAK_TOLERANCE = 1e-12
+# Guided search (guided_tracking): spacing of the seed pixels searched over all the shifts,
+# largest difference of the shifts searched with the displacement interpolated from the seeds,
+# correlation under which a peak is too weak to be trusted
+GUIDED_SEED_STEP = 8
+GUIDED_RADIUS = 2
+GUIDED_MIN_CORRELATION = 0.5
+# Pyramid search (pyramid_tracking): largest shift searched over all the shifts at the coarsest
+# level, smallest side of its images, standard deviation of the gaussian filter before each
+# downsampling, largest difference of the shifts searched with the upsampled displacement and
+# number of times a search is moved to a peak found on its border
+PYRAMID_COARSE_SHIFT = 3
+PYRAMID_MIN_SIZE = 16
+PYRAMID_SIGMA = 1.
+PYRAMID_RADIUS = 1
+PYRAMID_STEPS = 4
+# Correlation coefficients computed at once by search_pixels
+MAP_VALUES = 2**22
+
+
+def solveXSVT(experiment):
+    """
+    Speckle vector tracking of the sample images, the expensive stage of processProjectionXSVT.
 
+    :param experiment: gets all the information related to the desired experiment.
 
-def processProjectionXSVT(experiment):
+    Returns the tuple (dx, dy, transmission, darkfield) of start_tracking()
     """
-    Calls start_tracking() which manages the calling of speckle_vector_tracking().
+    return start_tracking(experiment.sample_images, experiment.reference_images, max_shift=experiment.max_shift, window=1+2*experiment.XSVT_Nw,
+                          search=getattr(experiment, "XSVT_search", XSVT_SEARCHES[0]))
+
+
+def processProjectionXSVT(experiment, solution=None):
+    """
+    Calls solveXSVT(), the speckle vector tracking of start_tracking().
     Applies median filter if required and performs integration of displacement images.
 
     :param experiment: gets all the information related to the desired experiment.
+    :param solution: output of solveXSVT(), to only redo the post-processing.
 
     Returns:
         Diff_x: displacement in x (horizontal)(in terms of pixels)
@@ -26,11 +67,14 @@ def processProjectionXSVT(experiment):
     """
 
     nb_images, px_rows, px_cols = experiment.sample_images.shape
-    diff_x, diff_y, transmission, darkfield = start_tracking(experiment.sample_images, experiment.reference_images, max_shift=experiment.max_shift, window=1+2*experiment.XSVT_Nw)
+    if solution is None:
+        solution = solveXSVT(experiment)
+    diff_x, diff_y, transmission, darkfield = solution
 
-    if experiment.XSVT_median_filter != 0:
-        diff_x = median_filter(diff_x, size=experiment.XSVT_median_filter)
-        diff_y = median_filter(diff_y, size=experiment.XSVT_median_filter)
+    with timed_stage("median filter"):
+        if experiment.XSVT_median_filter != 0:
+            diff_x = median_filter(diff_x, size=experiment.XSVT_median_filter)
+            diff_y = median_filter(diff_y, size=experiment.XSVT_median_filter)
 
     # Convert the displacement (pixels) to phase gradient (m-1)
     dphix = diff_x * experiment.getk() * (experiment.pixel / experiment.dist_object_detector)
@@ -48,8 +92,9 @@ def processProjectionXSVT(experiment):
     # The sampling step for the gradient is the magnified pixel size
     magnificationFactor = (experiment.dist_object_detector + experiment.dist_source_object) / experiment.dist_source_object
     gradientSampling = experiment.pixel / magnificationFactor    
-    phiFC = fc.frankotchellappa(dphix, dphiy, True) * gradientSampling
-    phiK = fourier_integration.fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
+    with timed_stage("integrate"):
+        phiFC = fc.frankotchellappa(dphix, dphiy, True) * gradientSampling
+        phiK = fourier_integration.fourier_solver(dphix, dphiy, gradientSampling, gradientSampling, solver='kottler')
     #phiLS = ls_integration.least_squares(dphix, dphiy, gradientSampling, gradientSampling, model='southwell')
 
     if (padForIntegration and padSize > 0):
@@ -60,32 +105,36 @@ def processProjectionXSVT(experiment):
     return {"dx": diff_x, "dy": diff_y, "Absorption": transmission, "Deff": darkfield, 'phiFC': phiFC, 'phiK': phiK} #, 'phiLS': phiLS}#
 
 
-def start_tracking(Isample, Iref, max_shift, window):
+def start_tracking(Isample, Iref, max_shift, window, workers=None, search=XSVT_SEARCHES[0]):
     """
     Compare speckle images with sample (Isample) and w/o sample
     (Iref) pixel by pixel.
     Find maximum correlation using Pearson's correlation coefficient and produce maps of local displacement.
     max_shift can be set to the number of pixels for an "acceptable"
     speckle displacement.
-    Option to use multiprocessing on all available cores.
+    The rows are tracked by blocks on the persistent process pool of
+    run_row_blocks: the padded images are put once in shared memory and the
+    workers write dx and dy straight into shared outputs. The guided search
+    (guided_tracking) only searches all the shifts for a grid of seed pixels,
+    the pyramid search (pyramid_tracking) for downsampled images; their pixels
+    are searched by blocks of rows on the same pool.
 
     :param Isample: A list  of measurements, with the sample aligned but speckles shifted
     :param Iref: A list of empty speckle measurements with the same displacement as Isample.
     :param max_shift: Do not allow shifts larger than this number of pixels
     :param window: window to consider when calculating the correlation
+    :param workers: number of processes, all the cores by default (1: in this process)
+    :param search: "full", "guided" or "pyramid" (see XSVT_SEARCHES)
 
     Returns dx, dy
     """
 
+    if search not in XSVT_SEARCHES:
+        raise ValueError(f"Unknown XSVT search {search!r}, expected one of {XSVT_SEARCHES}")
     print("Speckle vector tracking started")
 
     nb_images, px_rows, px_cols = Iref.shape
 
-    i = range(0, px_rows)
-    j = range(0, px_cols)
-
-    multiprocessing = True
-
     # pm = number of pixels in window surrounding the central pixel in each direction (up, down, left, right)
     pm = int((window - 1) / 2) if window >= 1 else 0
 
@@ -94,37 +143,20 @@ def start_tracking(Isample, Iref, max_shift, window):
     paddedIref = np.array([np.pad(Iref[im, :, :], max_shift + pm, 'edge') for im in range(0, nb_images)])
     paddedIsample = np.array([np.pad(Isample[im, :, :], pm, 'edge') for im in range(0, nb_images)])
 
-    # Multiprocessing will use all available cores
-    # speckle_vector_tracking() is dispatched to cores as they become available until end of loop
-    if multiprocessing:
-        print("Multiprocessing on: " + str(mp.cpu_count()) + " cores")
-        paramlist = list(product(i, j))
-        pool = mp.Pool(mp.cpu_count())
-        # Need to create partial function because multiprocessing.map only accepts one input parameter
-        pfunc = partial(speckle_vector_tracking, paddedIsample, paddedIref, max_shift, window)
-        result = pool.map(pfunc, paramlist)
-        dx = list(chain(*result))[0::2]
-        dy = list(chain(*result))[1::2]
-        #tr = list(chain(*result))[2::4]
-        #df = list(chain(*result))[3::4]
-        pool.close()
-    # If multiprocessing not used, simple for-loop is used
+    # A narrowed search only saves shifts when it is narrower than the full one
+    if search == "guided" and max_shift > GUIDED_RADIUS + 1:
+        dx, dy = guided_tracking(paddedIsample, paddedIref, px_rows, px_cols, max_shift, window, workers)
+    elif search == "pyramid" and max_shift > PYRAMID_COARSE_SHIFT:
+        dx, dy = pyramid_tracking(Isample, Iref, max_shift, window, workers)
     else:
-        print("Multiprocessing off")
-        dx = []
-        dy = []
-        #tr = []
-        #df = []
-
-        for a, b in product(i, j):
-            results = speckle_vector_tracking(paddedIsample, paddedIref, max_shift, window, [a, b])
-            dx.append(results[0])
-            dy.append(results[1])
-            #tr.append(results[2])
-            #df.append(results[3])
-
-    dx = np.array(dx).reshape(px_rows, px_cols)
-    dy = np.array(dy).reshape(px_rows, px_cols)
+        # track_rows() is run on blocks of rows, dispatched to the workers as they become available
+        # (partial of a module function, so that the workers can import it)
+        outputs = {"dx": ((px_rows, px_cols), np.float64), "dy": ((px_rows, px_cols), np.float64)}
+        result = run_row_blocks(partial(track_rows, max_shift=max_shift, window=window),
+                                {"sample": paddedIsample, "reference": paddedIref}, outputs,
+                                px_rows, max(1, BLOCK_PIXELS // px_cols), workers, "Speckle vector tracking")
+        dx = result["dx"]
+        dy = result["dy"]
 
     tr,df = calc_tr_df(Iref,Isample,dy,dx)
 
@@ -136,172 +168,232 @@ def start_tracking(Isample, Iref, max_shift, window):
     return dx, dy, tr, df
 
 
-def speckle_vector_tracking(sample_image, padded_ref_image, shift, w, params):
+def track_rows(inputs, outputs, row_start, row_stop, max_shift, window):
     """
-    Compare speckle images with sample (Isample) and w/o sample
-    (Iref) pixel by pixel.
-    Find maximum correlation using Pearson's correlation coefficient and produce maps of local displacement.
-    max_shift can be set to the number of pixels for an "acceptable"
-    speckle displacement.
-
-    :param sample_image: A list  of measurements, with the sample aligned but speckles shifted
-    :param padded_ref_image: A list of empty speckle measurements with the same displacement as Isample, padded
-    on each side with number of pixels = shift so that resulting image is of the same size as input images
-    :param shift: Number of pixels to consider when comparing sample_image with padded_ref_image
-    :param params: row, column
-    :param w: window
-
-    Returns diff_x, diff_y
+    Speckle vector tracking of the pixels of the rows row_start to row_stop,
+    written into outputs["dx"] and outputs["dy"] (see run_row_blocks). The
+    Pearson maps of all the pixels of the rows are computed at once
+    (pearson_maps), their cost does not depend on the window, and so are
+    their peaks (peak_displacements).
     """
+    pm = int((window - 1) / 2) if window > 1 else 0
+    sample = inputs["sample"][:, row_start:row_stop + 2 * pm]
+    reference = inputs["reference"][:, row_start:row_stop + 2 * (max_shift + pm)]
+    maps = pearson_maps(sample, reference, max_shift, window)
+    outputs["dx"][row_start:row_stop], outputs["dy"][row_start:row_stop] = peak_displacements(maps)
 
-    i = params[0]
-    j = params[1]
-
-    nb, rows, cols = padded_ref_image.shape
-    roi = 2 * shift + 1
-    pm = int((w - 1) / 2) if w > 1 else 0
-
-    if j == 0:
-        try:
-            process = mp.current_process()
-            print("Process ID: " + str(process.name) + "; Row: " + str(i))
-        except:
-            print("Row: " + str(i))
-
-    # Sub-matrix of Isample intensity values with size window**2
-    roi_sample = sample_image[:, i:i+w, j:j+w]
-    # Sub-matrix of Iref intensity values with size (window+2*shift)**2
-    roi_ref = np.array(padded_ref_image[:, i:i+2*pm+roi, j:j+2*pm+roi])
-
-    # Determine the correlation between v_sample and each value in v_ref
-    pearson_map = compute_covariance(roi_ref,roi_sample,pm,w)
-
-    # Fit a polynomial surface to pearson_map and find the maximum correlation peak
-    # To avoid instabilities, the fit is performed only around the maximum, on a 3x3 ROI.
-    # The fine-tuning is limited to one pixel. Larger values imply a failure of the fit. 
-    maxcorr = np.unravel_index(np.argmax(pearson_map, axis=None), pearson_map.shape)
-    roixmin = define_roi(maxcorr[1],shift)
-    roiymin = define_roi(maxcorr[0],shift)
-    cropped_pearson = pearson_map[roiymin:roiymin+3,roixmin:roixmin+3]
-    
-    fit_params = polyfit2d(cropped_pearson)
-    dy_fit, dx_fit = find_max(fit_params) - (maxcorr-np.array([roiymin,roixmin]))
-    dy_fit, dx_fit = np.minimum([dy_fit, dx_fit],[0.55,0.55])
-    dy_fit, dx_fit = np.maximum([dy_fit, dx_fit],[-0.55,-0.55])
-    diffy = dy_fit  + maxcorr[0]
-    diffx = dx_fit  + maxcorr[1]
 
-    # Give the shift in terms of displacement (in terms of pixels) of v_sample relative to v_ref
-    diff_x = ((pearson_map.shape[0]-1)/2. - diffx)
-    diff_y = ((pearson_map.shape[0]-1)/2. - diffy)
-
-    return diff_x, diff_y #, transn, dark
-
-
-@jit(nopython=True)
-def compute_covariance(roi_ref,roi_sample,pm,w):
-    pearson_map = np.zeros((roi_ref.shape[1] - 2*pm, roi_ref.shape[2] - 2*pm))
-    for l in range(roi_ref.shape[1] - 2*pm):
-        for m in range(roi_ref.shape[2] - 2*pm):
-            if np.std(roi_ref[:, l:l + w, m:m + w]) == 0 or np.std(roi_sample) == 0:
-                pearson_map[l][m] = 0.
-            else:
-                pearson_map[l][m] = nc(roi_sample, roi_ref[:, l:l + w, m:m + w])
-    return pearson_map
-
-@jit(nopython=True)
-def nc(x, y):
+def guided_tracking(paddedIsample, paddedIref, px_rows, px_cols, max_shift, window, workers=None):
     """
-    Calculate the Pearson correlation of two matrices, x and y. The Pearson correlation
-    coefficient lies between -1 and 1, where r = 1 means that x and y are the same,
-    r = -1 corresponds to inverse correlation and p = 0 means that there is no correlation
-    between x and y.
+    Speckle vector tracking searching all the shifts only for a grid of seed
+    pixels (every GUIDED_SEED_STEP pixels). The displacement fields being
+    smooth, the other pixels search the shifts within GUIDED_RADIUS of the
+    displacement interpolated from the seeds, and all the shifts only when
+    that peak cannot be trusted (see search_pixels). The window statistics
+    are computed once (PearsonSearch), each search is run by blocks of rows
+    on the process pool (search_image).
 
-    :param x: Matrix of intensity values corresponding to the window (i-(Nw-1)/2:i+(Nw-1)/2, j-(Nw-1)/2:j+(Nw-1)/2) of Isample
-    :param y: Matrix of intensity values corresponding to the window (i-(Nw-1)/2+m:i+(Nw-1)/2+m, j-(Nw-1)/2+l:j+(Nw-1)/2+l) of Iref
+    :param paddedIsample, paddedIref: images padded as in start_tracking
 
-    Returns r
+    Returns dx, dy
     """
-    xv = x - np.mean(x)
-    yv = y - np.mean(y)
-
-    r = np.sum(xv * yv) / np.sqrt(np.sum(xv**2) * np.sum(yv**2))
-    return r
-
-
-def polyfit2d(pmap):
+    search = PearsonSearch(paddedIsample, paddedIref, max_shift, window)
+
+    seed_rows = np.unique(np.append(np.arange(0, px_rows, GUIDED_SEED_STEP), px_rows - 1))
+    seed_cols = np.unique(np.append(np.arange(0, px_cols, GUIDED_SEED_STEP), px_cols - 1))
+    seeds = np.zeros((px_rows, px_cols), dtype=bool)
+    seeds[np.ix_(seed_rows, seed_cols)] = True
+    no_centres = np.zeros((px_rows, px_cols, 2), dtype=np.int64)
+    seed_dx, seed_dy, _ = search_image(search, seeds, no_centres, max_shift, workers, "Speckle vector tracking (seeds)")
+
+    # Shift at the centre of the search of each pixel, the opposite of its interpolated displacement
+    points = np.moveaxis(np.indices((px_rows, px_cols)), 0, -1)
+    centres = np.stack([RegularGridInterpolator((seed_rows, seed_cols), seed[np.ix_(seed_rows, seed_cols)])(points)
+                        for seed in (seed_dy, seed_dx)], axis=-1)
+    centres = np.clip(-np.rint(centres), -max_shift, max_shift).astype(np.int64)
+    dx, dy, found = search_image(search, ~seeds, centres, GUIDED_RADIUS, workers, "Speckle vector tracking")
+
+    # The seeds keep their full search
+    dx[seeds], dy[seeds], found[seeds] = seed_dx[seeds], seed_dy[seeds], True
+    lost = ~found
+    print(f"Guided search: {np.count_nonzero(lost)} of {found.size} pixels searched over all the shifts")
+    lost_dx, lost_dy, _ = search_image(search, lost, no_centres, max_shift, workers,
+                                       "Speckle vector tracking (full search)")
+    dx[lost], dy[lost] = lost_dx[lost], lost_dy[lost]
+
+    return dx, dy
+
+
+def pyramid_tracking(Isample, Iref, max_shift, window, workers=None):
     """
-    Fit a 2nd order polynomial surface (paraboloid) to the map of Pearson's correlation
-    coefficients (pmap) and return a list (a) containing the fit parameters.
-
-    Model: C(i, j) = a0*i*i + a1*j*j + a2*i*j + a3*i + a4*j + a5
+    Speckle vector tracking from coarse to fine. The images are filtered and
+    downsampled by 2 until max_shift, halved at each level, is at most
+    PYRAMID_COARSE_SHIFT. All the shifts are searched at the coarsest level
+    only; at each finer level, the pixels search the shifts within
+    PYRAMID_RADIUS of the displacement of the coarser level, upsampled, and
+    search again around the peak when it is on the border of those shifts.
+    The shifts searched per pixel no longer grow with max_shift. Each search
+    is run by blocks of rows on the process pool (search_image).
 
-    where (i, j) are the rows and columns in pmap.
+    :param Isample, Iref: the images, not padded
 
-    :param pmap: 2D array containing Pearson's correlation coefficients.
-
-    Returns a
+    Returns dx, dy
     """
-
-    i, j = np.indices(pmap.shape)
-    I = i.flatten()
-    J = j.flatten()
-    mf = pmap.flatten()
-
-    M = np.array([I ** 2, J ** 2, I * J, I, J, I * 0 + 1]).T
-    result = np.linalg.lstsq(M, mf,rcond=None)
-    a = result[0]
-
-    return a
+    pm = int((window - 1) / 2) if window >= 1 else 0
+    samples, references, shifts = [Isample], [Iref], [max_shift]
+    while shifts[-1] > PYRAMID_COARSE_SHIFT and min(samples[-1].shape[1:]) >= 2 * PYRAMID_MIN_SIZE:
+        samples.append(pyramid_level(samples[-1]))
+        references.append(pyramid_level(references[-1]))
+        shifts.append(math.ceil(shifts[-1] / 2))
+
+    dx = dy = None
+    for level in reversed(range(len(samples))):
+        shift = shifts[level]
+        px_rows, px_cols = samples[level].shape[1:]
+        search = PearsonSearch(np.pad(samples[level], ((0, 0), (pm, pm), (pm, pm)), 'edge'),
+                               np.pad(references[level], ((0, 0), (shift + pm, shift + pm), (shift + pm, shift + pm)), 'edge'),
+                               shift, window)
+        searched = np.ones((px_rows, px_cols), dtype=bool)
+        message = f"Speckle vector tracking (level {level})"
+        if dx is None:
+            dx, dy, _ = search_image(search, searched, np.zeros((px_rows, px_cols, 2), dtype=np.int64), shift, workers,
+                                     message)
+            continue
+
+        # The displacement of the coarser level at the position of each pixel, in pixels of this level
+        coordinates = np.indices((px_rows, px_cols)) / 2
+        dx, dy = (2 * map_coordinates(field, coordinates, order=1, mode='nearest') for field in (dx, dy))
+        for step in range(PYRAMID_STEPS + 1):
+            centres = np.clip(-np.rint(np.stack([dy, dx], axis=-1)), -shift, shift).astype(np.int64)
+            step_dx, step_dy, found = search_image(search, searched, centres, PYRAMID_RADIUS, workers, message,
+                                                   min_correlation=-np.inf)
+            dx[searched], dy[searched] = step_dx[searched], step_dy[searched]
+            searched &= ~found
+            if not searched.any():
+                break
+
+    return dx, dy
+
+
+def pyramid_level(images):
+    """
+    Next level of the gaussian pyramid of a stack of images: filtered, then one pixel out of 2 along each axis.
+    """
+    return gaussian_filter(np.asarray(images, dtype=float), (0, PYRAMID_SIGMA, PYRAMID_SIGMA))[:, ::2, ::2]
 
 
-def find_max(a):
+def search_image(search, searched, centres, radius, workers=None, message=None, min_correlation=GUIDED_MIN_CORRELATION):
     """
-    Find the coordinates (i0, j0) in terms of pixels of the maximum correlation peak from
-    the polynomial surface fit parameters.
+    search_pixels() of the pixels where searched is True, by blocks of rows on
+    the process pool of run_row_blocks (search_rows), as the full search. The
+    workers get the arrays of the search rather than computing them again.
 
-    :param a: List of polynomial surface fit parameters returned by polyfit2d()
+    :param search: PearsonSearch of the whole images
+    :param searched: pixels to search (rows x cols)
+    :param centres: shift (row, column) at the centre of the search of each pixel (rows x cols x 2)
 
-    Returns i0, j0
+    Returns diff_x, diff_y, found (rows x cols): NaN and False for the pixels not searched
     """
+    px_rows, px_cols = searched.shape
+    outputs = {"dx": ((px_rows, px_cols), np.float64), "dy": ((px_rows, px_cols), np.float64),
+               "found": ((px_rows, px_cols), bool)}
+    result = run_row_blocks(partial(search_rows, radius=radius, max_shift=search.max_shift, window=search.window,
+                                    min_correlation=min_correlation),
+                            {**search.arrays(), "searched": searched, "centres": centres}, outputs, px_rows, max(1, BLOCK_PIXELS // px_cols), workers, message)
+    return result["dx"], result["dy"], result["found"]
 
-    #If the quadratic terms are zero, the fit won't find a stationary point.
-    #We set the maximum to (1,1) to introduce no correction to argmax.
-    denominator = (4*a[0]*a[1] - a[2]**2)
-    if(denominator==0):
-        i0 = j0 = 1
-    else:    
-        j0 = ((a[2]*a[3]) - (2*a[0]*a[4])) / denominator
-        i0 = ((a[2] * a[4]) - (2 * a[1] * a[3])) / denominator
 
-    return i0, j0
+def search_rows(inputs, outputs, row_start, row_stop, radius, max_shift, window, min_correlation):
+    """
+    search_pixels() of the searched pixels of the rows row_start to row_stop,
+    written into outputs["dx"], outputs["dy"] and outputs["found"] (see run_row_blocks).
+    """
+    outputs["dx"][row_start:row_stop] = np.nan
+    outputs["dy"][row_start:row_stop] = np.nan
+    outputs["found"][row_start:row_stop] = False
+    rows, cols = np.nonzero(inputs["searched"][row_start:row_stop])
+    if len(rows) == 0:
+        return
+    search = PearsonSearch.from_arrays(inputs, max_shift, window, row_start, row_stop)
+    diff_x, diff_y, found = search_pixels(search, rows, cols, inputs["centres"][row_start:row_stop][rows, cols], radius,
+                                          min_correlation=min_correlation)
+    outputs["dx"][row_start + rows, cols] = diff_x
+    outputs["dy"][row_start + rows, cols] = diff_y
+    outputs["found"][row_start + rows, cols] = found
+
+
+def search_pixels(search, rows, cols, centres, radius, message=None, min_correlation=GUIDED_MIN_CORRELATION):
+    """
+    Displacement of some pixels from the peak of their correlation with the shifts
+    within radius of their centre (see correlation.PearsonSearch).
 
-def calc_transmission(vs, vr):
+    Returns diff_x, diff_y and found: False where the peak cannot be trusted, as
+    it is on the border of the searched shifts (the maximum may be beyond), next
+    to shifts larger than max_shift, or weaker than min_correlation.
     """
-    Calculate the transmission image.
+    diff_x = np.empty(len(rows))
+    diff_y = np.empty(len(rows))
+    found = np.empty(len(rows), dtype=bool)
+    chunk = max(1, MAP_VALUES // (2 * radius + 1)**2)
+    for start in range(0, len(rows), chunk):
+        if message is not None:
+            progress(message, start / len(rows))
+        pixels = slice(start, start + chunk)
+        maps = search.maps_around(rows[pixels], cols[pixels], centres[pixels], radius)
+        peaks = integer_peaks(maps)
+        neighbourhoods = peak_neighbourhoods(maps, peaks)[1]
+        found[pixels] = (((peaks > 0) & (peaks < 2 * radius)).all(axis=1) & np.isfinite(neighbourhoods).all(axis=(1, 2))
+                         & (maps.max(axis=(1, 2)) >= min_correlation))
+        with np.errstate(invalid='ignore'):
+            map_dx, map_dy = peak_displacements(np.moveaxis(maps, 0, -1))
+        # No fit next to the shifts larger than max_shift: the integer peak
+        map_dx = np.where(np.isfinite(map_dx), map_dx, radius - peaks[:, 1])
+        map_dy = np.where(np.isfinite(map_dy), map_dy, radius - peaks[:, 0])
+        # The displacements of the maps are relative to their centre
+        diff_x[pixels] = map_dx - centres[pixels, 1]
+        diff_y[pixels] = map_dy - centres[pixels, 0]
+    return diff_x, diff_y, found
+
+
+def peak_displacements(maps):
+    """
+    Displacement of the sample speckles relative to the reference ones, from the
+    maximum of the map of Pearson's correlation coefficients of all the shifts of each pixel.
 
-    :param vs: vector of sample intensity values
-    :param vr: vector of reference intensity values (shifted corresponding to max correlation)
+    :param maps: (2*shift+1)**2 correlation coefficients for each pixel, of any shape ((2*shift+1) x (2*shift+1) x ...)
 
-    Returns np.mean(vs) / np.mean(vr) => transmission image
+    Returns diff_x, diff_y, of the shape of the pixels
     """
 
-    return np.mean(vs) / np.mean(vr)
+    roi = maps.shape[0]
+    pixels_shape = maps.shape[2:]
+    maps = np.moveaxis(maps.reshape(roi, roi, -1), -1, 0)
 
+    # Fit a polynomial surface to each map and find the maximum correlation peak
+    # To avoid instabilities, the fit is performed only around the maximum, on a 3x3 ROI.
+    # The fine-tuning is limited to one pixel. Larger values imply a failure of the fit.
+    maxcorr = integer_peaks(maps)
+    centres, neighbourhoods = peak_neighbourhoods(maps, maxcorr)
+    offsets = paraboloid_peaks(neighbourhoods)[0]
+    fit = np.clip(offsets + centres - maxcorr, -0.55, 0.55)
+    diffy, diffx = (fit + maxcorr).T
 
-def calc_df(tr, vs, vr):
-    """
-    Calculate the darkfield image.
+    # Give the shift in terms of displacement (in terms of pixels) of v_sample relative to v_ref
+    diff_x = (roi - 1) / 2. - diffx
+    diff_y = (roi - 1) / 2. - diffy
 
-    :param tr: vector of transmission values
-    :param vs: vector of sample intensity values
-    :param vr: vector of reference intensity values (shifted corresponding to max correlation)
+    return diff_x.reshape(pixels_shape), diff_y.reshape(pixels_shape)
 
-    Returns (1/tr) * np.std(vs) / np.std(vr) => darkfield image
-    """
-
-    return (1/tr) * np.std(vs) / np.std(vr)
 
+def integer_peaks(maps):
+    """
+    Position (row, column) of the maximum of each map (pixels x rows x columns), pixels x 2.
+    """
+    # Shifts within rounding errors of the maximum are ties (e.g. identical windows in the padding
+    # of the images), the first one is taken as np.argmax does for exact ties
+    flat_maps = maps.reshape(len(maps), -1)
+    ties = flat_maps >= flat_maps.max(axis=1, keepdims=True) - PEAK_TOLERANCE
+    return np.stack(np.unravel_index(np.argmax(ties, axis=1), maps.shape[1:]), axis=1)
 
 
 def calc_tr_df(Iref,Isample,dy,dx):
@@ -316,15 +408,5 @@ def calc_tr_df(Iref,Isample,dy,dx):
 
     return tr,df
 
-def define_roi(index,shift):
-
-    if index==0:
-        ind_min=0
-    elif index == (2*shift):
-        ind_min = 2*(shift-1)
-    else:
-        ind_min = index-1
-    return ind_min
-
 def plot_pmap():
     return
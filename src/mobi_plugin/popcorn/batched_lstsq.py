@@ -0,0 +1,214 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Least squares solve of the small linear system of every pixel at once.
+
+The LCS and MIST methods solve, for each pixel, an overdetermined system
+a x = b with a of shape (nb_of_point, nb_of_variables). Instead of one QR
+decomposition per pixel in Python loops, the systems of a block of pixels
+are stacked in a (pixels, nb_of_point, nb_of_variables) array and given to
+the batched numpy QR and solve, which run the same LAPACK routines per pixel.
+
+Along with the solution, each solve returns an estimate of the condition
+number of the system of every pixel, once its columns are scaled to unit
+norm (the scaling of the unknowns does not change the accuracy of the
+solution, only its units). The systems too ill-conditioned to be solved in
+the working precision (condition number above 1/eps) are given the fallback
+solution, with one mask for the whole block.
+"""
+import numpy as np
+from ..pipeline._progress import progress
+
+# Pixels solved per block, to bound the memory of the stacked systems
+BLOCK_PIXELS = 65536
+
+
+def max_condition(dtype):
+    """Largest condition number of a system solvable in dtype (1/eps)."""
+    return 1 / np.finfo(dtype).eps
+
+
+def log_condition(condition):
+    """log10 of a condition number map, the image shown as the condition layer of the methods."""
+    with np.errstate(divide='ignore'):
+        return np.log10(condition)
+
+
+def triangular_condition(R):
+    """Condition number estimate of the matrices a = QR with unit norm columns, from their R.
+
+    Each diagonal element of R is divided by the norm of its column (the
+    norm of the column of a), the ratio of the largest to the smallest is
+    then a lower bound of the condition number of the scaled a, cheap
+    compared to its singular values. It is inf for rank deficient matrices.
+
+    Args:
+        R (NUMPY ARRAY): upper triangular matrices (pixels x nb_of_variables x nb_of_variables).
+
+    Returns:
+        NUMPY ARRAY: the condition number estimate of each pixel.
+    """
+    norms = np.sqrt(np.einsum('pij,pij->pj', R, R))
+    # A null column makes the matrix rank deficient: its diagonal element is 0
+    diagonal = np.zeros_like(norms)
+    np.divide(np.abs(np.diagonal(R, axis1=1, axis2=2)), norms, out=diagonal, where=norms > 0)
+    largest, smallest = diagonal.max(axis=1), diagonal.min(axis=1)
+    condition = np.full_like(largest, np.inf)
+    np.divide(largest, smallest, out=condition, where=smallest > 0)
+    return condition
+
+
+def solve_pixel_systems(RHS, LHS, fallback, message=None, block_pixels=BLOCK_PIXELS):
+    """Solves a x = b in the least squares sense for each pixel, by QR decomposition.
+
+    Args:
+        RHS (NUMPY ARRAY): the matrices a of the pixels (nb_of_point x nb_of_variables x Ny x Nx).
+        LHS (NUMPY ARRAY): the vectors b of the pixels (nb_of_point x Ny x Nx).
+        fallback (list): solution given to the pixels whose system is too ill-conditioned.
+        message (str): progress message, if any.
+        block_pixels (int): number of pixels solved at once.
+
+    Returns:
+        solution (NUMPY ARRAY): the unknowns of each pixel (nb_of_variables x Ny x Nx).
+        condition (NUMPY ARRAY): the condition number estimate of each pixel (Ny x Nx).
+
+    """
+    nb_of_point, nb_of_variables = RHS.shape[:2]
+    image_shape = RHS.shape[2:]
+    a_all = RHS.reshape(nb_of_point, nb_of_variables, -1)
+    b_all = LHS.reshape(nb_of_point, -1)
+    nb_of_pixels = a_all.shape[-1]
+    # Solved in the type of the matrices (float32 or float64)
+    dtype = np.result_type(RHS.dtype, np.float32)
+
+    solution = np.empty((nb_of_variables, nb_of_pixels), dtype=dtype)
+    solution[:] = np.asarray(fallback, dtype=dtype)[:, np.newaxis]
+    condition = np.empty(nb_of_pixels, dtype=dtype)
+
+    for start in range(0, nb_of_pixels, block_pixels):
+        if message is not None:
+            progress(message, start / nb_of_pixels)
+        stop = min(start + block_pixels, nb_of_pixels)
+        a = np.ascontiguousarray(a_all[:, :, start:stop].transpose(2, 0, 1), dtype=dtype)
+        b = np.ascontiguousarray(b_all[:, start:stop].T, dtype=dtype)
+        Q, R = np.linalg.qr(a) # qr decomposition of each pixel's A
+        Qb = np.einsum('pnk,pn->pk', Q, b) # computing Q^T*b (project b onto the range of A)
+
+        condition[start:stop] = triangular_condition(R)
+        solvable = condition[start:stop] < max_condition(dtype)
+        if solvable.any():
+            solution[:, start:stop][:, solvable] = np.linalg.solve(R[solvable], Qb[solvable][..., np.newaxis])[..., 0].T # solving R*x = Q^T*b
+
+    return solution.reshape((nb_of_variables,) + image_shape), condition.reshape(image_shape)
+
+
+def solve_normal_equations(AtA, Atb, fallback, message=None, block_pixels=BLOCK_PIXELS):
+    """Solves the normal equations (A^T A) x = A^T b of each pixel.
+
+    Used when the systems are accumulated one image at a time instead of
+    being stacked (see solve_LCS_DF_streaming), so that the memory does not
+    depend on the number of images.
+
+    Args:
+        AtA (NUMPY ARRAY): the Gram matrices of the pixels (nb_of_variables x nb_of_variables x Ny x Nx).
+        Atb (NUMPY ARRAY): the vectors A^T b of the pixels (nb_of_variables x Ny x Nx).
+        fallback (list): solution given to the pixels whose Gram matrix is too ill-conditioned.
+        message (str): progress message, if any.
+        block_pixels (int): number of pixels solved at once.
+
+    Returns:
+        solution (NUMPY ARRAY): the unknowns of each pixel (nb_of_variables x Ny x Nx), in float64
+        like the accumulated sums.
+        condition (NUMPY ARRAY): the condition number of the matrix A of each pixel with unit norm
+        columns (Ny x Nx), the square root of the one of its Gram matrix scaled to a unit diagonal.
+
+    """
+    nb_of_variables = AtA.shape[0]
+    image_shape = AtA.shape[2:]
+    gram_all = AtA.reshape(nb_of_variables, nb_of_variables, -1)
+    vector_all = Atb.reshape(nb_of_variables, -1)
+    nb_of_pixels = gram_all.shape[-1]
+
+    solution = np.empty((nb_of_variables, nb_of_pixels))
+    solution[:] = np.asarray(fallback, dtype=float)[:, np.newaxis]
+    condition = np.empty(nb_of_pixels)
+
+    for start in range(0, nb_of_pixels, block_pixels):
+        if message is not None:
+            progress(message, start / nb_of_pixels)
+        stop = min(start + block_pixels, nb_of_pixels)
+        gram = np.ascontiguousarray(gram_all[:, :, start:stop].transpose(2, 0, 1), dtype=float)
+        vector = np.ascontiguousarray(vector_all[:, start:stop].T, dtype=float)
+
+        # The scaled Gram matrices are symmetric: their condition number is the ratio of their extreme eigenvalues
+        finite = np.isfinite(gram).all(axis=(1, 2))
+        diagonal = np.diagonal(gram, axis1=1, axis2=2)
+        scaled = finite & (diagonal > 0).all(axis=1) # a null column makes the matrix singular
+        gram_condition = np.full(len(gram), np.inf)
+        gram_condition[~finite] = np.nan
+        if scaled.any():
+            scale = 1 / np.sqrt(diagonal[scaled])
+            eigenvalues = np.linalg.eigvalsh(gram[scaled] * scale[:, :, np.newaxis] * scale[:, np.newaxis, :])
+            with np.errstate(divide='ignore'):
+                gram_condition[scaled] = np.where(eigenvalues[:, 0] > 0, eigenvalues[:, -1] / eigenvalues[:, 0], np.inf)
+        condition[start:stop] = np.sqrt(gram_condition)
+        solvable = gram_condition < max_condition(float)
+        if solvable.any():
+            solution[:, start:stop][:, solvable] = np.linalg.solve(gram[solvable], vector[solvable][..., np.newaxis])[..., 0].T
+
+    return solution.reshape((nb_of_variables,) + image_shape), condition.reshape(image_shape)
+
+
+def pixel_pseudo_inverse(RHS, message=None, block_pixels=BLOCK_PIXELS):
+    """Pseudo-inverse R^-1 Q^T of the matrix a of each pixel, to solve several systems with the same matrices.
+
+    Args:
+        RHS (NUMPY ARRAY): the matrices a of the pixels (nb_of_point x nb_of_variables x Ny x Nx).
+        message (str): progress message, if any.
+        block_pixels (int): number of pixels factorized at once.
+
+    Returns:
+        pseudo_inverse (NUMPY ARRAY): pseudo-inverse of each pixel (pixels x nb_of_variables x nb_of_point),
+        0 where a is too ill-conditioned, in the type of the matrices.
+        condition (NUMPY ARRAY): the condition number estimate of each pixel (pixels).
+
+    """
+    nb_of_point, nb_of_variables = RHS.shape[:2]
+    a_all = RHS.reshape(nb_of_point, nb_of_variables, -1)
+    nb_of_pixels = a_all.shape[-1]
+    dtype = np.result_type(RHS.dtype, np.float32)
+
+    pseudo_inverse = np.zeros((nb_of_pixels, nb_of_variables, nb_of_point), dtype=dtype)
+    condition = np.empty(nb_of_pixels, dtype=dtype)
+    for start in range(0, nb_of_pixels, block_pixels):
+        if message is not None:
+            progress(message, start / nb_of_pixels)
+        stop = min(start + block_pixels, nb_of_pixels)
+        a = np.ascontiguousarray(a_all[:, :, start:stop].transpose(2, 0, 1), dtype=dtype)
+        Q, R = np.linalg.qr(a)
+        condition[start:stop] = triangular_condition(R)
+        solvable = condition[start:stop] < max_condition(dtype)
+        if solvable.any():
+            pseudo_inverse[start:stop][solvable] = np.linalg.solve(R[solvable], Q[solvable].transpose(0, 2, 1))
+
+    return pseudo_inverse, condition
+
+
+def apply_pseudo_inverse(pseudo_inverse, condition, LHS, fallback):
+    """Solves the systems of the pixels from their pseudo-inverse (see pixel_pseudo_inverse).
+
+    Args:
+        LHS (NUMPY ARRAY): the vectors b of the pixels (nb_of_point x Ny x Nx).
+        fallback (list): solution given to the pixels whose system is too ill-conditioned.
+
+    Returns:
+        solution (NUMPY ARRAY): the unknowns of each pixel (nb_of_variables x Ny x Nx).
+        condition (NUMPY ARRAY): the condition number estimate of each pixel (Ny x Nx).
+
+    """
+    nb_of_variables = pseudo_inverse.shape[1]
+    image_shape = LHS.shape[1:]
+    solution = np.einsum('pkn,np->kp', pseudo_inverse, LHS.reshape(LHS.shape[0], -1))
+    solvable = condition < max_condition(pseudo_inverse.dtype)
+    solution[:, ~solvable] = np.asarray(fallback, dtype=solution.dtype)[:, np.newaxis]
+    return solution.reshape((nb_of_variables,) + image_shape), condition.reshape(image_shape)
@@ -0,0 +1,209 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Pearson correlation maps of the speckle vector tracking (XSVT), for all the shifts and pixels at once.
+
+The correlation of the sample window of a pixel (window x window pixels of
+all the images, n values x) with the reference window shifted by (l, m)
+(values y) is
+
+    r = (Sxy - Sx Sy / n) / sqrt((Sxx - Sx^2 / n) (Syy - Sy^2 / n))
+
+with S the sums over the window. The sums of every window are read from
+summed-area tables (box_sums), so that their cost does not depend on the
+size of the window. Sx, Sxx, Sy and Syy are computed once; for each shift
+only Sxy is computed, from the product of the sample images with the
+shifted reference images. The images are centred first (r does not change),
+so that the sums lose less precision.
+
+PearsonSearch computes the correlations of a few shifts of some pixels
+only, from the same window sums.
+"""
+import numpy as np
+from numba import njit, prange
+
+# Windows whose variance is below this fraction of the variance of the images are flat: their correlation is 0
+FLAT_VARIANCE = 1e-10
+
+
+def box_sums(image, window):
+    """Sums of image over all its window x window windows, from its summed-area table.
+
+    Args:
+        image (NUMPY ARRAY): Ny x Nx image.
+        window (int): side of the windows.
+
+    Returns:
+        NUMPY ARRAY: the sum of the window starting at each pixel ((Ny - window + 1) x (Nx - window + 1)).
+    """
+    table = np.zeros((image.shape[0] + 1, image.shape[1] + 1))
+    np.cumsum(image, axis=0, out=table[1:, 1:])
+    np.cumsum(table[1:, 1:], axis=1, out=table[1:, 1:])
+    return table[window:, window:] - table[:-window, window:] - table[window:, :-window] + table[:-window, :-window]
+
+
+def window_statistics(images, window):
+    """Sums and variances (times n) of the values of each window of all the images.
+
+    Returns:
+        sums (NUMPY ARRAY): sum of each window.
+        variances (NUMPY ARRAY): sum of the squared deviations of each window, 0 if it is flat.
+    """
+    n = images.shape[0] * window**2
+    sums = box_sums(images.sum(axis=0), window)
+    variances = box_sums(np.einsum('kij,kij->ij', images, images), window) - sums**2 / n
+    variances[variances <= FLAT_VARIANCE * n * np.mean(images**2)] = 0
+    return sums, variances
+
+
+def pearson_maps(sample, reference, max_shift, window):
+    """Pearson correlation of each sample window with the reference windows of all the shifts.
+
+    The images are padded as in XSVT.start_tracking. The map of each pixel is
+    the Pearson correlation of its sample window with the reference windows
+    shifted by -max_shift to max_shift along each axis.
+
+    Args:
+        sample (NUMPY ARRAY): sample images padded by (window - 1) / 2 pixels
+        (nb_of_images x (rows + window - 1) x (cols + window - 1)).
+        reference (NUMPY ARRAY): reference images padded by max_shift + (window - 1) / 2 pixels.
+        max_shift (int): largest shift along each axis.
+        window (int): side of the windows.
+
+    Returns:
+        maps (NUMPY ARRAY): correlation of each shift (row shift, column shift) and pixel
+        ((2 max_shift + 1) x (2 max_shift + 1) x rows x cols), 0 where a window is flat.
+    """
+    sample = np.asarray(sample, dtype=float)
+    reference = np.asarray(reference, dtype=float)
+    sample = sample - sample.mean()
+    reference = reference - reference.mean()
+    n = sample.shape[0] * window**2
+    height, width = sample.shape[1:]
+    rows, cols = height - window + 1, width - window + 1
+    roi = 2 * max_shift + 1
+
+    sample_sums, sample_variances = window_statistics(sample, window)
+    reference_sums, reference_variances = window_statistics(reference, window)
+
+    maps = np.zeros((roi, roi, rows, cols))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for l in range(roi):
+            for m in range(roi):
+                products = box_sums(np.einsum('kij,kij->ij', sample, reference[:, l:l + height, m:m + width]), window)
+                covariance = products - sample_sums * reference_sums[l:l + rows, m:m + cols] / n
+                deviations = np.sqrt(sample_variances * reference_variances[l:l + rows, m:m + cols])
+                maps[l, m] = np.where(deviations > 0, covariance / deviations, 0.)
+    return maps
+
+
+class PearsonSearch:
+    """
+    Pearson correlations of a few shifts of some pixels, for searches narrowed
+    around a predicted displacement (XSVT guided search), where pearson_maps
+    would compute all the shifts of all the pixels.
+
+    The window sums and variances are computed once for the whole images
+    (window_statistics), so that each shift of a pixel only computes Sxy.
+    """
+
+    def __init__(self, sample, reference, max_shift, window):
+        """
+        Args:
+            sample, reference (NUMPY ARRAY): images padded as for pearson_maps.
+            max_shift (int): largest shift along each axis.
+            window (int): side of the windows.
+        """
+        sample = np.asarray(sample, dtype=float)
+        reference = np.asarray(reference, dtype=float)
+        sample = sample - sample.mean()
+        reference = reference - reference.mean()
+        self.max_shift = max_shift
+        self.window = window
+        self.sample_sums, self.sample_variances = window_statistics(sample, window)
+        self.reference_sums, self.reference_variances = window_statistics(reference, window)
+        # The values of all the images of a pixel next to each other, for the sums over the windows
+        self.sample = np.ascontiguousarray(np.moveaxis(sample, 0, -1))
+        self.reference = np.ascontiguousarray(np.moveaxis(reference, 0, -1))
+
+    ARRAYS = ("sample", "reference", "sample_sums", "sample_variances", "reference_sums", "reference_variances")
+
+    @classmethod
+    def from_arrays(cls, arrays, max_shift, window, row_start=0, row_stop=None):
+        """Search of the rows row_start to row_stop of the images of another search, from
+        its arrays (e.g. in shared memory for the workers) rather than computing them again.
+
+        Args:
+            arrays (dict): the arrays of the other search (arrays()).
+            max_shift (int), window (int): as for the other search.
+            row_start, row_stop (int): rows of the images searched, the pixel rows of the
+            new search start at row_start.
+        """
+        if row_stop is None:
+            row_stop = arrays["sample_sums"].shape[0]
+        search = cls.__new__(cls)
+        search.max_shift = max_shift
+        search.window = window
+        sample_rows = slice(row_start, row_stop + window - 1)
+        reference_rows = slice(row_start, row_stop + 2 * max_shift + window - 1)
+        search.sample = arrays["sample"][sample_rows]
+        search.reference = arrays["reference"][reference_rows]
+        search.sample_sums = arrays["sample_sums"][row_start:row_stop]
+        search.sample_variances = arrays["sample_variances"][row_start:row_stop]
+        search.reference_sums = arrays["reference_sums"][row_start:row_stop + 2 * max_shift]
+        search.reference_variances = arrays["reference_variances"][row_start:row_stop + 2 * max_shift]
+        return search
+
+    def arrays(self):
+        """Arrays of the search, for from_arrays()."""
+        return {name: getattr(self, name) for name in self.ARRAYS}
+
+    @property
+    def shape(self):
+        """Shape of the images tracked (rows x cols)."""
+        return self.sample_sums.shape
+
+    def maps_around(self, rows, cols, centres, radius):
+        """Correlation of the sample window of the pixels (rows, cols) with the reference
+        windows of the shifts within radius of their centre.
+
+        Args:
+            rows, cols (NUMPY ARRAY): the pixels (pixels).
+            centres (NUMPY ARRAY): shift (row, column) at the centre of the maps of each pixel
+            (pixels x 2), from -max_shift to max_shift.
+            radius (int): the maps cover the shifts centre - radius to centre + radius.
+
+        Returns:
+            maps (NUMPY ARRAY): correlation of each shift around the centre of each pixel
+            (pixels x (2 radius + 1) x (2 radius + 1)), -inf for the shifts larger than max_shift.
+        """
+        maps = np.empty((len(rows), 2 * radius + 1, 2 * radius + 1))
+        _maps_around(self.sample, self.reference, self.sample_sums, self.sample_variances, self.reference_sums,
+                     self.reference_variances, np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64),
+                     np.asarray(centres, dtype=np.int64), radius, self.max_shift, self.window, maps)
+        return maps
+
+
+@njit(parallel=True, cache=True)
+def _maps_around(sample, reference, sampleSums, sampleVariances, referenceSums, referenceVariances,
+                 rows, cols, centres, radius, max_shift, window, maps):
+    n = sample.shape[2] * window * window
+    for p in prange(len(rows)):
+        i, j = rows[p], cols[p]
+        for dl in range(2 * radius + 1):
+            for dm in range(2 * radius + 1):
+                l = max_shift + centres[p, 0] - radius + dl
+                m = max_shift + centres[p, 1] - radius + dm
+                if l < 0 or l > 2 * max_shift or m < 0 or m > 2 * max_shift:
+                    maps[p, dl, dm] = -np.inf
+                    continue
+                deviations = np.sqrt(sampleVariances[i, j] * referenceVariances[i + l, j + m])
+                if deviations == 0:
+                    maps[p, dl, dm] = 0.
+                    continue
+                products = 0.
+                for a in range(window):
+                    for b in range(window):
+                        for k in range(sample.shape[2]):
+                            products += sample[i + a, j + b, k] * reference[i + l + a, j + m + b, k]
+                maps[p, dl, dm] = (products - sampleSums[i, j] * referenceSums[i + l, j + m] / n) / deviations
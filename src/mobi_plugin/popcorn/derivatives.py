@@ -0,0 +1,110 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Derivatives of whole image stacks, shared by the solvers.
+
+The derivatives are taken along the last two axes of a (nb_of_point, Ny, Nx)
+stack (or of a single image) in one vectorized pass, instead of one image at
+a time. Each operator reproduces the values of the function the solvers used
+before:
+- derivative, gradient, second_derivatives: np.gradient (centred differences,
+  one-sided differences at the image edges);
+- laplacian: scipy.ndimage.laplace (image reflected at its edges);
+- wrapped_differences: the convolve2d of LCS_DirDF.myGradient (f[+1] - f[-1],
+  wrapping around the image).
+The outputs have the floating type of the input (float32 for the corrected
+images) or are written into preallocated arrays given as out.
+"""
+import numpy as np
+from scipy.ndimage import correlate1d
+
+
+def _output(stack, out):
+    if out is None:
+        return np.empty(np.shape(stack), dtype=np.result_type(np.asarray(stack).dtype, np.float32))
+    return out
+
+
+def derivative(stack, axis, spacing=1.0, out=None):
+    """Derivative of each image along axis (-2: y, -1: x), as np.gradient.
+
+    Args:
+        stack (NUMPY ARRAY): images (nb_of_point x Ny x Nx) or a single image.
+        axis (int): -2 or -1.
+        spacing (float): sampling step.
+        out (NUMPY ARRAY): where to write the derivative, if given.
+
+    Returns:
+        NUMPY ARRAY: the derivative, of the shape of stack.
+    """
+    stack = np.asarray(stack)
+    out = _output(stack, out)
+    f = np.moveaxis(stack, axis, -1)
+    o = np.moveaxis(out, axis, -1)
+    np.subtract(f[..., 2:], f[..., :-2], out=o[..., 1:-1])
+    o[..., 1:-1] /= 2. * spacing
+    np.subtract(f[..., 1], f[..., 0], out=o[..., 0])
+    o[..., 0] /= spacing
+    np.subtract(f[..., -1], f[..., -2], out=o[..., -1])
+    o[..., -1] /= spacing
+    return out
+
+
+def gradient(stack, spacing=1.0, out=None):
+    """Derivatives along y and x of each image, as np.gradient(image, spacing).
+
+    Args:
+        out (tuple): two arrays where to write the derivatives, if given.
+
+    Returns:
+        (NUMPY ARRAY, NUMPY ARRAY): the derivatives along y (axis -2) and x (axis -1).
+    """
+    out_y, out_x = out if out is not None else (None, None)
+    return derivative(stack, -2, spacing, out_y), derivative(stack, -1, spacing, out_x)
+
+
+def second_derivatives(stack, spacing=1.0):
+    """Second derivatives of each image, as the np.gradient of its np.gradient.
+
+    Returns:
+        (NUMPY ARRAY, NUMPY ARRAY, NUMPY ARRAY): the second derivatives along
+        y (yy), along x (xx) and the cross derivative (y of the x derivative).
+    """
+    first = derivative(stack, -2, spacing)
+    d_yy = derivative(first, -2, spacing)
+    first = derivative(stack, -1, spacing, out=first)
+    d_xx = derivative(first, -1, spacing)
+    d_yx = derivative(first, -2, spacing)
+    return d_yy, d_xx, d_yx
+
+
+def laplacian(stack, out=None):
+    """Laplacian of each image, as scipy.ndimage.laplace (mode reflect).
+
+    Returns:
+        NUMPY ARRAY: the laplacian, of the shape of stack.
+    """
+    stack = np.asarray(stack)
+    out = _output(stack, out)
+    weights = [1., -2., 1.]
+    correlate1d(stack, weights, axis=-2, output=out, mode='reflect')
+    out += correlate1d(stack, weights, axis=-1, output=out.dtype, mode='reflect')
+    return out
+
+
+def wrapped_differences(stack, out=None):
+    """Differences f[+1] - f[-1] along x and y of each image, wrapping around the image.
+
+    Args:
+        out (tuple): two arrays where to write the differences, if given.
+
+    Returns:
+        (NUMPY ARRAY, NUMPY ARRAY): the differences along x (axis -1) and y (axis -2).
+    """
+    stack = np.asarray(stack)
+    out_x, out_y = out if out is not None else (None, None)
+    out_x = _output(stack, out_x)
+    out_y = _output(stack, out_y)
+    correlate1d(stack, [-1., 0., 1.], axis=-1, output=out_x, mode='wrap')
+    correlate1d(stack, [-1., 0., 1.], axis=-2, output=out_y, mode='wrap')
+    return out_x, out_y
@@ -11,6 +11,13 @@ Main Function: fourier()
 '''
 
 import numpy as np
+import scipy.fft
+
+
+def fft_module(array):
+    # scipy.fft keeps single precision arrays in single precision (numpy.fft
+    # always computes in double precision), double precision is left to numpy.fft
+    return scipy.fft if np.asarray(array).dtype == np.float32 else np.fft
 
 def antisym(gx,gy):
     #Antisymmetrization of the gradient matrices as described in Bon et al, 2015
@@ -36,11 +43,12 @@ def kottler(gx,gy):
 
     #print("Kottler Solver")
 
-    Gx = np.fft.fft2(gx)
-    Gy = np.fft.fft2(gy)
+    fft = fft_module(gx)
+    Gx = fft.fft2(gx)
+    Gy = fft.fft2(gy)
 
-    fx=np.fft.fftfreq(np.shape(gx)[1])#,px)
-    fy=np.fft.fftfreq(np.shape(gx)[0])#,py)
+    fx=np.fft.fftfreq(np.shape(gx)[1]).astype(gx.dtype)#,px)
+    fy=np.fft.fftfreq(np.shape(gx)[0]).astype(gx.dtype)#,py)
     ffx,ffy = np.meshgrid(fx,fy)
 
     f_num = Gx + 1j * Gy
@@ -48,7 +56,7 @@ def kottler(gx,gy):
     #Set zero frequency to zero
     f_phase = f_num / f_den
     f_phase[0,0] = 0
-    phase = np.fft.ifft2(f_phase)
+    phase = fft.ifft2(f_phase)
 
     return np.real(phase)
 
@@ -59,11 +67,12 @@ def frankot_chellappa(gx,gy):
     # Input:  gx, gy : gradient along x (h) and y (v) respectively
     # Output: phase  : real part of the reconstructed ifft phase 
 
-    Gx = np.fft.fft2(gx)
-    Gy = np.fft.fft2(gy)
+    fft = fft_module(gx)
+    Gx = fft.fft2(gx)
+    Gy = fft.fft2(gy)
 
-    fx=np.fft.fftfreq(np.shape(gx)[1])
-    fy=np.fft.fftfreq(np.shape(gx)[0])
+    fx=np.fft.fftfreq(np.shape(gx)[1]).astype(gx.dtype)
+    fy=np.fft.fftfreq(np.shape(gx)[0]).astype(gx.dtype)
     ffx,ffy = np.meshgrid(fx,fy)
     ffx2,ffy2 = np.meshgrid(fx**2,fy**2)
 
@@ -72,7 +81,7 @@ def frankot_chellappa(gx,gy):
     #Set zero frequency to zero
     f_phase = f_num / f_den
     f_phase[0,0] = 0
-    phase = np.fft.ifft2(f_phase)
+    phase = fft.ifft2(f_phase)
 
     return np.real(phase)
 
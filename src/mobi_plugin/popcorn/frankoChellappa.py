@@ -267,22 +267,24 @@ def frankotchellappa(del_f_del_x, del_f_del_y, reflec_pad=True):
 
     """
 
-    from numpy.fft import fft2, ifft2, fftfreq
+    from numpy.fft import fftfreq
+    from .fourier_integration import fft_module
 
+    fft = fft_module(del_f_del_x)
     if reflec_pad:
         del_f_del_x, del_f_del_y = _reflec_pad_grad_fields(del_f_del_x,
                                                            del_f_del_y)
 
     NN, MM = del_f_del_x.shape
-    wx, wy = np.meshgrid(fftfreq(MM) * 2 * np.pi,
-                         fftfreq(NN) * 2 * np.pi, indexing='xy')
+    wx, wy = np.meshgrid((fftfreq(MM) * 2 * np.pi).astype(del_f_del_x.dtype),
+                         (fftfreq(NN) * 2 * np.pi).astype(del_f_del_x.dtype), indexing='xy')
     # by using fftfreq there is no need to use fftshift
 
-    numerator = -1j * wx * fft2(del_f_del_x) - 1j * wy * fft2(del_f_del_y)
+    numerator = -1j * wx * fft.fft2(del_f_del_x) - 1j * wy * fft.fft2(del_f_del_y)
 
     denominator = (wx) ** 2 + (wy) ** 2 + np.finfo(float).eps
 
-    res = ifft2(numerator / denominator)
+    res = fft.ifft2(numerator / denominator)
     res -= np.mean(np.real(res))
 
 
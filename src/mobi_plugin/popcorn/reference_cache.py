@@ -0,0 +1,223 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+What the solvers compute from the reference images only, kept for the next projections.
+
+In a scan, the reference images are the same for all the projections:
+- in MISTI, MISTII_1 and MISTII_2 the matrix of the system of each pixel is
+  built from the reference images, only the vector b depends on the sample,
+  so the systems are factorized once and each projection is solved with one
+  multiplication by the stored pseudo-inverses (ReferenceSystemCache), when
+  they fit in its memory budget;
+- LCS_DF and LCS_DirDF reuse the derivatives of the reference images and the
+  sums of their normal equations which do not involve the sample
+  (ReferencePreparation), so that a projection only computes the terms of
+  the sample.
+"""
+import hashlib
+import multiprocessing as mp
+import os
+import warnings
+from collections import OrderedDict
+
+import numpy as np
+import psutil
+
+from ..pipeline._cache import array_digest
+from .batched_lstsq import apply_pseudo_inverse, pixel_pseudo_inverse, solve_pixel_systems
+
+# Largest memory of the pseudo-inverses kept by ReferenceSystemCache, in bytes, if set
+REFERENCE_SYSTEMS_BYTES_VARIABLE = "MOBI_REFERENCE_SYSTEMS_BYTES"
+
+
+def default_systems_bytes():
+    """
+    Memory budget of the pseudo-inverses: REFERENCE_SYSTEMS_BYTES_VARIABLE if
+    set, otherwise a quarter of the available memory, shared by the worker
+    processes of the batch processing (one per core, each with its own cache).
+    """
+    if os.environ.get(REFERENCE_SYSTEMS_BYTES_VARIABLE):
+        return int(float(os.environ[REFERENCE_SYSTEMS_BYTES_VARIABLE]))
+    budget = psutil.virtual_memory().available / 4
+    if mp.parent_process() is not None:
+        budget /= os.cpu_count() or 1
+    return int(budget)
+
+
+class ReferenceSystemCache:
+    """
+    In-memory cache of the pseudo-inverses of the reference systems, keyed by
+    the system, its parameters and the content of the reference images. The
+    least recently used entries are removed once the cache is larger than
+    max_bytes (default_systems_bytes() by default, read at each put).
+    """
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()
+
+    @property
+    def budget(self):
+        return self.max_bytes if self.max_bytes is not None else default_systems_bytes()
+
+    def fits(self, nbytes):
+        """Whether an entry of nbytes can be kept, once the older entries are removed."""
+        return nbytes <= self.budget
+
+    def key(self, name, reference, parameters):
+        hasher = hashlib.blake2b(digest_size=20)
+        hasher.update(repr([name] + list(parameters)).encode())
+        array_digest(reference, hasher)
+        return hasher.hexdigest()
+
+    def get(self, key):
+        if key not in self._entries:
+            return None
+        self._entries.move_to_end(key)
+        return self._entries[key]
+
+    def put(self, key, pseudo_inverse, condition):
+        budget = self.budget
+        if pseudo_inverse.nbytes > budget:
+            return
+        self._entries[key] = (pseudo_inverse, condition)
+        self._entries.move_to_end(key)
+        while sum(entry[0].nbytes for entry in self._entries.values()) > budget:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+REFERENCE_CACHE = ReferenceSystemCache()
+
+
+def solve_reference_systems(name, reference, parameters, build_RHS, LHS, fallback, message=None, cache=REFERENCE_CACHE):
+    """Solves the system of each pixel, reusing the factorization of its matrix when the reference images are unchanged.
+
+    The pseudo-inverses take as much memory as the matrices: when they do not
+    fit in the budget of the cache, the systems are solved directly
+    (solve_pixel_systems) instead of being factorized for nothing.
+
+    Args:
+        name (str): name of the system, e.g. the method.
+        reference (NUMPY ARRAY): reference images the matrices are built from.
+        parameters (tuple): other values the matrices depend on (pixel size, energy...).
+        build_RHS (function): returns the matrices a of the pixels (nb_of_point x nb_of_variables x Ny x Nx).
+        LHS (NUMPY ARRAY): the vectors b of the pixels (nb_of_point x Ny x Nx).
+        fallback (list): solution given to the pixels whose matrix is too ill-conditioned.
+        message (str): progress message, if any.
+        cache (ReferenceSystemCache): where the pseudo-inverses are kept, None to always factorize.
+
+    Returns:
+        solution (NUMPY ARRAY): the unknowns of each pixel (nb_of_variables x Ny x Nx).
+        condition (NUMPY ARRAY): the condition number estimate of the matrix of each pixel (Ny x Nx).
+
+    """
+    if cache is None:
+        return solve_pixel_systems(build_RHS(), LHS, fallback, message)
+    key = cache.key(name, reference, parameters)
+    entry = cache.get(key)
+    if entry is not None:
+        print(f"Reusing the factorization of the {name} reference systems")
+        return apply_pseudo_inverse(*entry, LHS, fallback)
+
+    RHS = build_RHS()
+    # The pseudo-inverses have the size and type of the matrices
+    if not cache.fits(RHS.nbytes):
+        warnings.warn(f"The {name} reference systems ({RHS.nbytes / 1024**3:.1f} GiB) do not fit in the memory of the "
+                      f"reference cache ({cache.budget / 1024**3:.1f} GiB, see {REFERENCE_SYSTEMS_BYTES_VARIABLE}): "
+                      "the systems of each projection are solved directly", RuntimeWarning)
+        return solve_pixel_systems(RHS, LHS, fallback, message)
+    entry = pixel_pseudo_inverse(RHS, message)
+    cache.put(key, *entry)
+    return apply_pseudo_inverse(*entry, LHS, fallback)
+
+
+# Folder where the reference preparations are memory-mapped, if set (also seen by the worker processes)
+REFERENCE_CACHE_VARIABLE = "MOBI_REFERENCE_CACHE"
+# Part of the key of the preparations, to be changed with the formulas of the arrays prepared,
+# so that the files saved by an older version are not read
+PREPARATION_FORMAT = "1"
+
+
+class ReferencePreparation:
+    """
+    Arrays computed from one set of reference images only, by name (e.g. their
+    gradients), each computed the first time it is asked for. With a
+    directory, the arrays are saved there as .npy files and memory-mapped, so
+    that they are shared by the processes and kept between the sessions.
+    """
+
+    def __init__(self, key=None, directory=None, cache=None):
+        self.key = key
+        self.directory = directory if key is not None else None
+        self.cache = cache
+        self.arrays = {}
+
+    @property
+    def nbytes(self):
+        # Memory-mapped arrays are not held in memory
+        return sum(array.nbytes for array in self.arrays.values() if not isinstance(array, np.memmap))
+
+    def get(self, name, compute):
+        """
+        The array called name, given by compute() if it was not computed yet.
+        """
+        if name in self.arrays:
+            return self.arrays[name]
+        path = os.path.join(self.directory, self.key, name + ".npy") if self.directory else None
+        if path is not None and os.path.exists(path):
+            array = np.load(path, mmap_mode="r")
+        else:
+            array = compute()
+            if path is not None:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                # Written under a temporary name, so that another process never reads a partial file
+                temporary = f"{path}.{os.getpid()}.tmp.npy"
+                np.save(temporary, array)
+                os.replace(temporary, path)
+                array = np.load(path, mmap_mode="r")
+        self.arrays[name] = array
+        if self.cache is not None:
+            self.cache.trim()
+        return array
+
+
+class ReferencePreparationCache:
+    """
+    In-memory cache of the ReferencePreparation of the last reference images,
+    keyed by their content. The least recently used preparations are removed
+    once their arrays take more than max_bytes (memory-mapped ones excluded).
+    """
+
+    def __init__(self, max_bytes=2 * 1024**3, directory=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self._entries = OrderedDict()
+
+    def prepare(self, reference):
+        hasher = hashlib.blake2b(digest_size=16)
+        hasher.update(f"format {PREPARATION_FORMAT}".encode())
+        key = array_digest(reference, hasher)
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        preparation = ReferencePreparation(key, self.directory or os.environ.get(REFERENCE_CACHE_VARIABLE), self)
+        self._entries[key] = preparation
+        return preparation
+
+    def trim(self):
+        while self._entries and sum(entry.nbytes for entry in self._entries.values()) > self.max_bytes:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+
+REFERENCE_PREPARATIONS = ReferencePreparationCache()
+
+
+def prepare_reference(reference, cache=REFERENCE_PREPARATIONS):
+    """The ReferencePreparation of these reference images, None as cache to compute everything again."""
+    return cache.prepare(reference) if cache is not None else ReferencePreparation()
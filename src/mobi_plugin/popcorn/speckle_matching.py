@@ -10,12 +10,14 @@ import numpy as np
 from scipy import signal as sig
 from . import frankoChellappa as fc
 from . import fourier_integration, ls_integration
+from .subpixel import paraboloid_peaks, peak_neighbourhoods
+from ..pipeline._progress import progress
 
 def processProjectionUMPA(experiment):
 
     nbImages, Nx, Ny= experiment.sample_images.shape
     
-    result = match_speckles(experiment.sample_images, experiment.reference_images, Nw=experiment.umpaNw, step=1, max_shift=experiment.max_shift, df=True)
+    result = match_speckles(experiment.sample_images, experiment.reference_images, Nw=experiment.UMPA_Nw, step=1, max_shift=experiment.max_shift, df=True)
     dx=-result['dx']
     dy=-result['dy']
     dx[dx<-experiment.max_shift]=-experiment.max_shift
@@ -108,8 +110,14 @@ def match_speckles(Isample, Iref, Nw, step=1, max_shift=1, df=True, printout=Tru
     do = np.zeros(sh)
     MD = np.zeros(sh)
 
+    # The maps of a line, refined at once (sub_pix_minima)
+    lineD = np.empty((sh[1], 2*Ns+1, 2*Ns+1))
+    lineA = np.empty_like(lineD)
+    lineV = np.empty_like(lineD)
+
     # Loop through all positions
     for xi, i in enumerate(ROIx):
+        progress("Matching speckles", xi / sh[0])
         if printout:
             print ('line %d, %d/%d' % (i, xi, sh[0]))
         for xj, j in enumerate(ROIy):
@@ -146,20 +154,25 @@ def match_speckles(Isample, Iref, Nw, step=1, max_shift=1, df=True, printout=Tru
             # Construct D
             D = t1 + (beta**2)*t2 + (K**2)*t3 - 2*beta*t4 - 2*K*t5 + 2*beta*K*t6
 
-            # Find subpixel optimum for tx an ty
-            sx, sy = sub_pix_min(D)
+            lineD[xj] = D
+            lineA[xj] = a
+            lineV[xj] = v
+
+        # Find subpixel optimum for tx an ty
+        sx, sy = sub_pix_minima(lineD).T
 
-            # We should re-evaluate the other values with sub-pixel precision but here we just round
-            # We also need to clip because "sub_pix_min" can return the position of the minimum outside of the bounds...
-            isy = np.clip(int(np.round(sy)), 0, 2*Ns)
-            isx = np.clip(int(np.round(sx)), 0, 2*Ns)
+        # We should re-evaluate the other values with sub-pixel precision but here we just round
+        # We also need to clip because "sub_pix_minima" can return the position of the minimum outside of the bounds...
+        isy = np.clip(np.round(sy).astype(int), 0, 2*Ns)
+        isx = np.clip(np.round(sx).astype(int), 0, 2*Ns)
 
-            # store everything
-            ty[xi, xj] = sy - Ns
-            tx[xi, xj] = sx - Ns
-            tr[xi, xj] = a[isy, isx]
-            do[xi, xj] = v[isy, isx]
-            MD[xi, xj] = D[isy, isx]
+        # store everything
+        xj = np.arange(sh[1])
+        ty[xi] = sy - Ns
+        tx[xi] = sx - Ns
+        tr[xi] = lineA[xj, isy, isx]
+        do[xi] = lineV[xj, isy, isx]
+        MD[xi] = lineD[xj, isy, isx]
 
     return {'T': tr, 'dx': ty, 'dy': tx, 'df': do, 'f': MD}
 
@@ -268,6 +281,20 @@ def pshift(a, ctr):
     return out
 
 
+def sub_pix_minima(maps):
+    """
+    sub_pix_min(a) (with width 1) of a stack of maps at once.
+    :param maps: pixels x rows x columns
+    :return: position (row, column) of the minimum of each map (pixels x 2)
+    """
+    peaks = np.stack(np.unravel_index(np.argmin(maps.reshape(len(maps), -1), axis=1), maps.shape[1:]), axis=1)
+    centres, neighbourhoods = peak_neighbourhoods(np.real(maps), peaks)
+    offsets, is_maximum = paraboloid_peaks(-neighbourhoods)
+    if not is_maximum.all():
+        print('Warning: %d of %d maps do not fit to a minimum!' % ((~is_maximum).sum(), len(maps)))
+    return centres + offsets
+
+
 def sub_pix_min(a, width=1):
     """
     Find the position of the minimum in 2D array a with subpixel precision (using a paraboloid fit).
@@ -276,6 +303,9 @@ def sub_pix_min(a, width=1):
     :return:
     """
 
+    if width == 1:
+        return sub_pix_minima(a[np.newaxis])[0]
+
     sh = a.shape
 
     # Find the global minimum
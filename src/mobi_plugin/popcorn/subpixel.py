@@ -0,0 +1,72 @@
+# !/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Sub-pixel position of the peaks of correlation (XSVT) or distance (UMPA) maps.
+
+Both trackers fit the paraboloid
+
+    f(i, j) = p0 + p1 i + p2 j + p3 i^2 + p4 j^2 + p5 i j
+
+to the 3x3 neighbourhood of the best integer shift of each pixel. On this
+fixed grid the least squares fit is a product by the pseudo-inverse of the
+9 x 6 design matrix, computed once, so that the neighbourhoods of all the
+pixels are fitted in one matrix product instead of one lstsq per pixel.
+"""
+import numpy as np
+
+# Coordinates (i, j) of the 9 points of a 3x3 neighbourhood, centred on the middle one
+_I, _J = (np.indices((3, 3)) - 1).reshape(2, 9)
+# Least squares fit of p from the 9 values, as np.linalg.lstsq
+FIT = np.linalg.pinv(np.stack([np.ones(9), _I, _J, _I**2, _J**2, _I * _J], axis=1))
+
+
+def paraboloid_coefficients(neighbourhoods):
+    """Coefficients p of the paraboloid fitted to each 3x3 neighbourhood (module docstring).
+
+    Args:
+        neighbourhoods (NUMPY ARRAY): values around each peak (pixels x 3 x 3), (i, j) = (0, 0) at the centre.
+
+    Returns:
+        NUMPY ARRAY: p0 to p5 of each pixel (pixels x 6).
+    """
+    return np.reshape(neighbourhoods, (-1, 9)) @ FIT.T
+
+
+def paraboloid_peaks(neighbourhoods):
+    """Sub-pixel position of the stationary point of the paraboloid fitted to each 3x3 neighbourhood.
+
+    Args:
+        neighbourhoods (NUMPY ARRAY): values around each peak (pixels x 3 x 3).
+
+    Returns:
+        offsets (NUMPY ARRAY): position (row, column) of the stationary point relative to the
+        centre of its neighbourhood (pixels x 2), 0 where the paraboloid has none (singular hessian).
+        is_maximum (NUMPY ARRAY): True where the stationary point is a maximum, False for a
+        minimum, a saddle point or a flat direction (pixels).
+    """
+    p = paraboloid_coefficients(neighbourhoods)
+    determinant = 4 * p[:, 3] * p[:, 4] - p[:, 5]**2
+    offsets = np.zeros((len(p), 2))
+    regular = determinant != 0
+    with np.errstate(invalid='ignore'):
+        offsets[regular, 0] = (p[regular, 5] * p[regular, 2] - 2 * p[regular, 4] * p[regular, 1]) / determinant[regular]
+        offsets[regular, 1] = (p[regular, 5] * p[regular, 1] - 2 * p[regular, 3] * p[regular, 2]) / determinant[regular]
+    is_maximum = (p[:, 3] <= 0) & (p[:, 4] <= 0) & (determinant >= 0) & regular
+    return offsets, is_maximum
+
+
+def peak_neighbourhoods(maps, peaks):
+    """3x3 neighbourhoods of the peaks of maps, moved away from the edges of the maps.
+
+    Args:
+        maps (NUMPY ARRAY): one map per pixel (pixels x rows x columns), at least 3 x 3.
+        peaks (NUMPY ARRAY): position (row, column) of the peak of each map (pixels x 2).
+
+    Returns:
+        centres (NUMPY ARRAY): centre of each neighbourhood (pixels x 2).
+        neighbourhoods (NUMPY ARRAY): pixels x 3 x 3.
+    """
+    centres = np.clip(peaks, 1, np.array(maps.shape[1:]) - 2)
+    rows = centres[:, 0, np.newaxis, np.newaxis] + np.arange(-1, 2)[:, np.newaxis]
+    columns = centres[:, 1, np.newaxis, np.newaxis] + np.arange(-1, 2)
+    return centres, maps[np.arange(len(maps))[:, np.newaxis, np.newaxis], rows, columns]
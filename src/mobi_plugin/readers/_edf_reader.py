@@ -1,9 +1,6 @@
 import h5py
 import numpy as np
 
-import tkinter as tk
-from tkinter import messagebox, ttk
-
 import fabio
 
 from scipy.ndimage import median_filter
@@ -2,13 +2,9 @@ import h5py
 import numpy as np
 import glob
 import os
-from PyQt5.QtWidgets import (
-    QApplication, QDialog, QLabel, QVBoxLayout, QHBoxLayout, QPushButton,
-    QLineEdit, QComboBox, QCheckBox, QFileDialog, QFormLayout, QMessageBox
-)
 from scipy.ndimage import median_filter
 
-def read_hdf5(paths):
+def read_hdf5(paths, slices_info=None):
     """
     Reads data from HDF5/NXS files with a single selection of slice and dimension,
     then organizes the layers for each dataset.
@@ -17,6 +13,9 @@ def read_hdf5(paths):
     ----------
     paths : list[str] | str
         Paths to files to be processed.
+    slices_info : dict, optional
+        Slice, dimension and median selection for each dataset path, as
+        returned by the selection dialog. The dialog is shown if not given.
 
     Returns
     -------
@@ -30,8 +29,9 @@ def read_hdf5(paths):
     if os.path.isdir(paths[0]):
         paths = read_hdf5_folder(paths[0])
 
-    print("Selection of slices and dimensions for each dataset.")
-    slices_info = display_and_select_slices(paths[0])
+    if slices_info is None:
+        print("Selection of slices and dimensions for each dataset.")
+        slices_info = display_and_select_slices(paths[0])
 
     dataset_layers = {} 
 
@@ -143,67 +143,22 @@ def find_datasets_with_dim_3(file, group=None, path="", results=None):
                 ) 
     return results
 
-class SliceSelectionDialog(QDialog):
-    def __init__(self, datasets_3d):
-        super().__init__()
-        self.setWindowTitle("Sélection des slices et dimensions")
-        self.datasets_3d = datasets_3d
-        self.selections = {}
-
-        layout = QVBoxLayout()
-        form_layout = QFormLayout()
-
-        self.slice_inputs = {}
-        self.dimension_inputs = {}
-        self.median_checks = {}
-
-        for path, shape in datasets_3d:
-            row_layout = QHBoxLayout()
-            
-            label = QLabel(f"{path} - Dimensions: {shape}")
-            slice_input = QLineEdit("0")
-            dimension_input = QComboBox()
-            dimension_input.addItems(["0", "1", "2"])
-            median_check = QCheckBox("Utiliser médiane")
-            
-            self.slice_inputs[path] = slice_input
-            self.dimension_inputs[path] = dimension_input
-            self.median_checks[path] = median_check
-
-            form_layout.addRow(label, slice_input)
-            form_layout.addRow(QLabel("Dimension :"), dimension_input)
-            form_layout.addRow(QLabel("Filtre médian :"), median_check)
-
-        layout.addLayout(form_layout)
-        
-        submit_button = QPushButton("Valider")
-        submit_button.clicked.connect(self.submit_selection)
-        layout.addWidget(submit_button)
-
-        self.setLayout(layout)
-
-    def submit_selection(self):
-        try:
-            for path, shape in self.datasets_3d:
-                slice_value = int(self.slice_inputs[path].text())
-                dimension_value = int(self.dimension_inputs[path].currentText())
-                use_median = self.median_checks[path].isChecked()
-
-                if not (0 <= slice_value < shape[dimension_value]):
-                    raise ValueError(f"Slice invalide pour {path}. Doit être entre 0 et {shape[dimension_value] - 1}.")
-
-                self.selections[path] = {
-                    "slice": slice_value,
-                    "dimension": dimension_value,
-                    "use_median": use_median,
-                }
-            self.accept()
-        except ValueError as e:
-            QMessageBox.critical(self, "Erreur", str(e))
-
-from PyQt5.QtWidgets import QApplication
+def default_slices_info(file_path, slice_number=0, dim=0, use_median=False):
+    """
+    Same selection for every 3D dataset of the file, without any dialog.
+    """
+    with h5py.File(file_path, "r") as f:
+        datasets_3d = find_datasets_with_dim_3(f)
+    return {
+        path: {"slice": slice_number, "dimension": dim, "use_median": use_median}
+        for path, shape in datasets_3d
+    }
 
 def display_and_select_slices(file_path):
+    # Qt is only needed for the dialog, so that the headless processing (mobi-process) can read the files without it
+    from PyQt5.QtWidgets import QApplication, QMessageBox
+    from ._slice_dialog import SliceSelectionDialog
+
     with h5py.File(file_path, "r") as f:
         datasets_3d = find_datasets_with_dim_3(f)
         if not datasets_3d:
@@ -220,6 +175,8 @@ def display_and_select_slices(file_path):
         return {}
 
 def read_hdf5_folder(path):
+    from PyQt5.QtWidgets import QApplication, QFileDialog
+
     app = QApplication.instance()  # Vérifie si QApplication existe déjà
     if app is None:
         app = QApplication([])
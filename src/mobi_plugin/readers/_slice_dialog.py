@@ -0,0 +1,62 @@
+from PyQt5.QtWidgets import (
+    QDialog, QLabel, QVBoxLayout, QHBoxLayout, QPushButton,
+    QLineEdit, QComboBox, QCheckBox, QFormLayout, QMessageBox
+)
+
+class SliceSelectionDialog(QDialog):
+    def __init__(self, datasets_3d):
+        super().__init__()
+        self.setWindowTitle("Sélection des slices et dimensions")
+        self.datasets_3d = datasets_3d
+        self.selections = {}
+
+        layout = QVBoxLayout()
+        form_layout = QFormLayout()
+
+        self.slice_inputs = {}
+        self.dimension_inputs = {}
+        self.median_checks = {}
+
+        for path, shape in datasets_3d:
+            row_layout = QHBoxLayout()
+            
+            label = QLabel(f"{path} - Dimensions: {shape}")
+            slice_input = QLineEdit("0")
+            dimension_input = QComboBox()
+            dimension_input.addItems(["0", "1", "2"])
+            median_check = QCheckBox("Utiliser médiane")
+            
+            self.slice_inputs[path] = slice_input
+            self.dimension_inputs[path] = dimension_input
+            self.median_checks[path] = median_check
+
+            form_layout.addRow(label, slice_input)
+            form_layout.addRow(QLabel("Dimension :"), dimension_input)
+            form_layout.addRow(QLabel("Filtre médian :"), median_check)
+
+        layout.addLayout(form_layout)
+        
+        submit_button = QPushButton("Valider")
+        submit_button.clicked.connect(self.submit_selection)
+        layout.addWidget(submit_button)
+
+        self.setLayout(layout)
+
+    def submit_selection(self):
+        try:
+            for path, shape in self.datasets_3d:
+                slice_value = int(self.slice_inputs[path].text())
+                dimension_value = int(self.dimension_inputs[path].currentText())
+                use_median = self.median_checks[path].isChecked()
+
+                if not (0 <= slice_value < shape[dimension_value]):
+                    raise ValueError(f"Slice invalide pour {path}. Doit être entre 0 et {shape[dimension_value] - 1}.")
+
+                self.selections[path] = {
+                    "slice": slice_value,
+                    "dimension": dimension_value,
+                    "use_median": use_median,
+                }
+            self.accept()
+        except ValueError as e:
+            QMessageBox.critical(self, "Erreur", str(e))
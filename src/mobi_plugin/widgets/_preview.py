@@ -0,0 +1,97 @@
+import numpy as np
+
+from ..pipeline._dispatch import run_processing
+from ..pipeline._preview import bin_images, binned_experiment, clip_bounds, crop_images
+
+from ._processing import SOLVE_CACHE, add_image_to_layer, get_layer_data, start_worker
+
+PREVIEW_REGIONS = ["Viewport", "ROI (shapes layer)", "Binning 2x", "Binning 4x"]
+PREVIEW_PREFIX = "preview_"
+
+
+def world_to_pixels(layer, points):
+    """
+    Convert (y, x) world coordinates to pixel coordinates of the last two axes of a layer.
+    """
+    scale = np.asarray(layer.scale)[-2:]
+    translate = np.asarray(layer.translate)[-2:]
+    return (np.asarray(points, dtype=float) - translate) / scale
+
+def viewport_bounds(viewer, layer):
+    """
+    Pixels of the layer visible in the canvas, as (y0, y1, x0, x1): the
+    canvas, of (height, width) screen pixels, shows 1/zoom world units per
+    screen pixel around the centre of the camera.
+    """
+    center = np.asarray(viewer.camera.center)[-2:]
+    half_size = np.asarray(viewer._canvas_size) / viewer.camera.zoom / 2
+    (y0, x0), (y1, x1) = world_to_pixels(layer, [center - half_size, center + half_size])
+    return y0, y1, x0, x1
+
+def roi_bounds(viewer, layer):
+    """
+    Bounding box, as (y0, y1, x0, x1) pixels of the layer, of the selected
+    shape (or the last one) of the active shapes layer (or the first one).
+    """
+    from napari.layers import Shapes
+
+    shapes_layers = [shapes for shapes in viewer.layers if isinstance(shapes, Shapes) and len(shapes.data) > 0]
+    if not shapes_layers:
+        raise ValueError("Draw a rectangle in a shapes layer to select the region of the preview")
+    active = viewer.layers.selection.active
+    shapes = active if active in shapes_layers else shapes_layers[0]
+
+    selected = sorted(shapes.selected_data)
+    vertices = np.asarray(shapes.data[selected[0] if selected else -1])[:, -2:]
+    world = vertices * np.asarray(shapes.scale)[-2:] + np.asarray(shapes.translate)[-2:]
+    pixels = world_to_pixels(layer, world)
+    (y0, x0), (y1, x1) = pixels.min(axis=0), pixels.max(axis=0) + 1
+    return y0, y1, x0, x1
+
+def preview(experiment, viewer, region):
+    """
+    Run the method of the experiment on a part of the images (the viewport
+    or a ROI) or on binned images, and show the results as temporary
+    "preview_" layers placed over the full images.
+    The experiment itself is not modified and can be used for the full run.
+    Returns the worker.
+    """
+    sample, reference, darkfield, flatfield = get_layer_data(viewer, experiment)
+    sample_layer = viewer.layers[experiment.sample_images]
+    run_experiment = experiment.copy()
+
+    # Preview of a scan: first projection only
+    if sample.ndim == 4:
+        sample = sample[0]
+
+    scale = np.asarray(sample_layer.scale)[-2:]
+    translate = np.asarray(sample_layer.translate)[-2:]
+    if region.startswith("Binning"):
+        factor = int(region.split()[-1].rstrip("x"))
+        images = [bin_images(images, factor) for images in (sample, reference, darkfield, flatfield)]
+        run_experiment = binned_experiment(run_experiment, factor)
+        layer_kwargs = {"scale": scale * factor, "translate": translate + scale * (factor - 1) / 2}
+    else:
+        if region == "Viewport":
+            bounds = viewport_bounds(viewer, sample_layer)
+        else:
+            bounds = roi_bounds(viewer, sample_layer)
+        y0, y1, x0, x1 = clip_bounds(bounds, sample.shape[-2:])
+        images = [crop_images(images, (y0, y1, x0, x1)) for images in (sample, reference, darkfield, flatfield)]
+        layer_kwargs = {"scale": scale, "translate": translate + scale * (y0, x0)}
+    print(f"Preview on {region}: images of {images[0].shape[-2:]} pixels")
+
+    def run():
+        return run_processing(run_experiment, *images, solve_cache=SOLVE_CACHE)
+
+    def on_returned(result):
+        add_image_to_layer(result, run_experiment.method, viewer, prefix=PREVIEW_PREFIX, **layer_kwargs)
+
+    return start_worker(viewer, run, on_returned, message="Preview...")
+
+def remove_preview_layers(viewer):
+    """
+    Remove the temporary layers created by the previews.
+    """
+    for layer in [layer for layer in viewer.layers if layer.name.startswith(PREVIEW_PREFIX)]:
+        viewer.layers.remove(layer)
@@ -1,143 +1,167 @@
-import numpy as np
+from qtpy.QtCore import QObject, Qt, Signal
+from qtpy.QtWidgets import QProgressDialog
 
-from qtpy.QtWidgets import QApplication, QDialog, QVBoxLayout, QLabel
+from ..pipeline._batch import process_batch
+from ..pipeline._cache import ResultCache
+from ..pipeline._dispatch import run_processing
+from ..pipeline._progress import ProcessingCancelled, ProcessingMonitor
+from ..pipeline._stages import SolveCache
+from ..pipeline._timing import TIMINGS_KEY, StageTimings, merge_timings
 
-from mbipy.numpy.phase_retrieval import lcs
-from mbipy.src.normal_integration.fourier import kottler, frankot
+from ._timings import publish_timings
+from ._utils import Experiment
 
-from ..popcorn.LCS_DirDF import processProjectionLCS_DDF
-from ..popcorn.LCS_DF import process_projection_LCS_DF
-from ..popcorn.MISTI import MISTI
-from ..popcorn.MISTII_1 import processProjectionMISTII_1
-from ..popcorn.MISTII_2 import processProjectionMISTII_2
-from ..popcorn.Pavlov2020 import tie_Pavlovetal2020
-from ..popcorn.XSVT import processProjectionXSVT
-from ..popcorn.ReverseFlow_LCS import processProjection_rLCS
-from ..popcorn.speckle_matching import processProjectionUMPA
 
-from ._utils import Experiment
+# Results of previous runs, so that re-processing the same layers with the
+# same parameters (also after a restart) is immediate
+RESULT_CACHE = ResultCache()
+# Solve stage of the last runs, so that tuning the post-processing (median
+# filters, phase integration) does not solve the system again
+SOLVE_CACHE = SolveCache()
+
+
+class ProgressRelay(QObject):
+    """
+    Forward progress reports emitted from the worker thread to the GUI thread.
+    """
+    progress = Signal(str, object)
+
 
 def create_processing_dialog(parent, message="Processing..."):
     """
-    Create and display a dialog with a message to indicate that processing is ongoing.
+    Create and display a non-modal dialog showing the progress of the
+    processing, with a Cancel button.
     """
-    dialog = QDialog(parent)
+    dialog = QProgressDialog(message, "Cancel", 0, 100, parent)
     dialog.setWindowTitle("Processing")
-    layout = QVBoxLayout()
-    label = QLabel(message)
-    layout.addWidget(label)
-    dialog.setLayout(layout)
-    dialog.setFixedSize(200, 100)
+    dialog.setWindowModality(Qt.NonModal)
+    dialog.setMinimumDuration(0)
+    dialog.setAutoClose(False)
+    dialog.setAutoReset(False)
+    dialog.setValue(0)
     dialog.show()
-    QApplication.processEvents()
     return dialog
 
-def apply_corrections(viewer, experiment):
+def update_processing_dialog(dialog, stage, fraction):
     """
-    Apply flatfield and darkfield corrections to the sample and reference layers 
-    using the data stored in the experiment object.
+    Show the current stage, and its completion if known, in the dialog.
     """
-    print("Applying corrections")
-    sample_layer = viewer.layers[experiment.sample_images].data
-    reference_layer = viewer.layers[experiment.reference_images].data
-
-    if experiment.darkfield is not None:
-        darkfield_layer = viewer.layers[experiment.darkfield].data
-        sample_layer = sample_layer - darkfield_layer
-        reference_layer = reference_layer - darkfield_layer
-
-    if experiment.flatfield is not None:
-        flatfield_layer = viewer.layers[experiment.flatfield].data
-        sample_layer = sample_layer / flatfield_layer
-        reference_layer = reference_layer / flatfield_layer
+    dialog.setLabelText(stage)
+    if fraction is not None:
+        dialog.setValue(int(100 * fraction))
 
-    return sample_layer, reference_layer
-
-def apply_phase(result, phase_parameters):
+def get_layer_data(viewer, experiment):
     """
-    Apply phase calculation based on the provided phase parameters.
+    Fetch the data of the layers selected in the experiment object.
     """
-    if phase_parameters['method'] == 'Kottler':
-        return kottler(result['dy'], result['dx'], pad=phase_parameters['pad'])
-    elif phase_parameters['method'] == 'Frankot_Chellappa':
-        return frankot(result['dy'], result['dx'], pad=phase_parameters['pad'])
-    else:
-        raise ValueError(f"Unknown phase retrieval method: {phase_parameters['method']}")
+    sample = viewer.layers[experiment.sample_images].data
+    reference = viewer.layers[experiment.reference_images].data
+    darkfield = viewer.layers[experiment.darkfield].data if experiment.darkfield is not None else None
+    flatfield = viewer.layers[experiment.flatfield].data if experiment.flatfield is not None else None
+    return sample, reference, darkfield, flatfield
 
-def add_image_to_layer(results, method, viewer):
+def add_image_to_layer(results, method, viewer, prefix="", **layer_kwargs):
     """
     Add the resulting image to the viewer as a new layer.
+    With a prefix (temporary preview layers), an existing layer of the same
+    name is updated instead, so that its display settings are kept.
     """
     for name, image in results.items():
-        viewer.add_image(image.real, name=f"{name}_{method}")
-
-def processing(experiment, viewer):
+        if name == TIMINGS_KEY:
+            continue
+        if name == 'phase':
+            # Le nom de la couche phase est basé sur le nom de la méthode
+            layer_name = f"{prefix}{method}_phase"
+        else:
+            image = image.real
+            layer_name = f"{prefix}{name}_{method}"
+
+        if prefix and layer_name in viewer.layers:
+            layer = viewer.layers[layer_name]
+            layer.data = image
+            for attribute, value in layer_kwargs.items():
+                setattr(layer, attribute, value)
+        else:
+            viewer.add_image(image, name=layer_name, **layer_kwargs)
+
+def on_processing_error(error):
     """
-    Process the data using the parameters contained in the experiment object.
-    The viewer is used to access layer data and to add the resulting images.
+    Report an error raised in the processing worker.
     """
+    if isinstance(error, ProcessingCancelled):
+        print(error)
+        return
+    print(f"Error during processing: {error}")
+    import traceback
+    traceback.print_exception(type(error), error, error.__traceback__)
+
+def start_worker(viewer, function, on_returned, message="Processing..."):
+    """
+    Run function in a worker thread, with a progress dialog allowing to
+    cancel it; on_returned is called in the GUI thread with its result.
+    Returns the worker.
+    """
+    # Imported here so that the pipeline can be used without loading napari
+    from napari.qt.threading import create_worker
 
-    processing_dialog = create_processing_dialog(viewer.window._qt_window)  
-
-    try:
+    processing_dialog = create_processing_dialog(viewer.window._qt_window, message)
+    relay = ProgressRelay()
+    relay.progress.connect(lambda stage, fraction: update_processing_dialog(processing_dialog, stage, fraction))
+    monitor = ProcessingMonitor(callback=relay.progress.emit)
 
-        sample_layer, reference_layer = apply_corrections(viewer, experiment)
-        experiment.sample_images = sample_layer
-        experiment.reference_images = reference_layer
+    def run():
+        with monitor.activate():
+            return function()
 
+    def returned(result):
+        processing_dialog.setLabelText("Adding images to the viewer")
         try:
-            print(f"Processing with method: {experiment.method}")
-            if experiment.method == 'lcs':
-                result = lcs(reference_layer, sample_layer, alpha=experiment.alpha, weak_absorption=experiment.weak_absorption)
-                result = np.moveaxis(result, -1, 0)
-                result = {'abs': result[0], 'dx': result[1], 'dy': result[2]}
-            elif experiment.method == 'lcs_df':
-                result = process_projection_LCS_DF(experiment)
-            elif experiment.method == 'lcs_dirdf':
-                result = processProjectionLCS_DDF(experiment)
-            elif experiment.method == 'misti':
-                result = MISTI(experiment)
-            elif experiment.method == 'mistii1':
-                result = processProjectionMISTII_1(experiment)
-            elif experiment.method == 'mistii2':
-                result = processProjectionMISTII_2(experiment)
-            elif experiment.method == 'pavlov2020':
-                result = tie_Pavlovetal2020(experiment)
-            elif experiment.method == 'xsvt':
-                result = processProjectionXSVT(experiment)
-            elif experiment.method == 'reversflowlcs':
-                result = processProjection_rLCS(experiment)
-            elif experiment.method == 'specklematching':
-                result = processProjectionUMPA(experiment)
-            else:
-                raise ValueError(f"Unknown method: {experiment.method}")
-        except Exception as e:
-            print(f"Error during processing: {e}")
-            import traceback
-            traceback.print_exc()
-            return
-
-        # Si des paramètres de phase sont définis, calculer la phase
-        if experiment.phase_parameters:
-            try:
-                phase = apply_phase(result, experiment.phase_parameters)
-                # Le nom de la couche phase est basé sur le nom de la couche sample
-                viewer.add_image(phase, name=f"{experiment.method}_phase")
-            except Exception as e:
-                print(f"Error during phase calculation: {e}")
-                import traceback
-                traceback.print_exc()
-
-        # Ajouter les images résultantes au viewer
-        try:
-            add_image_to_layer(result, experiment.method, viewer)
+            on_returned(result)
         except Exception as e:
             print(f"Error adding image to layer: {e}")
             import traceback
             traceback.print_exc()
 
-        return result
-    finally:
-        processing_dialog.close()
+    worker = create_worker(run)
+    worker.returned.connect(returned)
+    worker.errored.connect(on_processing_error)
+    worker.finished.connect(processing_dialog.close)
+    processing_dialog.canceled.connect(monitor.cancel)
+    processing_dialog.canceled.connect(lambda: processing_dialog.setLabelText("Cancelling..."))
+    # Keep the relay alive as long as the worker
+    worker.relay = relay
+    worker.start()
 
+    return worker
 
+def processing(experiment, viewer):
+    """
+    Process the data using the parameters contained in the experiment object.
+    The processing runs in a worker thread so that napari stays responsive;
+    the resulting images are added to the viewer once it is done.
+    Returns the worker.
+    """
+    timings = StageTimings()
+    with timings.stage("read"):
+        sample, reference, darkfield, flatfield = get_layer_data(viewer, experiment)
+
+    # The worker gets its own copy: the widget's experiment keeps layer names
+    run_experiment = experiment.copy()
+
+    def run():
+        # A 4D sample (angle x membrane position x y x x) is a full scan
+        if sample.ndim == 4:
+            return process_batch(run_experiment, sample, reference, darkfield, flatfield, cache=RESULT_CACHE)
+        return run_processing(run_experiment, sample, reference, darkfield, flatfield, cache=RESULT_CACHE, solve_cache=SOLVE_CACHE, timings=timings)
+
+    def on_returned(result):
+        with timings.stage("add to viewer"):
+            add_image_to_layer(result, run_experiment.method, viewer)
+        stages = timings.as_dict()
+        if sample.ndim == 4:
+            # The stages of the projections were timed in the worker processes
+            stages = merge_timings(stages, result.get(TIMINGS_KEY, {}))
+        result[TIMINGS_KEY] = stages
+        publish_timings(result[TIMINGS_KEY], run_experiment.method)
+
+    return start_worker(viewer, run, on_returned)
@@ -16,8 +16,10 @@ from qtpy.QtWidgets import (
     QSizePolicy,
     QInputDialog
 )
+from ..pipeline._experiment import CONDITION_METHODS, PRECISIONS, XSVT_SEARCHES
 from ._utils import Experiment, LayerUtils
 from ._processing import processing 
+from ._preview import PREVIEW_REGIONS, preview, remove_preview_layers
 
 def add_layer_selection_section(widget):
     """
@@ -127,6 +129,32 @@ def add_processing_button(widget):
     """
     Add the processing button.
     """
+    precision_layout = QHBoxLayout()
+    precision_layout.addWidget(QLabel("Precision:"))
+    widget.precision_selection = QComboBox()
+    widget.precision_selection.addItems(PRECISIONS)
+    widget.precision_selection.setCurrentText(str(widget.experiment.precision))
+    precision_layout.addWidget(widget.precision_selection)
+    widget.layout().addLayout(precision_layout)
+
+    if widget.experiment.method in CONDITION_METHODS:
+        widget.condition_map_checkbox = QCheckBox("Condition map (conditioning of each pixel's system)")
+        # QSettings gives back booleans as strings
+        widget.condition_map_checkbox.setChecked(str(widget.experiment.condition_map).lower() == "true")
+        widget.layout().addWidget(widget.condition_map_checkbox)
+
+    preview_layout = QHBoxLayout()
+    widget.preview_selection = QComboBox()
+    widget.preview_selection.addItems(PREVIEW_REGIONS)
+    preview_layout.addWidget(widget.preview_selection)
+    btn_preview = QPushButton("Preview")
+    btn_preview.clicked.connect(lambda: call_preview(widget))
+    preview_layout.addWidget(btn_preview)
+    btn_clear_preview = QPushButton("Clear")
+    btn_clear_preview.clicked.connect(lambda: remove_preview_layers(widget.viewer))
+    preview_layout.addWidget(btn_clear_preview)
+    widget.layout().addLayout(preview_layout)
+
     btn_start_processing = QPushButton("Start processing")
     btn_start_processing.clicked.connect(lambda: call_processing(widget))
     widget.layout().addWidget(btn_start_processing)
@@ -152,10 +180,26 @@ def call_processing(widget):
     """
     Updates experiment parameters using widget values,
     then launches processing using the experiment object and viewer.
+    Returns the worker running the processing in the background.
     """
     widget.experiment.update_parameters(widget)
-    result = processing(widget.experiment, widget.viewer)
-    return result
+    worker = processing(widget.experiment, widget.viewer)
+    return worker
+
+def call_preview(widget):
+    """
+    Updates experiment parameters using widget values, then runs the method
+    on the region selected for the preview (viewport, ROI or binned images).
+    Returns the worker, or None if the preview could not be started.
+    """
+    widget.experiment.update_parameters(widget)
+    try:
+        return preview(widget.experiment, widget.viewer, widget.preview_selection.currentText())
+    except Exception as e:
+        print(f"Error during preview: {e}")
+        import traceback
+        traceback.print_exc()
+        return None
 
 def ensure_variables_layout(widget):
     """
@@ -221,6 +265,12 @@ def add_LCS_median_filter_layout(widget):
     # widget.LCS_median_filter_input.textChanged.connect(lambda: update_parameters(widget))
     widget.variables_layout.addWidget(widget.LCS_median_filter_input)
 
+def add_LCS_streaming_layout(widget):
+    widget.LCS_streaming_checkbox = QCheckBox("Low memory (accumulate the images one by one)")
+    # QSettings gives back booleans as strings
+    widget.LCS_streaming_checkbox.setChecked(str(widget.experiment.LCS_streaming).lower() == "true")
+    widget.variables_layout.addWidget(widget.LCS_streaming_checkbox)
+
 def add_beta_layout(widget):
     widget.variables_layout.addWidget(QLabel("Beta:"))
     widget.beta_input = QLineEdit()
@@ -277,6 +327,13 @@ def add_XSVT_Nw_layout(widget):
     # widget.XSVT_Nw_input.textChanged.connect(lambda: update_parameters(widget))
     widget.variables_layout.addWidget(widget.XSVT_Nw_input)
 
+def add_XSVT_search_layout(widget):
+    widget.variables_layout.addWidget(QLabel("XSVT search:"))
+    widget.XSVT_search_selection = QComboBox()
+    widget.XSVT_search_selection.addItems(XSVT_SEARCHES)
+    widget.XSVT_search_selection.setCurrentText(str(widget.experiment.XSVT_search))
+    widget.variables_layout.addWidget(widget.XSVT_search_selection)
+
 def add_umpaNw_layout(widget):
     widget.variables_layout.addWidget(QLabel("UMPA Nw:"))
     widget.UMPA_Nw_input = QLineEdit()
@@ -334,6 +391,8 @@ def add_lcs_df_variables(widget):
     add_dist_source_object_layout(widget)
     add_energy_layout(widget)
     add_LCS_median_filter_layout(widget)
+    if widget.experiment.method == "lcs_df":
+        add_LCS_streaming_layout(widget)
 
 def add_misti_variables(widget):
     """
@@ -400,6 +459,7 @@ def add_xsvt_variables(widget):
     add_energy_layout(widget)
     add_XSVT_median_filter_layout(widget)
     add_XSVT_Nw_layout(widget)
+    add_XSVT_search_layout(widget)
 
 def add_reversflowlcs_variables(widget):
     """
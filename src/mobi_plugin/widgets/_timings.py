@@ -0,0 +1,53 @@
+from qtpy.QtWidgets import QFileDialog, QTableWidget, QTableWidgetItem
+
+from ..pipeline._timing import write_timings
+
+# Timings docks to update at the end of each run, and the last timings shown
+_listeners = []
+last_timings = {"method": None, "stages": {}}
+
+TIMINGS_COLUMNS = ["Stage", "Wall (s)", "CPU (s)", "Peak memory (MB)", "Memory increase (MB)", "Calls"]
+
+
+def publish_timings(stages, method):
+    """
+    Show the timings of a finished run in the timings docks.
+    """
+    last_timings["method"] = method
+    last_timings["stages"] = stages
+    for listener in list(_listeners):
+        listener(stages, method)
+
+def subscribe_timings(listener):
+    _listeners.append(listener)
+
+def unsubscribe_timings(listener):
+    if listener in _listeners:
+        _listeners.remove(listener)
+
+def create_timings_table():
+    table = QTableWidget(0, len(TIMINGS_COLUMNS))
+    table.setHorizontalHeaderLabels(TIMINGS_COLUMNS)
+    table.verticalHeader().setVisible(False)
+    return table
+
+def fill_timings_table(table, stages):
+    """
+    One row per stage, in the order the stages started.
+    """
+    table.setRowCount(len(stages))
+    for row, (name, record) in enumerate(stages.items()):
+        values = [name, f"{record['wall_time']:.3f}", f"{record['cpu_time']:.3f}",
+                  f"{record['peak_memory'] / 1e6:.1f}", f"{record['memory_increase'] / 1e6:.1f}", str(record['calls'])]
+        for column, value in enumerate(values):
+            table.setItem(row, column, QTableWidgetItem(value))
+    table.resizeColumnsToContents()
+
+def save_timings(parent):
+    """
+    Ask for a file name and save the last timings as JSON.
+    """
+    path, _ = QFileDialog.getSaveFileName(parent, "Save timings", "timings.json", "JSON (*.json)")
+    if path:
+        write_timings(path, last_timings["stages"], method=last_timings["method"])
+        print(f"Timings saved in {path}")
@@ -1,6 +1,7 @@
-from numpy import pi
 from qtpy.QtCore import QSettings
 
+from ..pipeline._experiment import ExperimentParameters
+
 class LayerUtils:
     @staticmethod
     def connect_signals(widget):
@@ -30,122 +31,15 @@ class LayerUtils:
             widget.flatfield_selection.clear()
             widget.flatfield_selection.addItems(layers) 
 
-class Experiment:
+class Experiment(ExperimentParameters):
     def __init__(self, method): 
-        self.method = method
         self.settings = QSettings("mobi", "mobiconfig")
-
-        self.sample_images = None
-        self.reference_images = None
-        self.darkfield = None
-        self.flatfield = None
-
-        self._initialize_method_parameters()
+        super().__init__(method)
 
         self.load_settings()
 
         print(f"Initialized Parameters with method: {self.method}")
 
-    def _initialize_method_parameters(self):
-
-        if self.method == "lcs":
-            self.alpha = None
-            self.weak_absorption = False 
-
-        elif self.method == "lcs_df":
-            self.nb_of_point = None
-            self.max_shift = None
-            self.pixel = None
-            self.energy = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.LCS_median_filter = None
-
-        elif self.method == "lcs_dirdf":
-            self.nb_of_point = None
-            self.max_shift = None
-            self.pixel = None
-            self.energy = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.LCS_median_filter = None
-
-        elif self.method == "misti":
-            self.pixel = None
-            self.dist_object_detector = None
-            self.beta = None
-            self.delta = None
-            self.energy = None
-            self.MIST_median_filter = None
-            self.sigma_regularization = None
-
-        elif self.method == "mistii1":
-            self.nb_of_point = None
-            self.pixel = None
-            self.dist_object_detector = None
-            self.beta = None
-            self.delta = None
-            self.energy = None
-            self.MIST_median_filter = None
-            self.sigma_regularization = None
-
-        elif self.method == "mistii2":
-            self.nb_of_point = None
-            self.pixel = None
-            self.dist_object_detector = None
-            self.beta = None
-            self.delta = None
-            self.energy = None
-            self.MIST_median_filter = None
-            self.sigma_regularization = None
-
-        elif self.method == "pavlov2020":
-            self.pixel = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.beta = None
-            self.delta = None
-            self.energy = None
-            self.sigma_regularization = None
-            self.source_size = None
-
-        elif self.method == "xsvt":
-            self.max_shift = None
-            self.pixel = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.energy = None
-            self.XSVT_median_filter = None
-            self.XSVT_Nw = None
-
-        elif self.method == "reversflowlcs":
-            self.nb_of_point = None
-            self.max_shift = None
-            self.pixel = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.energy = None
-
-        elif self.method == "specklematching":
-            self.max_shift = None
-            self.pixel = None
-            self.dist_object_detector = None
-            self.dist_source_object = None
-            self.UMPA_Nw = None
-            self.energy = None
-            
-        self.phase_parameters = None
-
-    def getk(self):
-        """
-        Energy in eV
-        """
-        h=6.626e-34
-        c=2.998e8
-        e=1.6e-19
-        k=2*pi*self.energy*e/(h*c)
-        return k     
-    
     def load_settings(self):
 
         method_key_prefix = f"{self.method}/"
@@ -188,6 +82,12 @@ class Experiment:
             else:
                 self.flatfield = None
 
+            if hasattr(widget, 'precision_selection'):
+                self.precision = widget.precision_selection.currentText()
+
+            if hasattr(widget, 'condition_map_checkbox'):
+                self.condition_map = widget.condition_map_checkbox.isChecked()
+
             if self.method == "lcs":
                 self.alpha = float(widget.alpha_input.text())
                 self.weak_absorption = widget.weak_absorption_checkbox.isChecked()
@@ -204,6 +104,7 @@ class Experiment:
                 self.dist_object_detector = float(widget.dist_object_detector_input.text())
                 self.dist_source_object = float(widget.dist_source_object_input.text())
                 self.LCS_median_filter = int(widget.LCS_median_filter_input.text())
+                self.LCS_streaming = widget.LCS_streaming_checkbox.isChecked()
 
             elif self.method == "lcs_dirdf":
                 dim_range = widget.viewer.dims.range[0]
@@ -273,6 +174,7 @@ class Experiment:
                 self.energy = float(widget.energy_input.text())
                 self.XSVT_median_filter = int(widget.XSVT_median_filter_input.text())
                 self.XSVT_Nw = int(widget.XSVT_Nw_input.text())
+                self.XSVT_search = widget.XSVT_search_selection.currentText()
 
             elif self.method == "reversflowlcs":
                 dim_range = widget.viewer.dims.range[0]